@@ -8,7 +8,9 @@ import ConfigParser
 
 import cmdln
 import requests
+from cmdln import option
 
+from pp.user.validate import error
 from pp.user.client.rest import UserService
 
 
@@ -93,3 +95,72 @@ class AdminCmds(cmdln.Cmdln):
 
         else:
             self.log.info("Connected to user service OK: %s" % result)
+
+    @option(
+        "-n", "--requests", type="int", default=10,
+        help="The number of requests to profile (%default).",
+    )
+    @option(
+        "-r", "--route", default=None,
+        help="Only profile requests to this route e.g. the_users.",
+    )
+    @option(
+        "-o", "--output", default=".",
+        help="The directory to save the profile files in (%default).",
+    )
+    @option(
+        "-w", "--wait", type="float", default=300,
+        help=(
+            "The seconds to wait for the requests to be made, the capture "
+            "then ends with those made so far (%default)."
+        ),
+    )
+    def do_profile(self, subcmd, opts):
+        """${cmd_name}: Profile the next requests the service handles.
+
+        The service must have a profiling.admin_token, given here as the
+        admin_token in the configuration file. The pstats and memory files
+        are saved to the output directory once the requests are captured.
+        Look at the CPU profile with e.g.
+
+            python -m pstats <capture id>.pstats
+
+        ${cmd_usage}
+        ${cmd_option_list}
+
+        """
+        cfg = self.config
+        admin_token = cfg.get('admin_token')
+        if not admin_token:
+            self.log.error("No admin_token in the configuration file.")
+            return 1
+
+        with UserService(cfg['url']) as us:
+            details = us.profile(
+                admin_token, requests=opts.requests, route=opts.route,
+                timeout=opts.wait,
+            )
+            capture_id = details['capture_id']
+            self.log.info(
+                "Capturing '{}' requests as '{}', waiting...".format(
+                    opts.requests, capture_id
+                )
+            )
+
+            try:
+                details = us.profile_wait(
+                    admin_token, capture_id, timeout=opts.wait
+                )
+
+            except error.CommunicationError:
+                details = us.profile_cancel(admin_token, capture_id)
+                if not details['done']:
+                    raise
+            for kind in details['files']:
+                path = os.path.join(
+                    opts.output, "{}.{}".format(capture_id, kind)
+                )
+                data = us.profile_download(admin_token, capture_id, kind)
+                with open(path, "wb") as fd:
+                    fd.write(data)
+                self.log.info("Saved <{}>".format(path))
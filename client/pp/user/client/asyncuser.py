@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Non-blocking access to the User Service.
+
+The AsyncUserService and AsyncUserManagement have the same methods as the
+UserService and UserManagement. Each returns an AsyncResult straight away
+instead of blocking. Its get() returns what the blocking method would or
+raises the same error e.g. UserServiceError. The calls run in a pool of
+threads over one pooled session, so many can be in flight at once::
+
+    with AsyncUserService(uri) as api:
+        users = gather([api.user.get(name) for name in usernames])
+
+The generators iter_all() and iter_changes() are not offered as they would
+still be reading from the service, call page() and changes() instead.
+
+"""
+import logging
+from multiprocessing.pool import ThreadPool
+
+from pp.user.client import session as pooled
+from pp.user.client.rest import UserService
+from pp.user.client.user import UserManagement
+
+
+def get_log(e=None):
+    return logging.getLogger("{0}.{1}".format(__name__, e) if e else __name__)
+
+
+def gather(results, timeout=None):
+    """Wait for all the results.
+
+    :param results: A list of AsyncResult instances.
+
+    :param timeout: The seconds to wait for each result or None to block.
+
+    :returns: A list of the values in the same order. The first error
+    raised by a call is raised here.
+
+    """
+    return [result.get(timeout) for result in results]
+
+
+class AsyncUserManagement(object):
+    """The non-blocking version of UserManagement."""
+
+    def __init__(
+        self, uri, session=None, timeout=pooled.DEFAULT_TIMEOUT, workers=10,
+        pool=None, cache=None,
+    ):
+        """Set the URI of the User Service.
+
+        :param uri: The base address of the User Service server.
+
+        :param session: The requests.Session to make calls with. If not given
+        one pooling a connection per worker is created.
+
+        :param timeout: The (connect, read) timeout in seconds of each call.
+
+        :param workers: The number of calls which can be in flight at once.
+
+        :param pool: The ThreadPool to make calls in. If not given one of
+        workers threads is created and closed with this instance.
+
+        :param cache: See UserManagement().
+
+        """
+        self.log = get_log("AsyncUserManagement")
+        self.base_uri = uri
+        self._owns_session = session is None
+        if not session:
+            session = pooled.new_session(pool_size=workers)
+        self.session = session
+        self._owns_pool = pool is None
+        self.pool = pool if pool else ThreadPool(workers)
+        self.user = UserManagement(
+            uri, session=session, timeout=timeout, cache=cache,
+        )
+
+    def _submit(self, method, *args, **kwargs):
+        return self.pool.apply_async(method, args, kwargs)
+
+    def close(self):
+        """Wait for calls in flight then close the pool and session if this
+        instance created them.
+        """
+        if self._owns_pool:
+            self.pool.close()
+            self.pool.join()
+        if self._owns_session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def all(self):
+        """See UserManagement.all()."""
+        return self._submit(self.user.all)
+
+    def page(self, limit=100, after=None, fields=None, **filters):
+        """See UserManagement.page()."""
+        return self._submit(self.user.page, limit, after, fields, **filters)
+
+    def changes(self, since=0, limit=100, wait=0):
+        """See UserManagement.changes()."""
+        return self._submit(self.user.changes, since, limit, wait)
+
+    def get(self, username):
+        """See UserManagement.get()."""
+        return self._submit(self.user.get, username)
+
+    def get_many(self, usernames, fields=None, chunk_size=None):
+        """See UserManagement.get_many()."""
+        return self._submit(self.user.get_many, usernames, fields, chunk_size)
+
+    def add(self, user):
+        """See UserManagement.add()."""
+        return self._submit(self.user.add, user)
+
+    def add_many(self, users, chunk_size=None, progress=None):
+        """See UserManagement.add_many(). The progress is called from the
+        worker thread.
+        """
+        return self._submit(self.user.add_many, users, chunk_size, progress)
+
+    def remove(self, username):
+        """See UserManagement.remove()."""
+        return self._submit(self.user.remove, username)
+
+    def update(self, data, expected_version=None):
+        """See UserManagement.update()."""
+        return self._submit(self.user.update, data, expected_version)
+
+    def patch(self, data, expected_version=None):
+        """See UserManagement.patch()."""
+        return self._submit(self.user.patch, data, expected_version)
+
+    def version(self, username):
+        """See UserManagement.version(), this doesn't call the service so
+        the version is returned rather than a result.
+        """
+        return self.user.version(username)
+
+    def update_with_retry(self, username, change, attempts=5):
+        """See UserManagement.update_with_retry(). The change is called
+        from the worker thread.
+        """
+        return self._submit(
+            self.user.update_with_retry, username, change, attempts
+        )
+
+    def authenticate(self, username, plain_password):
+        """See UserManagement.authenticate()."""
+        return self._submit(self.user.authenticate, username, plain_password)
+
+    def authenticate_many(self, credentials, chunk_size=None):
+        """See UserManagement.authenticate_many()."""
+        return self._submit(
+            self.user.authenticate_many, credentials, chunk_size
+        )
+
+    def secret_for_access_token(self, access_token):
+        """See UserManagement.secret_for_access_token()."""
+        return self._submit(self.user.secret_for_access_token, access_token)
+
+
+class AsyncUserService(object):
+    """The non-blocking version of UserService."""
+
+    def __init__(
+        self, uri="http://localhost:16801", timeout=pooled.DEFAULT_TIMEOUT,
+        workers=10,
+    ):
+        """Set the URI of the UserService.
+
+        :param uri: The base address of the User Service server.
+
+        :param timeout: The (connect, read) timeout in seconds of each call.
+
+        :param workers: The number of calls which can be in flight at once.
+
+        The session and thread pool are shared with the AsyncUserManagement.
+
+        """
+        self.log = get_log("AsyncUserService")
+        self.base_uri = uri
+        self.pool = ThreadPool(workers)
+        self.service = UserService(
+            uri, timeout=timeout, pool_size=workers,
+        )
+        self.session = self.service.session
+        self.user = AsyncUserManagement(
+            uri, session=self.session, timeout=timeout, pool=self.pool,
+        )
+        self.api = self.user
+
+    def _submit(self, method, *args, **kwargs):
+        return self.pool.apply_async(method, args, kwargs)
+
+    def close(self):
+        """Wait for calls in flight then close the pool and session."""
+        self.pool.close()
+        self.pool.join()
+        self.service.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def ping(self):
+        """See UserService.ping()."""
+        return self._submit(self.service.ping)
+
+    def dump(self):
+        """See UserService.dump(). Streaming is not offered as the result
+        would be a generator still reading from the service.
+        """
+        return self._submit(self.service.dump)
+
+    def load(self, data, batch_size=1000):
+        """See UserService.load()."""
+        return self._submit(self.service.load, data, batch_size=batch_size)
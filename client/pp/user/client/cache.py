@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+An opt-in read through cache of users and access secrets for the client.
+
+Give UserManagement a TTLCache and its get() and secret_for_access_token()
+are answered from it while the entry is fresh::
+
+    um = UserManagement(uri, cache=TTLCache(max_size=1000, ttl=30))
+
+Updates and removes made through the same UserManagement drop what they
+change from the cache. Changes made elsewhere are seen once the TTL has
+expired.
+
+With a stale_ttl an expired entry is still returned for that many more
+seconds while it is refreshed in a background thread, so callers don't
+wait on the service for users they have asked for recently::
+
+    TTLCache(max_size=1000, ttl=30, stale_ttl=30)
+
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+
+def get_log(e=None):
+    return logging.getLogger("{0}.{1}".format(__name__, e) if e else __name__)
+
+
+# The states lookup() returns an entry in:
+FRESH = "fresh"
+STALE = "stale"
+MISSING = "missing"
+
+
+class TTLCache(object):
+    """A thread safe LRU cache with a time to live and a stale window.
+
+    Once max_size entries are held, adding another evicts the least
+    recently used.
+
+    """
+    def __init__(self, max_size=1000, ttl=30, stale_ttl=0, clock=time.time):
+        """
+        :param max_size: The most entries held. 0 disables the cache.
+
+        :param ttl: The seconds an entry is fresh for.
+
+        :param stale_ttl: The seconds after the TTL an entry is still
+        returned while it is refreshed. 0 disables stale-while-revalidate.
+
+        :param clock: A callable returning the time in seconds.
+
+        """
+        self.log = get_log("TTLCache")
+        self.max_size = int(max_size)
+        self.ttl = float(ttl)
+        self.stale_ttl = float(stale_ttl)
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._discards = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key):
+        """Recover the cached value for the key and how fresh it is.
+
+        :returns: A (state, value) tuple. The state is FRESH, STALE or
+        MISSING in which case the value is None.
+
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            now = self.clock()
+            if entry is None or entry[0] + self.stale_ttl < now:
+                self.misses += 1
+                return MISSING, None
+
+            # Put it back as the most recently used:
+            self._entries[key] = entry
+            if entry[0] < now:
+                self.stale_hits += 1
+                return STALE, entry[1]
+
+            self.hits += 1
+            return FRESH, entry[1]
+
+    def peek(self, key):
+        """Return the value held for the key, however old, or None.
+
+        This doesn't count as a use of the entry.
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry else None
+
+    def marker(self):
+        """Return a marker to give set() for a value about to be fetched.
+
+        If anything is discarded while the value is fetched, set() ignores
+        it as it may be from before the discard.
+
+        """
+        with self._lock:
+            return self._discards
+
+    def set(self, key, value, marker=None):
+        """Store the value for the key.
+
+        :param marker: The marker() from before the value was fetched.
+
+        """
+        if self.max_size < 1:
+            return
+
+        expires = self.clock() + self.ttl
+        with self._lock:
+            if marker is not None and marker != self._discards:
+                return
+
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[key] = (expires, value)
+
+    def discard(self, *keys):
+        """Remove the entries for the given keys if present."""
+        with self._lock:
+            self._discards += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def discard_if(self, predicate):
+        """Remove every entry the predicate(key, value) returns True for."""
+        with self._lock:
+            self._discards += 1
+            stale = [
+                key for key, (expires, value) in self._entries.items()
+                if predicate(key, value)
+            ]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        """Remove all entries leaving the counters as they are."""
+        with self._lock:
+            self._discards += 1
+            self._entries.clear()
+
+    def revalidate(self, key, fetch):
+        """Refresh a stale entry in a background thread.
+
+        Only one refresh of a key runs at a time. If fetch fails the stale
+        entry is kept until it expires.
+
+        :param fetch: A callable returning the fresh value.
+
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            marker = self._discards
+
+        def refresh():
+            failed = False
+            try:
+                self.set(key, fetch(), marker)
+
+            except Exception:
+                failed = True
+                self.log.exception("refreshing <{!r}> failed.".format(key))
+
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+                    if failed:
+                        self.refresh_errors += 1
+                    else:
+                        self.refreshes += 1
+
+        thread = threading.Thread(target=refresh, name="TTLCache.refresh")
+        thread.daemon = True
+        thread.start()
+
+    def stats(self):
+        """Return the cache counters.
+
+        :returns: A dict of the form::
+
+            dict(
+                size=<entries held>,
+                max_size=<most entries held>,
+                hits=<fresh entries returned>,
+                stale_hits=<stale entries returned while refreshed>,
+                misses=<count>,
+                hit_rate=<hits and stale hits over all lookups, 0.0 to 1.0>,
+                evictions=<count>,
+                refreshes=<background refreshes done>,
+                refresh_errors=<background refreshes which failed>,
+            )
+
+        """
+        lookups = self.hits + self.stale_hits + self.misses
+        return dict(
+            size=len(self._entries),
+            max_size=self.max_size,
+            hits=self.hits,
+            stale_hits=self.stale_hits,
+            misses=self.misses,
+            hit_rate=(
+                float(self.hits + self.stale_hits) / lookups
+                if lookups else 0.0
+            ),
+            evictions=self.evictions,
+            refreshes=self.refreshes,
+            refresh_errors=self.refresh_errors,
+        )
@@ -7,12 +7,12 @@ service to service access.
 
 """
 import json
+import time
 import logging
 from urlparse import urljoin
 
-import requests
-
 from pp.user.validate import error
+from pp.user.client import session as pooled
 from pp.user.client.user import UserManagement
 
 
@@ -28,17 +28,62 @@ class UserService(object):
 
     LOAD = "/usiverse/load/"
 
-    def __init__(self, uri="http://localhost:16801"):
+    PROFILE = "/usiverse/profile/"
+
+    PROFILE_STATUS = "/usiverse/profile/%(capture_id)s/"
+
+    PROFILE_FILE = "/usiverse/profile/%(capture_id)s/%(kind)s/"
+
+    ADMIN_TOKEN_HEADER = "X-Admin-Token"
+
+    NDJSON_CT = 'application/x-ndjson'
+
+    def __init__(
+        self, uri="http://localhost:16801", session=None,
+        timeout=pooled.DEFAULT_TIMEOUT, pool_size=10, pool_block=False,
+        retries=3, backoff=0.1,
+    ):
         """Set the URI of the UserService.
 
         :param uri: The base address of the User Service server.
 
+        :param session: The requests.Session to make calls with. If not
+        given a pooled one is created from the pool_size, pool_block, retries
+        and backoff. See pooled.new_session() for these.
+
+        :param timeout: The (connect, read) timeout in seconds of each call.
+
+        The session is shared with the UserManagement instance.
+
         """
         self.log = get_log("UserService")
         self.base_uri = uri
-        self.user = UserManagement(self.base_uri)
+        self.timeout = timeout
+        self._owns_session = session is None
+        if not session:
+            session = pooled.new_session(
+                pool_size=pool_size,
+                pool_block=pool_block,
+                retries=retries,
+                backoff=backoff,
+            )
+        self.session = session
+        self.user = UserManagement(
+            self.base_uri, session=self.session, timeout=self.timeout
+        )
         self.api = self.user
 
+    def close(self):
+        """Close the pooled connections if this instance created them."""
+        if self._owns_session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def ping(self):
         """Recover the User Service status page.
 
@@ -47,14 +92,23 @@ class UserService(object):
         :returns: service status dict.
 
         """
-        res = requests.get(self.base_uri)
+        res = self.session.get(self.base_uri, timeout=self.timeout)
         res.raise_for_status()
         return json.loads(res.content)
 
-    def dump(self):
+    def dump(self, stream=False, after=None, before=None, compress=True):
         """Used in testing to dump the entire user universe.
 
-        :returns: A dict.
+        :param stream: True to recover the users one at a time as they are
+        received rather than as a single list.
+
+        :param after: (stream only) recover users whose '_id' is after this.
+
+        :param before: (stream only) recover users whose '_id' is before this.
+
+        :param compress: (stream only) False to not ask for a gzipped stream.
+
+        :returns: A dict or when streaming a generator of user dicts.
 
         This has the form::
 
@@ -68,7 +122,10 @@ class UserService(object):
         uri = urljoin(self.base_uri, self.DUMP)
         self.log.debug("dump: uri <{}>".format(uri))
 
-        res = requests.get(uri)
+        if stream:
+            return self._dump_stream(uri, after, before, compress)
+
+        res = self.session.get(uri, timeout=self.timeout)
 
         rc = json.loads(res.content)
 
@@ -77,19 +134,211 @@ class UserService(object):
 
         return rc
 
-    def load(self, data):
+    def _dump_stream(self, uri, after, before, compress):
+        """Recover the newline-delimited JSON dump as it arrives.
+
+        :returns: A generator of user dicts.
+
+        """
+        params = dict(stream='yes')
+        if after:
+            params['after'] = after
+        if before:
+            params['before'] = before
+
+        headers = {}
+        if not compress:
+            headers['Accept-Encoding'] = 'identity'
+
+        res = self.session.get(
+            uri,
+            params=params,
+            headers=headers,
+            stream=True,
+            timeout=self.timeout,
+        )
+        if res.status_code not in [200]:
+            raise error.CommunicationError(res.content)
+
+        return (json.loads(line) for line in res.iter_lines() if line)
+
+    def load(self, data, stream=False, batch_size=1000):
         """Used in testing to load an entire user universe.
 
         :param data: See the return of a call to dump().
 
+        :param stream: True to send the users as newline-delimited JSON in
+        requests of batch_size users. The data can then be any iterable of
+        user dicts e.g. the generator of dump(stream=True).
+
+        :param batch_size: The number of users written per bulk operation.
+
+        :returns: The load report dict of the form::
+
+            dict(
+                batches=<bulk operations done>,
+                loaded=<users written>,
+                errors=<users which could not be written>,
+            )
+
         """
         uri = urljoin(self.base_uri, self.LOAD)
         self.log.debug("load: uri <{}>".format(uri))
 
+        params = dict(batch_size=batch_size)
+
+        if stream:
+            return self._load_stream(uri, data, params, batch_size)
+
         data = json.dumps(data)
-        res = requests.post(uri, data=data)
+        res = self.session.post(
+            uri,
+            data=data,
+            params=params,
+            timeout=self.timeout,
+        )
 
         rc = json.loads(res.content)
 
         if res.status_code not in [200]:
             raise error.CommunicationError(rc['message'])
+
+        return rc
+
+    def _load_stream(self, uri, data, params, batch_size):
+        """POST the users in newline-delimited JSON chunks.
+
+        :returns: The load reports of each chunk added together.
+
+        """
+        headers = {'content-type': self.NDJSON_CT}
+        report = dict(batches=0, loaded=0, errors=0)
+
+        def send(lines):
+            body = "\n".join(lines) + "\n"
+            res = self.session.post(
+                uri,
+                data=body,
+                params=params,
+                headers=headers,
+                timeout=self.timeout,
+            )
+            rc = json.loads(res.content)
+            if res.status_code not in [200]:
+                raise error.CommunicationError(rc['message'])
+            for key in report:
+                report[key] += rc[key]
+
+        lines = []
+        for userdict in data:
+            lines.append(json.dumps(userdict))
+            if len(lines) >= batch_size:
+                send(lines)
+                lines = []
+
+        if lines:
+            send(lines)
+
+        return report
+
+    def _admin_request(self, method, uri, admin_token, **kwargs):
+        """Make a request to an admin only URI.
+
+        :returns: The requests Response.
+
+        """
+        headers = kwargs.pop('headers', {})
+        headers[self.ADMIN_TOKEN_HEADER] = admin_token
+        res = self.session.request(
+            method, uri, headers=headers, timeout=self.timeout, **kwargs
+        )
+        if res.status_code not in [200]:
+            try:
+                message = json.loads(res.content)['message']
+            except (ValueError, KeyError, TypeError):
+                message = res.content
+            raise error.CommunicationError(message)
+
+        return res
+
+    def profile(self, admin_token, requests=10, route=None, timeout=None):
+        """Profile the next requests the service handles.
+
+        :param admin_token: The service's profiling.admin_token.
+
+        :param requests: The number of requests to capture.
+
+        :param route: Only capture requests to this route e.g. 'the_users'.
+
+        :param timeout: The seconds after which the capture ends with the
+        requests captured so far. None for the service's default.
+
+        :returns: The capture details dict with its 'capture_id'.
+
+        """
+        uri = urljoin(self.base_uri, self.PROFILE)
+        self.log.debug("profile: uri <{}>".format(uri))
+        res = self._admin_request(
+            'POST', uri, admin_token,
+            data=json.dumps(
+                dict(requests=requests, route=route, timeout=timeout)
+            ),
+            headers={'content-type': 'application/json'},
+        )
+        return json.loads(res.content)
+
+    def profile_cancel(self, admin_token, capture_id):
+        """End a capture, saving the requests captured so far.
+
+        Only the service worker making the capture can end it, the others
+        return its details unchanged.
+
+        :returns: The capture details.
+
+        """
+        uri = urljoin(
+            self.base_uri, self.PROFILE_STATUS % dict(capture_id=capture_id)
+        )
+        res = self._admin_request('DELETE', uri, admin_token)
+        return json.loads(res.content)
+
+    def profile_status(self, admin_token, capture_id):
+        """Recover the capture details, 'done' is True once it's complete.
+        """
+        uri = urljoin(
+            self.base_uri, self.PROFILE_STATUS % dict(capture_id=capture_id)
+        )
+        res = self._admin_request('GET', uri, admin_token)
+        return json.loads(res.content)
+
+    def profile_wait(self, admin_token, capture_id, timeout=60, poll=0.5):
+        """Wait for the capture to complete.
+
+        :returns: The done capture details.
+
+        """
+        expires = time.time() + timeout
+        while True:
+            details = self.profile_status(admin_token, capture_id)
+            if details['done']:
+                return details
+            if time.time() > expires:
+                raise error.CommunicationError(
+                    "Capture '{}' not done after '{}' seconds.".format(
+                        capture_id, timeout
+                    )
+                )
+            time.sleep(poll)
+
+    def profile_download(self, admin_token, capture_id, kind):
+        """Download one of a done capture's files.
+
+        :param kind: One of 'pstats', 'memory' or 'tracemalloc'.
+
+        :returns: The file's content.
+
+        """
+        uri = urljoin(self.base_uri, self.PROFILE_FILE % dict(
+            capture_id=capture_id, kind=kind,
+        ))
+        return self._admin_request('GET', uri, admin_token).content
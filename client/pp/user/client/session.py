@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+The pooled HTTP session shared by the UserService and its UserManagement.
+
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from pp.user.validate import tracing
+
+
+# Only requests which can be safely repeated are retried once sent:
+IDEMPOTENT_METHODS = frozenset(['HEAD', 'GET', 'OPTIONS'])
+
+# Server responses worth retrying an idempotent request on:
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+# The default (connect, read) timeouts in seconds:
+DEFAULT_TIMEOUT = (3.05, 30)
+
+
+class TracedAdapter(HTTPAdapter):
+    """Send each request in a span, passing the trace on in its headers."""
+
+    def send(self, request, **kwargs):
+        path = request.path_url.split("?")[0]
+        name = "client {} {}".format(request.method, path)
+        with tracing.start_span(name) as span:
+            request.headers[tracing.HEADER] = span.traceparent()
+            response = super(TracedAdapter, self).send(request, **kwargs)
+            span.set_attribute("status", response.status_code)
+            return response
+
+
+def new_session(pool_size=10, pool_block=False, retries=3, backoff=0.1):
+    """Create a requests Session keeping connections open to the service.
+
+    :param pool_size: The number of connections kept open per host.
+
+    :param pool_block: True to wait for a free connection rather than open
+    a throw away one when all pool_size connections are in use.
+
+    :param retries: The number of retries of an idempotent request or a
+    request whose connection could not be established.
+
+    :param backoff: The backoff factor in seconds between retries.
+
+    Each request carries the current trace context, see
+    pp.user.validate.tracing.
+
+    :returns: A requests.Session instance.
+
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        method_whitelist=IDEMPOTENT_METHODS,
+    )
+    adapter = TracedAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        pool_block=pool_block,
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
@@ -10,14 +10,20 @@ Oisin Mulvihill
 2014-01-23
 
 """
+import copy
 import json
+import time
+import httplib
 import logging
+import threading
+from collections import OrderedDict
 from urlparse import urljoin
 
-import requests
-
 from pp.user.validate import error
+from pp.user.validate import tracing
 from pp.user.validate import userdata
+from pp.user.client import session as pooled
+from pp.user.client import cache as clientcache
 
 
 def get_log(e=None):
@@ -45,14 +51,111 @@ class UserManagement(object):
 
     AUTH = "/access/auth/%(username)s/"
 
+    AUTH_BATCH = "/access/auth/batch/"
+
+    BATCH = "/users/batch/"
+
+    # The most users sent or asked for in one batch request:
+    BATCH_SIZE = 500
+
     TOKEN = "/access/secret/%(access_token)s/"
 
     GET_UPDATE_OR_DELETE = "/user/%(username)s/"
 
-    def __init__(self, uri):
+    CHANGES = "/users/changes/"
+
+    # The seconds iter_changes() pauses when the service has no room for
+    # another long poll:
+    CHANGES_BUSY_PAUSE = 1.0
+
+    # The most users get() keeps the ETag and body of to revalidate:
+    MAX_VALIDATED = 1000
+
+    # The version of each user, changed by every update. The service only
+    # gives it in the user's ETag, see version():
+    VERSION_FIELD = "_version"
+
+    def __init__(
+        self, uri, session=None, timeout=pooled.DEFAULT_TIMEOUT, cache=None,
+    ):
+        """Set the URI of the UserService.
+
+        :param uri: The base address of the User Service server.
+
+        :param session: The requests.Session to make calls with. If not
+        given a pooled one is created by pooled.new_session() and closed
+        with this instance.
+
+        :param timeout: The (connect, read) timeout in seconds of each call.
+
+        :param cache: An optional pp.user.client.cache.TTLCache to answer
+        get() and secret_for_access_token() from. None for no caching.
+
+        """
         self.log = get_log("UserManagement")
         self.base_uri = uri
+        self.timeout = timeout
+        self.cache = cache
+        self._owns_session = session is None
+        self.session = session if session else pooled.new_session()
+        self._validated = OrderedDict()
+        self._validated_lock = threading.Lock()
+
+    def close(self):
+        """Close the pooled connections if this instance created them."""
+        if self._owns_session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _raise_if_busy(self, res):
+        """Raise ServiceBusyError if the service responded with a 503."""
+        if res.status_code == httplib.SERVICE_UNAVAILABLE:
+            raise error.ServiceBusyError(
+                "The user service is too busy, try again later."
+            )
+
+    def _if_match(self, data, expected_version):
+        """Return the If-Match of the user data's expected version."""
+        if not data.get('_id'):
+            raise ValueError(
+                "The user '_id' is needed with the expected_version."
+            )
+        return '"{}.{}"'.format(data['_id'], expected_version)
+
+    def _version_of(self, etag):
+        """Recover the user version from the ETag get() was given."""
+        return int(etag.strip().strip('"').rpartition(".")[2])
+
+    def _remember(self, username, etag, userdict):
+        """Keep the ETag and user the service returned, see get()."""
+        if not etag:
+            return
+
+        with self._validated_lock:
+            self._validated.pop(username, None)
+            self._validated[username] = (etag, copy.deepcopy(userdict))
+            while len(self._validated) > self.MAX_VALIDATED:
+                self._validated.popitem(last=False)
+
+    def version(self, username):
+        """Return the user's '_version' as last returned by the service.
+
+        This is from the ETag of the user's last get(), add(), update() or
+        patch() and is what update() takes as the expected_version.
+
+        :returns: The version or None if the user's ETag isn't known.
 
+        """
+        with self._validated_lock:
+            known = self._validated.get(username)
+        return self._version_of(known[0]) if known else None
+
+    @tracing.traced("UserManagement.all")
     def all(self):
         """Return all users currently on the system.
 
@@ -64,7 +167,7 @@ class UserManagement(object):
         uri = urljoin(self.base_uri, self.ALL)
         self.log.debug("all: uri <%s>" % uri)
 
-        res = requests.get(uri)
+        res = self.session.get(uri, timeout=self.timeout)
         rc = res.json()
         if not rc['success']:
             raise userdata.UserServiceError(rc['message'])
@@ -73,11 +176,227 @@ class UserManagement(object):
 
         return rc['data']
 
+    @tracing.traced("UserManagement.page")
+    def page(self, limit=100, after=None, fields=None, **filters):
+        """Return a page of the users on the system.
+
+        :param limit: The most users to return.
+
+        :param after: The 'after' returned with the previous page.
+
+        :param fields: A list of the user fields to return or None for all.
+
+        :param filters: Only users with these field values are returned.
+
+        :returns: A dict of the form::
+
+            dict(
+                users=[<user dict>, ..],
+                # None when there are no more pages:
+                after="<_id to recover the next page with>",
+            )
+
+        """
+        params = dict(filters)
+        params['limit'] = limit
+        if after:
+            params['after'] = after
+        if fields:
+            params['fields'] = ",".join(fields)
+
+        uri = urljoin(self.base_uri, self.ALL)
+        self.log.debug("page: uri <%s> params <%s>" % (uri, params))
+
+        res = self.session.get(uri, params=params, timeout=self.timeout)
+        rc = res.json()
+        if not rc['success']:
+            raise userdata.UserServiceError(rc['message'])
+
+        return rc['data']
+
+    def iter_all(self, page_size=100, fields=None, **filters):
+        """Iterate over all users a page at a time.
+
+        :param page_size: The number of users recovered per request.
+
+        See page() for fields and filters.
+
+        :returns: A generator of user dicts.
+
+        """
+        after = None
+        while True:
+            found = self.page(page_size, after, fields, **filters)
+            for user in found['users']:
+                yield user
+
+            after = found['after']
+            if not after:
+                break
+
+    @tracing.traced("UserManagement.changes")
+    def changes(self, since=0, limit=100, wait=0):
+        """Return the user changes after the given sequence number.
+
+        :param since: The 'last_seq' of the previous call, 0 for all.
+
+        :param limit: The most changes to return.
+
+        :param wait: The seconds the service waits for a change if there
+        are none yet. ServiceBusyError is raised if too many others are
+        already waiting.
+
+        :returns: A dict of the form::
+
+            dict(
+                changes=[<change>, ..],
+                last_seq=<the since of the following call>,
+                reset=<True if every user must be reloaded>,
+            )
+
+        See pp.user.model.changes for the change dict.
+
+        """
+        uri = urljoin(self.base_uri, self.CHANGES)
+        params = dict(since=since, limit=limit, wait=wait)
+        self.log.debug("changes: uri <%s> params <%s>" % (uri, params))
+
+        # Allow for the wait on top of the usual read timeout:
+        timeout = self.timeout
+        if isinstance(timeout, tuple):
+            timeout = (timeout[0], timeout[1] + wait)
+        elif timeout:
+            timeout += wait
+
+        res = self.session.get(uri, params=params, timeout=timeout)
+        self._raise_if_busy(res)
+        rc = res.json()
+        if not rc['success']:
+            raise userdata.UserServiceError(rc['message'])
+
+        return rc['data']
+
+    def iter_changes(self, since=0, limit=100, wait=30, follow=True):
+        """Yield the user changes in order from the given sequence number.
+
+        Each change's 'seq' is the since to resume from after it::
+
+            for change in um.iter_changes(since=last_seq):
+                apply(change)
+                last_seq = change['seq']
+
+        :param wait: The seconds each request waits for new changes. If
+        the service is too busy to wait this pauses and tries again.
+
+        :param follow: True to wait for changes forever, False to stop once
+        the changes made so far have been returned.
+
+        ChangesResetError is raised if the changes after since are no longer
+        held.
+
+        :returns: A generator of change dicts.
+
+        """
+        while True:
+            try:
+                found = self.changes(since, limit, wait if follow else 0)
+
+            except error.ServiceBusyError:
+                time.sleep(self.CHANGES_BUSY_PAUSE)
+                continue
+
+            if found['reset']:
+                raise userdata.ChangesResetError(
+                    "The changes after '%s' are no longer held." % since
+                )
+
+            for change in found['changes']:
+                yield change
+
+            since = found['last_seq']
+            if not follow and not found['changes']:
+                break
+
+    def _cached(self, key, fetch):
+        """Return the value from the cache, fetching it if missing.
+
+        A stale value is returned and refreshed in the background.
+
+        """
+        if self.cache is None:
+            return fetch()
+
+        state, value = self.cache.lookup(key)
+        if state == clientcache.STALE:
+            self.cache.revalidate(key, fetch)
+        if state != clientcache.MISSING:
+            return value
+
+        marker = self.cache.marker()
+        value = fetch()
+        # Not found isn't cached, so e.g. a new access token is seen:
+        if value is not None:
+            self.cache.set(key, value, marker)
+        return value
+
+    def _forget(self, username, changed_tokens, updated=None):
+        """Drop the cached user and the secrets a change could affect.
+
+        :param changed_tokens: True if the user's tokens could have changed.
+
+        :param updated: The user dict returned by the change, if any.
+
+        """
+        if self.cache is None:
+            return
+
+        before = self.cache.peek(('user', username))
+        tokens = set()
+        for found in (before, updated):
+            if found:
+                tokens.update((found.get('tokens') or {}).keys())
+
+        keys = [('user', username)] + [('secret', t) for t in tokens]
+        if updated:
+            # It may have been renamed:
+            keys.append(('user', updated['username']))
+        self.cache.discard(*keys)
+
+        if changed_tokens and before is None:
+            # The tokens the user had aren't known:
+            self.cache.discard_if(lambda key, value: key[0] == 'secret')
+
+    @tracing.traced("UserManagement.get")
     def get(self, username):
         """Get an existing user of the system.
 
+        If this has a cache the user is returned from it while fresh.
+
+        The ETag and user of the last get(), add(), update() or patch() of
+        each username are kept. The service is asked if the user has
+        changed since, if not it doesn't send the user again. The user's
+        '_version' is in its ETag rather than the dict, see version().
+
         :returns: The user dict.
 
+        """
+        if self.cache is None:
+            return self._get(username)
+
+        # Each caller gets its own copy of the cached user to change:
+        found = self._cached(('user', username), lambda: self._get(username))
+        return copy.deepcopy(found)
+
+    def _get(self, username):
+        """Recover the user from the service, see get()."""
+        return self._get_with_etag(username)[0]
+
+    def _get_with_etag(self, username):
+        """Recover the user and its ETag from the service, see get().
+
+        :returns: A (user dict, ETag) tuple, the ETag is None if the
+        service didn't give one.
+
         """
         #self.log.debug("get: attempting to get user <%s>" % username)
 
@@ -86,13 +405,76 @@ class UserManagement(object):
         ))
         #self.log.debug("get: uri <%s>" % uri)
 
-        res = requests.get(uri, headers=self.JSON_CT)
+        headers = dict(self.JSON_CT)
+        with self._validated_lock:
+            known = self._validated.get(username)
+        if known:
+            headers['If-None-Match'] = known[0]
+
+        res = self.session.get(uri, headers=headers, timeout=self.timeout)
+        if known and res.status_code == httplib.NOT_MODIFIED:
+            return copy.deepcopy(known[1]), known[0]
+
         rc = res.json()
         if not rc['success']:
+            with self._validated_lock:
+                self._validated.pop(username, None)
             raise userdata.UserServiceError(rc['message'])
 
-        return rc['data']
+        etag = res.headers.get('ETag')
+        self._remember(username, etag, rc['data'])
+
+        return rc['data'], etag
+
+    @tracing.traced("UserManagement.get_many")
+    def get_many(self, usernames, fields=None, chunk_size=None):
+        """Get many existing users, a request per chunk of usernames.
+
+        :param usernames: A list of the usernames to get.
+
+        :param fields: A list of the user fields to return or None for all.
+        The '_id' and 'username' are always returned.
+
+        :param chunk_size: The most usernames asked for per request, the
+        BATCH_SIZE by default.
+
+        :returns: A dict of the form::
 
+            dict(
+                # In the order given, None for a username not found:
+                users=[<user dict> | None, ..],
+                missing=["<username not found>", ..],
+            )
+
+        """
+        chunk_size = chunk_size or self.BATCH_SIZE
+        uri = urljoin(self.base_uri, self.BATCH)
+        self.log.debug("get_many: <%s> users uri <%s>" % (
+            len(usernames), uri
+        ))
+
+        rc = dict(users=[], missing=[])
+        for start in range(0, len(usernames), chunk_size):
+            data = dict(usernames=usernames[start:start + chunk_size])
+            if fields is not None:
+                data['fields'] = fields
+
+            res = self.session.post(
+                uri,
+                json.dumps(data),
+                headers=self.JSON_CT,
+                timeout=self.timeout,
+            )
+            found = res.json()
+            if not found['success']:
+                raise userdata.UserServiceError(found['message'])
+
+            rc['users'].extend(found['data']['users'])
+            rc['missing'].extend(found['data']['missing'])
+
+        return rc
+
+    @tracing.traced("UserManagement.add")
     def add(self, user):
         """Add a new user to the system.
 
@@ -109,13 +491,96 @@ class UserManagement(object):
         uri = urljoin(self.base_uri, self.ADD)
         self.log.debug("add: uri <%s>" % uri)
 
-        res = requests.put(uri, json.dumps(user), headers=self.JSON_CT)
+        res = self.session.put(
+            uri,
+            json.dumps(user),
+            headers=self.JSON_CT,
+            timeout=self.timeout,
+        )
+        self._raise_if_busy(res)
         rc = res.json()
         if not rc['success']:
             raise userdata.UserServiceError(rc['message'])
 
+        self._remember(
+            rc['data']['username'], res.headers.get('ETag'), rc['data']
+        )
+
         return rc['data']
 
+    @tracing.traced("UserManagement.add_many")
+    def add_many(self, users, chunk_size=None, progress=None):
+        """Add many new users, a request per chunk of users.
+
+        :param users: An iterable of user dicts as add() takes. It is read
+        a chunk at a time so a generator of any size can be given.
+
+        :param chunk_size: The most users sent per request, the BATCH_SIZE
+        by default.
+
+        :param progress: An optional callable given the list of results so
+        far after each chunk.
+
+        :returns: A list in the same order as the users of::
+
+            dict(
+                username="<username>",
+                status="added" | "conflict" | "invalid" | "failed",
+                _id="<the new user's '_id'>" | None,
+                message="<why the user wasn't added>" | None,
+            )
+
+        """
+        chunk_size = chunk_size or self.BATCH_SIZE
+        uri = urljoin(self.base_uri, self.BATCH)
+        self.log.debug("add_many: uri <%s>" % uri)
+
+        def send(chunk):
+            res = self.session.put(
+                uri,
+                json.dumps([user for index, user in chunk]),
+                headers=self.JSON_CT,
+                timeout=self.timeout,
+            )
+            self._raise_if_busy(res)
+            rc = res.json()
+            if not rc['success']:
+                raise userdata.UserServiceError(rc['message'])
+            for (index, user), result in zip(chunk, rc['data']):
+                results[index] = result
+            if progress:
+                progress(results)
+
+        results = []
+        # The (index in results, user) of the users to send next:
+        chunk = []
+        for user in users:
+            # Validated here as the password is sent obuscated, see add():
+            try:
+                user = userdata.creation_required_fields(dict(user))
+            except userdata.UserServiceError as e:
+                results.append(dict(
+                    username=user.get('username'),
+                    status="invalid",
+                    _id=None,
+                    message=str(e),
+                ))
+                continue
+
+            if "password" in user:
+                user['password'] = user['password'].encode("base64")
+            chunk.append((len(results), user))
+            results.append(None)
+            if len(chunk) >= chunk_size:
+                send(chunk)
+                chunk = []
+
+        if chunk:
+            send(chunk)
+
+        return results
+
+    @tracing.traced("UserManagement.remove")
     def remove(self, username):
         """Remove an existing user from the system.
 
@@ -129,14 +594,20 @@ class UserManagement(object):
         ))
         self.log.debug("remove: uri <%s>" % uri)
 
-        res = requests.delete(uri, headers=self.JSON_CT)
+        res = self.session.delete(
+            uri,
+            headers=self.JSON_CT,
+            timeout=self.timeout,
+        )
         rc = res.json()
+        self._forget(username, True)
         if not rc['success']:
             raise userdata.UserServiceError(rc['message'])
 
         return rc['data']
 
-    def update(self, data):
+    @tracing.traced("UserManagement.update")
+    def update(self, data, expected_version=None):
         """Update the details about an existing user.
 
         :param data: This must contain the 'username' field at least.
@@ -145,6 +616,10 @@ class UserManagement(object):
 
         To change password, the "new_password" field is provided.
 
+        :param expected_version: The user's version() as last seen. The
+        data must then also have the user's '_id'. If the user has changed
+        since UserVersionConflictError is raised and nothing is updated.
+
         :returns: A dict containing the updated user details.
 
         """
@@ -168,13 +643,140 @@ class UserManagement(object):
         ))
         self.log.debug("update: uri <%s>" % uri)
 
-        res = requests.put(uri, json.dumps(data), headers=self.JSON_CT)
+        headers = dict(self.JSON_CT)
+        if expected_version is not None:
+            headers['If-Match'] = self._if_match(data, expected_version)
+
+        res = self.session.put(
+            uri,
+            json.dumps(data),
+            headers=headers,
+            timeout=self.timeout,
+        )
+        self._raise_if_busy(res)
         rc = res.json()
+        self._forget(
+            username, 'tokens' in data, rc['data'] if rc['success'] else None
+        )
+        if res.status_code == httplib.PRECONDITION_FAILED:
+            raise userdata.UserVersionConflictError(rc['message'])
         if not rc['success']:
             raise userdata.UserServiceError(rc['message'])
 
+        self._remember(
+            rc['data']['username'], res.headers.get('ETag'), rc['data']
+        )
+
         return rc['data']
 
+    @tracing.traced("UserManagement.patch")
+    def patch(self, data, expected_version=None):
+        """Change some of an existing user's fields.
+
+        :param data: This must contain the 'username' field at least. It is
+        merged into the user, a dict such as 'extra' or 'tokens' field by
+        field, and a None value removes the field::
+
+            um.patch(dict(username="bob", extra=dict(role="admin")))
+
+        Only the changes are sent and written, unlike update() which
+        replaces each field given.
+
+        :param expected_version: As for update().
+
+        :returns: A dict containing the updated user details.
+
+        """
+        data = userdata.user_update_fields_ok(dict(data))
+        username = data.pop('username')
+
+        self.log.debug("patch: attempting to patch user <%s>." % username)
+
+        # obuscate for moment, see update():
+        if "new_password" in data:
+            data["new_password"] = data["new_password"].encode("base64")
+
+        uri = urljoin(self.base_uri, self.GET_UPDATE_OR_DELETE % dict(
+            username=username,
+        ))
+        self.log.debug("patch: uri <%s>" % uri)
+
+        headers = {'content-type': 'application/merge-patch+json'}
+        if expected_version is not None:
+            headers['If-Match'] = self._if_match(data, expected_version)
+        data.pop('_id', None)
+
+        res = self.session.patch(
+            uri,
+            json.dumps(data),
+            headers=headers,
+            timeout=self.timeout,
+        )
+        self._raise_if_busy(res)
+        rc = res.json()
+        self._forget(
+            username, 'tokens' in data, rc['data'] if rc['success'] else None
+        )
+        if res.status_code == httplib.PRECONDITION_FAILED:
+            raise userdata.UserVersionConflictError(rc['message'])
+        if not rc['success']:
+            raise userdata.UserServiceError(rc['message'])
+
+        self._remember(
+            rc['data']['username'], res.headers.get('ETag'), rc['data']
+        )
+
+        return rc['data']
+
+    def update_with_retry(self, username, change, attempts=5):
+        """Change a user, merging with the changes made by others.
+
+        The user is read, change(user) is called with a copy of it and the
+        fields it returns are updated if the user is still that version.
+        If another update got there first the user is read again and
+        change() called with it, up to attempts times::
+
+            def add_role(user):
+                return dict(extra=dict(user['extra'], role="admin"))
+
+            um.update_with_retry("bob", add_role)
+
+        :param change: Called with the user dict, returns a dict of the
+        fields to update. An empty dict or None leaves the user as is.
+
+        :returns: The updated user dict.
+
+        """
+        for attempt in range(attempts):
+            # Not from the cache, the version must be the current one:
+            current, etag = self._get_with_etag(username)
+            fields = change(copy.deepcopy(current))
+            if not fields:
+                return current
+
+            if etag:
+                version = self._version_of(etag)
+            else:
+                version = current.get(self.VERSION_FIELD, 0)
+
+            fields = dict(fields, username=username, _id=current['_id'])
+            try:
+                return self.update(fields, version)
+
+            except userdata.UserVersionConflictError:
+                self.log.debug(
+                    "update_with_retry: <%s> changed, attempt %s." % (
+                        username, attempt + 1
+                    )
+                )
+
+        raise userdata.UserVersionConflictError(
+            "The user <%s> kept changing over %s attempts." % (
+                username, attempts
+            )
+        )
+
+    @tracing.traced("UserManagement.authenticate")
     def authenticate(self, username, plain_password):
         """Verify the password for the given username.
 
@@ -196,22 +798,80 @@ class UserManagement(object):
         uri = urljoin(self.base_uri, self.AUTH % dict(username=username))
         self.log.debug("authenticate: uri <%s>" % uri)
 
-        res = requests.post(uri, json.dumps(data), headers=self.JSON_CT)
+        res = self.session.post(
+            uri,
+            json.dumps(data),
+            headers=self.JSON_CT,
+            timeout=self.timeout,
+        )
+        self._raise_if_busy(res)
         rc = res.json()
         if not rc['success']:
             raise userdata.UserServiceError(rc['message'])
 
         return rc['data']
 
+    @tracing.traced("UserManagement.authenticate_many")
+    def authenticate_many(self, credentials, chunk_size=None):
+        """Verify the passwords of many users, a request per chunk.
+
+        :param credentials: A list of (username, plain_password) tuples.
+
+        :param chunk_size: The most credentials sent per request, the
+        BATCH_SIZE by default.
+
+        :returns: A list of True or False in the same order. False is
+        returned for a wrong password or a username which isn't present.
+
+        """
+        self.log.debug("authenticate_many: <%s> users" % len(credentials))
+
+        chunk_size = chunk_size or self.BATCH_SIZE
+        data = [
+            dict(username=username, password=plain_password.encode("base64"))
+            for username, plain_password in credentials
+        ]
+
+        uri = urljoin(self.base_uri, self.AUTH_BATCH)
+        self.log.debug("authenticate_many: uri <%s>" % uri)
+
+        results = []
+        for start in range(0, len(data), chunk_size):
+            res = self.session.post(
+                uri,
+                json.dumps(data[start:start + chunk_size]),
+                headers=self.JSON_CT,
+                timeout=self.timeout,
+            )
+            self._raise_if_busy(res)
+            rc = res.json()
+            if not rc['success']:
+                raise userdata.UserServiceError(rc['message'])
+
+            results.extend(result['authenticated'] for result in rc['data'])
+
+        return results
+
+    @tracing.traced("UserManagement.secret_for_access_token")
     def secret_for_access_token(self, access_token):
         """Recover the secret for the given access token.
+
+        If this has a cache a found secret is returned from it while fresh.
+
         """
+        return self._cached(
+            ('secret', access_token),
+            lambda: self._secret_for_access_token(access_token),
+        )
+
+    def _secret_for_access_token(self, access_token):
+        """Recover the secret from the service."""
         uri = urljoin(self.base_uri, self.TOKEN % dict(
             access_token=access_token,
         ))
         self.log.debug("secret_for_access_token: uri <%s>" % uri)
 
-        res = requests.get(uri, headers=self.JSON_CT)
+        res = self.session.get(uri, headers=self.JSON_CT, timeout=self.timeout)
         rc = res.json()
         if not rc['success']:
             raise userdata.UserServiceError(rc['message'])
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Account for the MongoDB round trips made while doing something.
+
+Every command the driver sends in a track() block is recorded with its
+query shape, the documents returned or written and the bytes sent and
+received::
+
+    with accounting.track() as usage:
+        user.update(username="bob", display_name="Bob")
+
+    usage.round_trips
+    >>> 1
+    usage.shapes()
+    >>> ['findAndModify everyone {"username": "?"}']
+
+MongoDB doesn't report the documents a query examined to the driver, use
+explain() on a shape from here for that.
+
+max_round_trips() fails a test when a model call starts needing more round
+trips than it should::
+
+    with accounting.max_round_trips(1):
+        user.get("bob")
+
+"""
+import json
+import logging
+import threading
+from timeit import default_timer
+
+import bson
+from pymongo import monitoring
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+# The filter each command's query shape comes from:
+FILTER_FIELDS = ("filter", "query", "q")
+
+
+def shape(value):
+    """Return the value with every literal replaced by '?'.
+
+    Operators and field names are kept, so queries differing only in the
+    values they look for have the same shape.
+
+    """
+    if isinstance(value, dict):
+        return dict((key, shape(item)) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        return [shape(item) for item in value[:1]]
+    return "?"
+
+
+def command_shape(name, command):
+    """Return the "<command> <collection> <filter shape>" of a command."""
+    # A getMore is named after its cursor id:
+    if name == "getMore":
+        collection = command.get("collection")
+    else:
+        collection = command.get(name)
+    found = None
+    for field in FILTER_FIELDS:
+        if field in command:
+            found = command[field]
+            break
+
+    if found is None and name == "aggregate":
+        found = command.get("pipeline")
+
+    # Writes hold their filters in a list of statements:
+    statements = command.get(name + "s")
+    if found is None and statements and name in ("update", "delete"):
+        found = statements[0].get("q")
+
+    rc = "{} {}".format(name, collection)
+    if found is not None:
+        rc += " " + json.dumps(shape(found), sort_keys=True)
+    return rc
+
+
+def documents_in(name, reply):
+    """Return the (returned, written) document counts from a reply."""
+    cursor = reply.get("cursor")
+    if cursor:
+        batch = cursor.get("firstBatch", cursor.get("nextBatch", []))
+        return len(batch), 0
+    if name == "findAndModify":
+        return (1 if reply.get("value") else 0), 0
+    if name in ("insert", "update", "delete"):
+        return 0, reply.get("n", 0)
+    return 0, 0
+
+
+class Usage(object):
+    """The round trips made within a track() block."""
+
+    def __init__(self, measure_bytes=True):
+        self.measure_bytes = measure_bytes
+        self.commands = []
+        self.round_trips = 0
+        self.docs_returned = 0
+        self.docs_written = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.started = default_timer()
+        self.duration = None
+
+    def add(self, command):
+        self.commands.append(command)
+        self.round_trips += 1
+        self.docs_returned += command['docs_returned']
+        self.docs_written += command['docs_written']
+        self.bytes_sent += command['bytes_sent']
+        self.bytes_received += command['bytes_received']
+
+    def shapes(self):
+        """Return the query shape of each round trip in order."""
+        return [command['shape'] for command in self.commands]
+
+    def summary(self):
+        return dict(
+            round_trips=self.round_trips,
+            docs_returned=self.docs_returned,
+            docs_written=self.docs_written,
+            bytes_sent=self.bytes_sent,
+            bytes_received=self.bytes_received,
+            duration_ms=(self.duration or 0) * 1000,
+            commands=self.commands,
+        )
+
+
+class CommandListener(monitoring.CommandListener):
+    """Record the commands made in this thread into its track() blocks.
+
+    Outside of a track() block each event costs a thread local lookup.
+
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def active(self):
+        return getattr(self._local, "usages", None)
+
+    def push(self, usage):
+        if self.active() is None:
+            self._local.usages = []
+            self._local.pending = {}
+        self._local.usages.append(usage)
+
+    def pop(self, usage):
+        self._local.usages.remove(usage)
+
+    def started(self, event):
+        usages = self.active()
+        if not usages:
+            return
+
+        command = event.command
+        sent = 0
+        if any(usage.measure_bytes for usage in usages):
+            sent = len(bson.BSON.encode(command))
+        self._local.pending[event.request_id] = dict(
+            command=event.command_name,
+            shape=command_shape(event.command_name, command),
+            bytes_sent=sent,
+        )
+
+    def _finish(self, event, reply, failure=None):
+        usages = self.active()
+        if not usages:
+            return
+        found = self._local.pending.pop(event.request_id, None)
+        if found is None:
+            return
+
+        returned, written = documents_in(event.command_name, reply)
+        received = 0
+        if any(usage.measure_bytes for usage in usages):
+            received = len(bson.BSON.encode(reply))
+        found.update(
+            duration_ms=event.duration_micros / 1000.0,
+            docs_returned=returned,
+            docs_written=written,
+            bytes_received=received,
+            failure=failure,
+        )
+        for usage in usages:
+            usage.add(found)
+
+    def succeeded(self, event):
+        self._finish(event, event.reply)
+
+    def failed(self, event):
+        self._finish(event, {}, str(event.failure))
+
+
+# Added to every MongoClient made by pp.user.model.db:
+listener = CommandListener()
+
+
+class track(object):
+    """Record the MongoDB round trips made in this thread in the block.
+
+    :param measure_bytes: False to not measure the bytes sent and received,
+    which costs re-encoding each command and reply.
+
+    """
+    def __init__(self, measure_bytes=True):
+        self.usage = Usage(measure_bytes)
+
+    def __enter__(self):
+        listener.push(self.usage)
+        return self.usage
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.usage.duration = default_timer() - self.usage.started
+        listener.pop(self.usage)
+
+
+class max_round_trips(track):
+    """Fail with an AssertionError if the block makes more round trips.
+
+    For use in tests to keep model calls within their budget.
+
+    """
+    def __init__(self, budget):
+        super(max_round_trips, self).__init__(measure_bytes=False)
+        self.budget = budget
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(max_round_trips, self).__exit__(exc_type, exc_value, traceback)
+        if exc_type is None and self.usage.round_trips > self.budget:
+            raise AssertionError(
+                "'{}' round trips made, the budget is '{}':\n{}".format(
+                    self.usage.round_trips, self.budget,
+                    "\n".join(self.usage.shapes()),
+                )
+            )
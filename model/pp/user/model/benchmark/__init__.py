@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks of pp.user.model.user against a local mongod.
+
+Run at the default 1k/100k/1M users, writing JSON results to compare builds
+with::
+
+    user-model-benchmark --output results.json
+
+See runner.main() for the options.
+
+"""
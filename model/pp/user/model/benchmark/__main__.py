@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+Allow the benchmarks to be run with 'python -m pp.user.model.benchmark'.
+
+"""
+from .runner import main
+
+main()
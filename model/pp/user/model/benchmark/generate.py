@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Reproducible synthetic users for benchmarking.
+
+The same seed, count and sizes always produce the same users so results
+from different builds can be compared.
+
+"""
+import random
+
+from pp.auth import pwtools
+
+
+def username_for(index):
+    """Return the username of the synthetic user at the given index."""
+    return "user{:08d}".format(index)
+
+
+def synthetic_users(
+    count, start=0, tokens=2, extra_bytes=256, seed=1, password_hash=None,
+):
+    """Generate synthetic user dicts ready to load().
+
+    :param count: The number of users to generate.
+
+    :param start: The index of the first user, users are numbered from here.
+
+    :param tokens: The number of access tokens each user has.
+
+    :param extra_bytes: The approximate size of each user's 'extra' dict.
+
+    :param seed: The random seed. Each user is generated from the seed and
+    its index so any range of users is the same on every run.
+
+    :param password_hash: The hash every user has. Hashing is deliberately
+    slow so one hash is shared. If not given the hash of 'password' is used.
+
+    :returns: A generator of user dicts.
+
+    """
+    if not password_hash:
+        password_hash = pwtools.hash_password('password')
+
+    for index in range(start, start + count):
+        rng = random.Random("{}-{}".format(seed, index))
+
+        def hexstr(length):
+            return "{:0{}x}".format(rng.getrandbits(length * 4), length)
+
+        username = username_for(index)
+        user_tokens = dict(
+            (hexstr(32), dict(access_secret=hexstr(64)))
+            for i in range(tokens)
+        )
+        # Each extra field is a 64 character value with a short key:
+        extra = dict(
+            ("field{}".format(i), hexstr(64))
+            for i in range(max(1, extra_bytes // 72))
+        )
+
+        yield {
+            "_id": "user-{:032x}".format(index),
+            "username": username,
+            "display_name": "User {}".format(index),
+            "email": "{}@example.com".format(username),
+            "phone": "{:010d}".format(index),
+            "password_hash": password_hash,
+            "tokens": user_tokens,
+            "extra": extra,
+        }
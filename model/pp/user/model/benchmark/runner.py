@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Time the pp.user.model.user operations at different collection sizes.
+
+Each size is run in a fresh database named like the testing databases, which
+is dropped afterwards. The results are JSON of the form::
+
+    dict(
+        meta=dict(sizes=[1000, ..], ops=1000, tokens=2, ..),
+        results={
+            "1000": {
+                "get": dict(
+                    count=<calls timed>,
+                    ops_per_sec=<calls per second>,
+                    p50_ms=<median call latency>,
+                    p95_ms=<95th percentile call latency>,
+                    p99_ms=<99th percentile call latency>,
+                ),
+                :
+                etc
+            },
+            :
+            etc
+            "large_documents": {
+                # Read, change and write back the whole user:
+                "update_replace": dict(
+                    <as above>,
+                    round_trips_per_op=<MongoDB round trips per call>,
+                    bytes_sent_per_op=<bytes sent to MongoDB per call>,
+                    bytes_received_per_op=<bytes received per call>,
+                ),
+                # user.update() sending only the changed fields:
+                "update_set": dict(..),
+            },
+        }
+    )
+
+"""
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+from timeit import default_timer
+
+from pymongo import ReturnDocument
+
+from pp.auth import pwtools
+from pp.user.model import db
+from pp.user.model import user
+from pp.user.model import changes
+from pp.user.model import accounting
+from pp.user.model.benchmark.generate import username_for
+from pp.user.model.benchmark.generate import synthetic_users
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+def percentile(ordered, fraction):
+    """Return the nearest-rank percentile of the sorted latencies."""
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1)
+    return ordered[max(0, index)]
+
+
+def summary(latencies, elapsed, **extra):
+    """Return the ops/sec and latency percentiles of the timed calls.
+
+    :param latencies: A list of each call's seconds.
+
+    :param elapsed: The total seconds all the calls took.
+
+    :param extra: Other figures to add to the summary.
+
+    """
+    ordered = sorted(latencies)
+    rc = dict(
+        count=len(latencies),
+        ops_per_sec=len(latencies) / elapsed if elapsed else 0.0,
+        p50_ms=percentile(ordered, 0.50) * 1000,
+        p95_ms=percentile(ordered, 0.95) * 1000,
+        p99_ms=percentile(ordered, 0.99) * 1000,
+    )
+    rc.update(extra)
+    return rc
+
+
+def measure(func, calls):
+    """Time func called with each of the given arguments.
+
+    :param func: The callable to time.
+
+    :param calls: A list of (args, kwargs) to call func with.
+
+    :returns: See summary().
+
+    """
+    latencies = []
+    started = default_timer()
+    for args, kwargs in calls:
+        before = default_timer()
+        func(*args, **kwargs)
+        latencies.append(default_timer() - before)
+    elapsed = default_timer() - started
+
+    return summary(latencies, elapsed)
+
+
+def measure_writes(func, calls):
+    """Time func as measure() does and account for its MongoDB traffic.
+
+    :returns: See summary(), with the round trips and bytes per call.
+
+    """
+    with accounting.track() as usage:
+        rc = measure(func, calls)
+
+    count = max(1, rc['count'])
+    rc.update(
+        round_trips_per_op=usage.round_trips / float(count),
+        bytes_sent_per_op=usage.bytes_sent / float(count),
+        bytes_received_per_op=usage.bytes_received / float(count),
+    )
+    return rc
+
+
+def replace_update(username, **fields):
+    """Update a user as user.update() did before partial updates.
+
+    The whole user is read, changed and written back. This is kept to
+    compare the partial update against. The change is logged as any
+    update is, so only the writes differ.
+
+    """
+    current = user.get(username, primary=True)
+    current.update(fields)
+    current[user.VERSION_FIELD] = current.get(user.VERSION_FIELD, 0) + 1
+    updated = db.db().conn().find_one_and_replace(
+        {'_id': current['_id']}, current,
+        return_document=ReturnDocument.AFTER,
+    )
+    changes.record(changes.UPDATE, [updated])
+    return updated
+
+
+def run_large(ops, tokens, extra_bytes, seed, password_hash):
+    """Compare whole document and partial updates of large users.
+
+    :returns: A dict of 'update_replace' and 'update_set' summaries, see
+    measure_writes().
+
+    """
+    log = get_log("run_large")
+    mongo = db.db()
+    mongo.hard_reset()
+
+    log.info("populating '{}' users of '{}' extra bytes.".format(
+        ops, extra_bytes
+    ))
+    user.load(synthetic_users(
+        ops, tokens=tokens, extra_bytes=extra_bytes, seed=seed,
+        password_hash=password_hash,
+    ))
+    calls = [((username_for(index),), {}) for index in range(ops)]
+
+    return dict(
+        update_replace=measure_writes(
+            lambda name: replace_update(name, display_name="Replaced"),
+            calls,
+        ),
+        update_set=measure_writes(
+            lambda name: user.update(username=name, display_name="Set"),
+            calls,
+        ),
+    )
+
+
+def run_size(
+    size, ops, tokens, extra_bytes, seed, load_batch, password_hash,
+):
+    """Populate a collection of the given size and time each operation.
+
+    :returns: A dict of operation name to summary().
+
+    """
+    log = get_log("run_size")
+    mongo = db.db()
+    mongo.hard_reset()
+
+    def users(count, start=0):
+        return synthetic_users(
+            count, start=start, tokens=tokens, extra_bytes=extra_bytes,
+            seed=seed, password_hash=password_hash,
+        )
+
+    log.info("populating '{}' users.".format(size))
+    started = default_timer()
+    user.load(users(size), batch_size=load_batch)
+    elapsed = default_timer() - started
+    results = dict(populate=summary(
+        [elapsed], elapsed, users_per_sec=size / elapsed,
+    ))
+
+    # The same users are picked on every run:
+    rng = random.Random(seed)
+    picked = [rng.randrange(size) for i in range(ops)]
+    names = [username_for(index) for index in picked]
+    access_tokens = [
+        rng.choice(list(next(users(1, start=index))['tokens']))
+        for index in picked
+    ] if tokens else []
+
+    def by_name(**kwargs):
+        return [((name,), dict(kwargs)) for name in names]
+
+    log.info("timing operations at '{}' users.".format(size))
+    results['has'] = measure(user.has, by_name())
+    results['get'] = measure(user.get, by_name())
+    results['find'] = measure(
+        user.find, [((), dict(username=name)) for name in names]
+    )
+    results['count'] = measure(user.count, [((), {})] * ops)
+    if access_tokens:
+        results['secret_for_access_token'] = measure(
+            user.secret_for_access_token,
+            [((token,), {}) for token in access_tokens],
+        )
+    results['update'] = measure(
+        lambda name: user.update(username=name, display_name="Updated"),
+        by_name(),
+    )
+
+    added = list(users(ops, start=size))
+    results['add'] = measure(
+        lambda data: user.add(**data), [((data,), {}) for data in added]
+    )
+    results['remove'] = measure(
+        user.remove, [((data['username'],), {}) for data in added]
+    )
+
+    batches = max(1, ops // load_batch)
+    results['load'] = measure(
+        user.load,
+        [
+            ((list(users(load_batch, start=(i * load_batch) % size)),), {})
+            for i in range(batches)
+        ],
+    )
+    results['load']['users_per_sec'] = (
+        results['load']['ops_per_sec'] * load_batch
+    )
+
+    started = default_timer()
+    dumped = sum(1 for userdict in user.iter_dump())
+    elapsed = default_timer() - started
+    results['dump'] = summary(
+        [elapsed], elapsed, users_per_sec=dumped / elapsed,
+    )
+
+    return results
+
+
+def run(
+    sizes=(1000, 100000, 1000000), ops=1000, tokens=2, extra_bytes=256,
+    seed=1, load_batch=1000, host="localhost", port=27017,
+    large_extra_bytes=65536,
+):
+    """Run the benchmarks at each collection size.
+
+    The updates of users with large_extra_bytes of extra are then compared
+    and reported as results['large_documents'], 0 skips this.
+
+    The DB instance and access secret cache in use are restored after.
+
+    :returns: The results dict described in this module's docs.
+
+    """
+    log = get_log("run")
+
+    dbname = "benchmarkdb-{}".format(uuid.uuid4().hex)
+    mongo = db.DB(dict(dbname=dbname, host=host, port=port))
+    log.info('database ready for benchmarking "{}"'.format(dbname))
+
+    password_hash = pwtools.hash_password('password')
+
+    rc = dict(
+        meta=dict(
+            sizes=list(sizes),
+            ops=ops,
+            tokens=tokens,
+            extra_bytes=extra_bytes,
+            seed=seed,
+            load_batch=load_batch,
+            large_extra_bytes=large_extra_bytes,
+            started=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        ),
+        results={},
+    )
+    previous_db = db.use(mongo)
+    previous_cache = user.secret_cache, user.secret_negative_ttl
+    try:
+        # Time the database rather than the in-process cache:
+        user.configure_secret_cache(max_size=0)
+
+        for size in sizes:
+            rc['results'][str(size)] = run_size(
+                size, ops, tokens, extra_bytes, seed, load_batch,
+                password_hash,
+            )
+
+        if large_extra_bytes:
+            rc['results']['large_documents'] = run_large(
+                ops, tokens, large_extra_bytes, seed, password_hash,
+            )
+
+    finally:
+        mongo.hard_reset()
+        log.warn('benchmark database dropped "{}"'.format(dbname))
+        db.use(previous_db)
+        user.secret_cache, user.secret_negative_ttl = previous_cache
+
+    return rc
+
+
+def main(argv=None):
+    """user-model-benchmark main script as set up in the 'setup.py'."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark pp.user.model.user against a local mongod."
+    )
+    parser.add_argument(
+        '--sizes', default="1000,100000,1000000",
+        help='Comma separated collection sizes to run at (%(default)s).'
+    )
+    parser.add_argument(
+        '--ops', type=int, default=1000,
+        help='The calls timed per operation (%(default)s).'
+    )
+    parser.add_argument(
+        '--tokens', type=int, default=2,
+        help='The access tokens each user has (%(default)s).'
+    )
+    parser.add_argument(
+        '--extra-bytes', type=int, default=256,
+        help="The approximate size of each user's extra (%(default)s)."
+    )
+    parser.add_argument(
+        '--large-extra-bytes', type=int, default=65536,
+        help="The extra of the users the whole document and partial "
+        "updates are compared with, 0 to skip (%(default)s)."
+    )
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--load-batch', type=int, default=1000)
+    parser.add_argument('--host', default="localhost")
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument(
+        '--output', default="-",
+        help='The file to write the JSON results to, - for stdout.'
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s',
+    )
+
+    results = run(
+        sizes=[int(size) for size in args.sizes.split(",")],
+        ops=args.ops,
+        tokens=args.tokens,
+        extra_bytes=args.extra_bytes,
+        seed=args.seed,
+        load_batch=args.load_batch,
+        host=args.host,
+        port=args.port,
+        large_extra_bytes=args.large_extra_bytes,
+    )
+
+    rendered = json.dumps(results, indent=4, sort_keys=True)
+    if args.output == "-":
+        sys.stdout.write(rendered + "\n")
+    else:
+        with open(args.output, "w") as fd:
+            fd.write(rendered)
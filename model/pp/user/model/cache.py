@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+A bounded in-process LRU cache whose entries expire after a time to live.
+
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+class LRUCache(object):
+    """A thread safe LRU cache with a per entry time to live.
+
+    Once max_size entries are held, adding another evicts the least
+    recently used. An entry older than its TTL is treated as missing.
+
+    An entry can be set in a group, e.g. the user owning it, so every entry
+    of the group is removed by discard_group() without walking the cache.
+
+    """
+    def __init__(self, max_size=10000, ttl=60, clock=time.time):
+        """
+        :param max_size: The most entries held. 0 disables the cache.
+
+        :param ttl: The default seconds an entry lives for.
+
+        :param clock: A callable returning the time in seconds.
+
+        """
+        self.log = get_log("LRUCache")
+        self.max_size = int(max_size)
+        self.ttl = float(ttl)
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # group -> set of the keys set in it:
+        self._groups = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _ungroup(self, key, entry):
+        """Forget the removed entry from its group, the lock is held."""
+        group = entry[2]
+        if group is None:
+            return
+        keys = self._groups.get(group)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._groups[group]
+
+    def get(self, key, default=None):
+        """Recover the cached value for the key.
+
+        :returns: The value or the default if missing or expired.
+
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < self.clock():
+                if entry is not None:
+                    self._ungroup(key, entry)
+                self.misses += 1
+                return default
+
+            # Put it back as the most recently used:
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None, group=None):
+        """Store the value for the key.
+
+        :param ttl: The seconds this entry lives for or the default TTL.
+
+        :param group: The group the entry is removed with by
+        discard_group(), None for no group.
+
+        """
+        if self.max_size < 1:
+            return
+
+        expires = self.clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._discard(key)
+            while len(self._entries) >= self.max_size:
+                evicted, entry = self._entries.popitem(last=False)
+                self._ungroup(evicted, entry)
+                self.evictions += 1
+            self._entries[key] = (expires, value, group)
+            if group is not None:
+                self._groups.setdefault(group, set()).add(key)
+
+    def _discard(self, key):
+        """Remove the key's entry if present, the lock is held."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._ungroup(key, entry)
+
+    def discard(self, *keys):
+        """Remove the entries for the given keys if present."""
+        with self._lock:
+            for key in keys:
+                self._discard(key)
+
+    def discard_group(self, *groups):
+        """Remove every entry set in the given groups.
+
+        This costs the number of entries in the groups, not the cache size.
+
+        """
+        with self._lock:
+            for group in groups:
+                for key in self._groups.pop(group, ()):
+                    self._entries.pop(key, None)
+
+    def discard_if(self, predicate):
+        """Remove every entry whose value the predicate returns True for.
+
+        This walks the whole cache, prefer discard() or discard_group().
+
+        """
+        with self._lock:
+            stale = [
+                key for key, entry in self._entries.items()
+                if predicate(entry[1])
+            ]
+            for key in stale:
+                self._discard(key)
+
+    def clear(self):
+        """Remove all entries leaving the counters as they are."""
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+
+    def stats(self):
+        """Return the cache counters.
+
+        :returns: A dict of the form::
+
+            dict(
+                size=<entries held>,
+                max_size=<most entries held>,
+                hits=<count>,
+                misses=<count>,
+                evictions=<count>,
+            )
+
+        """
+        return dict(
+            size=len(self._entries),
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+        )
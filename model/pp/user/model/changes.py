@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+The ordered log of changes made to users, for downstream services to sync
+from incrementally rather than dumping every user.
+
+Every add, update, remove and load through pp.user.model.user appends a
+change with the next sequence number to a capped collection::
+
+    dict(
+        seq=<sequence number, 1 upwards>,
+        op="add" | "update" | "remove" | "load",
+        user_id=<the user's '_id'>,
+        username=<the user's username>,
+        version=<the user's version, None for a remove>,
+        at=<time.time() of the change>,
+        # The user as it is now, None for a remove i.e. a tombstone:
+        user=<user dict>,
+    )
+
+Only the ids are logged so a write of a large user isn't written twice.
+The user is recovered when the change is read, so it may be a later
+version than the change made. A consumer applying the changes in order
+still ends up with the current user.
+
+A consumer remembers the seq of the last change it applied and asks for
+the changes since it::
+
+    found = changes.since(last_seq)
+    for change in found['changes']:
+        :
+    last_seq = found['last_seq']
+
+The oldest changes are dropped once the capped collection is full. A
+consumer which has fallen that far behind is told to 'reset' i.e. reload
+every user, then carry on from the seq it got with changes.latest() before
+reloading.
+
+A change is appended after the user is written, so delivery is at most
+once: if the process dies in between, the write is made but its change is
+never seen. A consumer which can't miss a change must reset every so often
+to catch these. A writer which is merely slow, appending after readers have
+skipped its seqs (see GAP_GRACE), appends its changes again with new seqs,
+so these are seen, possibly twice.
+
+"""
+import time
+import logging
+from timeit import default_timer
+
+from pymongo import ReturnDocument
+
+from pp.user.model import db
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+ADD = "add"
+UPDATE = "update"
+REMOVE = "remove"
+LOAD = "load"
+
+# A writer takes its sequence numbers before appending its changes, so a
+# later seq can be seen before an earlier one. Changes stop at such a gap
+# until it is this many seconds old, when the writer is assumed to have
+# failed and the gap is skipped. A writer taking over half of this appends
+# its changes again, see record():
+GAP_GRACE = 5.0
+
+# The seconds wait() sleeps between looking for changes:
+POLL_INTERVAL = 0.25
+
+
+def next_seqs(count):
+    """Reserve the next count sequence numbers.
+
+    :returns: A list of the sequence numbers in order.
+
+    """
+    counters = db.db().collection(db.COUNTERS)
+    returned = counters.find_one_and_update(
+        {'_id': db.CHANGES},
+        {'$inc': {'seq': count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    last = returned['seq']
+    return range(last - count + 1, last + 1)
+
+
+def latest():
+    """Return the sequence number of the latest change, 0 if none."""
+    counters = db.db().collection(db.COUNTERS)
+    returned = counters.find_one({'_id': db.CHANGES})
+    return returned['seq'] if returned else 0
+
+
+def record(op, users):
+    """Append a change for each of the users written.
+
+    :param op: One of ADD, UPDATE, REMOVE or LOAD.
+
+    :param users: A list of the user dicts as written, or as they were
+    before a REMOVE.
+
+    If appending took long enough for readers to have skipped the seqs as
+    a failed writer's, the changes are appended again with the next seqs.
+    Half the GAP_GRACE is allowed for the readers' own delays.
+
+    :returns: The list of sequence numbers the changes were last given.
+
+    """
+    log = get_log("record")
+    if not users:
+        return []
+
+    # Any later seq was taken, and its change timed, after this:
+    started = time.time()
+    seqs = next_seqs(len(users))
+    now = time.time()
+    entries = [
+        dict(
+            _id=seq,
+            op=op,
+            user_id=userdict['_id'],
+            username=userdict['username'],
+            version=None if op == REMOVE else userdict.get('_version'),
+            at=now,
+        )
+        for seq, userdict in zip(seqs, users)
+    ]
+    db.db().changes_conn().insert_many(entries, ordered=False)
+
+    if time.time() - started >= GAP_GRACE / 2:
+        log.warn(
+            "changes '{}' to '{}' were slow, appending them again.".format(
+                seqs[0], seqs[-1]
+            )
+        )
+        seqs = record(op, users)
+
+    return seqs
+
+
+def since(seq, limit=100):
+    """Recover the changes made after the given sequence number.
+
+    :param seq: The seq of the last change the caller has, 0 for all.
+
+    :param limit: The most changes returned.
+
+    :returns: A dict of the form::
+
+        dict(
+            changes=[<change>, ..],
+            # Ask for the changes since this next time:
+            last_seq=<seq of the last change returned or the given seq>,
+            # True if changes after seq have been dropped from the log:
+            reset=<True or False>,
+        )
+
+    """
+    log = get_log("since")
+    conn = db.db().changes_conn()
+
+    found = list(
+        conn.find({'_id': {'$gt': seq}}).sort('_id', 1).limit(limit)
+    )
+
+    now = time.time()
+    if found and found[0]['_id'] != seq + 1:
+        # A recent oldest change may be after one still being written:
+        oldest = conn.find_one({}, sort=[('_id', 1)])
+        if (
+            oldest and oldest['_id'] > seq + 1 and
+            now - oldest['at'] >= GAP_GRACE
+        ):
+            log.warn("changes after '{}' are no longer held.".format(seq))
+            return dict(changes=[], last_seq=seq, reset=True)
+
+    changes = []
+    expected = seq + 1
+    for change in found:
+        if change['_id'] != expected and now - change['at'] < GAP_GRACE:
+            # An earlier change is still being written:
+            break
+        expected = change['_id'] + 1
+        change['seq'] = change.pop('_id')
+        changes.append(change)
+
+    # The users changed are recovered in one query:
+    wanted = list(set(
+        change['user_id'] for change in changes if change['op'] != REMOVE
+    ))
+    users = {}
+    if wanted:
+        users = dict(
+            (userdict['_id'], userdict)
+            for userdict in db.db().conn().find({'_id': {'$in': wanted}})
+        )
+    for change in changes:
+        change['user'] = users.get(change['user_id'])
+        if change['op'] == REMOVE:
+            change['user'] = None
+
+    return dict(
+        changes=changes,
+        last_seq=changes[-1]['seq'] if changes else seq,
+        reset=False,
+    )
+
+
+def wait(seq, limit=100, timeout=30.0):
+    """Wait for changes after the given sequence number.
+
+    :param timeout: The most seconds to wait for a change.
+
+    :returns: See since(), changes is empty if none were made in time.
+
+    """
+    deadline = default_timer() + timeout
+    while True:
+        found = since(seq, limit)
+        if found['changes'] or found['reset']:
+            return found
+
+        if default_timer() + POLL_INTERVAL > deadline:
+            return found
+
+        time.sleep(POLL_INTERVAL)
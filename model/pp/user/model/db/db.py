@@ -1,26 +1,92 @@
 # -*- coding: utf-8 -*-
 """
 """
+import os
 import uuid
 import logging
+import threading
 
-from pymongo import Connection
+from pymongo import MongoClient
+from pymongo import ReadPreference
+from pymongo import WriteConcern
+from pymongo.errors import CollectionInvalid
+
+from pp.user.model import accounting
 
 
 __all__ = [
-    "DB", "init", "db", "load", "dump", "doc_id_for", "split_docid"
+    "DB", "init", "use", "db", "load", "dump", "iter_dump", "doc_id_for",
+    "split_docid",
+    "INDEXES", "CHANGES", "COUNTERS",
+]
+
+
+# The (key, options) of each index the user collection must have. These are
+# ensured the first time the collection is used through DB.conn().
+#
+INDEXES = [
+    # Usernames are unique, adding or renaming to one in use fails with a
+    # DuplicateKeyError:
+    ("username", {"unique": True}),
+    # The access tokens each user owns, denormalised from their 'tokens'
+    # dict so an access token lookup is a single indexed query:
+    ("_access_tokens", {}),
 ]
 
 
+# The capped collection of user changes, see pp.user.model.changes:
+CHANGES = "changes"
+
+# The collection of sequence counters e.g. of the changes:
+COUNTERS = "counters"
+
+
+# The read preferences a DB can be configured with, by name:
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primarypreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondarypreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+
 class DB(object):
     """An lightwrapper around a mongodb connection.
 
     The init is given the configuration dict::
 
         dict(
-            db_name='<name>',  # test-db is default.
+            dbname='<name>',  # test-db is default.
             port=<mongodb tcp port>,  # 27012 by default.
             host=<mongodb host address>,  # localhost by default.
+
+            # Optional, a mongodb:// URI e.g. of a replica set to use
+            # instead of the host and port:
+            uri='mongodb://host1,host2/?replicaSet=rs0',
+
+            # Optional connection pool and timeout settings:
+            max_pool_size=<connections>,  # 100 by default.
+            min_pool_size=<connections>,  # 0 by default.
+            connect_timeout_ms=<ms>,  # 20000 by default.
+            socket_timeout_ms=<ms>,  # No timeout by default.
+            server_selection_timeout_ms=<ms>,  # 30000 by default.
+
+            # Optional, where conn(read=True) reads from e.g. nearest,
+            # secondaryPreferred. Writes always go to the primary:
+            read_preference='primary',
+
+            # Optional, the default write concern:
+            w=<number or 'majority'>,  # 1 by default.
+            j=<yes or no>,  # no by default.
+            wtimeout_ms=<ms>,  # No timeout by default.
+
+            # Optional, pymongo.monitoring listeners e.g. to time commands:
+            event_listeners=[<CommandListener instance>, ..],
+
+            # Optional, the bytes the capped change log is created with.
+            # The oldest changes are dropped once it is full:
+            changes_size=<bytes>,  # 64MB by default.
         )
 
     Create this class and then call instances db property to
@@ -36,21 +102,174 @@ class DB(object):
         self.dbname = config.get("dbname", "test-db").strip()
         self.port = int(config.get("port", 27017))
         self.host = config.get("host", "localhost").strip()
+        self.uri = (config.get("uri") or "").strip()
+        self.read_preference = READ_PREFERENCES[
+            config.get("read_preference", "primary").strip().lower()
+        ]
+        self.changes_size = int(config.get("changes_size", 64 * 1024 * 1024))
+        self._connection = None
+        self._collection = None
+        self._read_collection = None
+        self._indexed = False
+        self._changes_ready = False
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def client_options(self):
+        """Return the MongoClient keyword arguments from the config.
+
+        Only the settings present in the config are returned so the driver
+        defaults apply otherwise.
+
+        """
+        options = {}
+        integer_options = [
+            ("max_pool_size", "maxPoolSize"),
+            ("min_pool_size", "minPoolSize"),
+            ("connect_timeout_ms", "connectTimeoutMS"),
+            ("socket_timeout_ms", "socketTimeoutMS"),
+            ("server_selection_timeout_ms", "serverSelectionTimeoutMS"),
+            ("wtimeout_ms", "wtimeout"),
+        ]
+        for key, option in integer_options:
+            if str(self.config.get(key, "")).strip():
+                options[option] = int(self.config[key])
+
+        w = str(self.config.get("w", "")).strip()
+        if w:
+            options["w"] = int(w) if w.isdigit() else w
+
+        j = str(self.config.get("j", "")).strip().lower()
+        if j:
+            options["j"] = j in ("yes", "true", "1")
+
+        if self.config.get("event_listeners"):
+            options["event_listeners"] = list(self.config["event_listeners"])
+
+        return options
+
+    def _forked(self):
+        """Forget the parent process's connection after a fork.
+
+        The client's sockets and monitor threads can't be shared with the
+        parent, so the child creates its own on next use. The parent's
+        client is left alone as the parent is still using it.
+
+        """
+        self.log.info("process forked, a new connection will be made.")
+        self._lock = threading.Lock()
         self._connection = None
+        self._collection = None
+        self._read_collection = None
+        self._pid = os.getpid()
 
     def mongo_conn(self):
-        """Returns a mongodb connection not tied to a database."""
-        if not self._connection:
-            self._connection = Connection(self.host, self.port)
+        """Returns a mongodb connection not tied to a database.
+
+        The connection is made once per process however many threads ask
+        for it at the same time.
+
+        """
+        if self._pid != os.getpid():
+            self._forked()
+
+        if self._connection is None:
+            with self._lock:
+                if self._connection is None:
+                    options = self.client_options()
+                    # Round trips are accounted for, see accounting.track():
+                    options['event_listeners'] = options.get(
+                        'event_listeners', []
+                    ) + [accounting.listener]
+                    if self.uri:
+                        self._connection = MongoClient(self.uri, **options)
+                    else:
+                        self._connection = MongoClient(
+                            self.host, self.port, **options
+                        )
+
         return self._connection
 
-    def conn(self):
+    def conn(self, read=False, write_concern=None):
         """Return the db connection.
 
-        :returns: A mongodb Connection instance for the configured db name.
+        Writes use the write concern configured by w, j and wtimeout_ms.
+
+        :param read: True to get a collection for reading which uses the
+        configured read preference e.g. to read from secondaries.
+
+        :param write_concern: A dict of WriteConcern arguments replacing
+        those configured for the returned collection's writes e.g.
+        dict(w='majority') where durability matters.
+
+        :returns: A mongodb Collection instance for the configured db name.
+
+        """
+        client = self.mongo_conn()
+
+        if self._collection is None:
+            with self._lock:
+                if self._collection is None:
+                    collection = client[self.dbname]['everyone']
+                    self._read_collection = collection.with_options(
+                        read_preference=self.read_preference
+                    )
+                    self._collection = collection
+
+        if not self._indexed:
+            self.ensure_indexes(self._collection)
+
+        collection = self._read_collection if read else self._collection
+        if write_concern:
+            options = dict(collection.write_concern.document)
+            options.update(write_concern)
+            collection = collection.with_options(
+                write_concern=WriteConcern(**options)
+            )
+
+        return collection
+
+    def collection(self, name):
+        """Return another collection of the configured database.
+
+        :param name: The collection name e.g. COUNTERS.
+
+        """
+        return self.mongo_conn()[self.dbname][name]
+
+    def changes_conn(self):
+        """Return the capped collection of user changes.
+
+        It is created with the configured changes_size the first time it is
+        used. A collection already present is used as it is.
+
+        """
+        database = self.mongo_conn()[self.dbname]
+
+        if not self._changes_ready:
+            with self._lock:
+                if not self._changes_ready:
+                    try:
+                        database.create_collection(
+                            CHANGES, capped=True, size=self.changes_size
+                        )
+                    except CollectionInvalid:
+                        # It is present, created by us or another process:
+                        pass
+                    self._changes_ready = True
+
+        return database[CHANGES]
+
+    def ensure_indexes(self, collection):
+        """Make sure the collection has all the INDEXES it needs.
+
+        :param collection: The mongodb collection to index.
 
         """
-        return self.mongo_conn()[self.dbname]['everyone']
+        for key, options in INDEXES:
+            self.log.debug("ensure_indexes: <{}> {}".format(key, options))
+            collection.create_index(key, **options)
+        self._indexed = True
 
     def hard_reset(self):
         """Remove the database from mongo clearing out all contents.
@@ -59,6 +278,9 @@ class DB(object):
 
         """
         self.mongo_conn().drop_database(self.dbname)
+        # The indexes went with the database, recreate them on next use:
+        self._indexed = False
+        self._changes_ready = False
 
 
 # The
@@ -118,14 +340,29 @@ def dump():
     return dump()
 
 
-def load(data):
+def iter_dump(after=None, before=None, batch_size=1000):
+    """Stream an entire database one user at a time.
+
+    :returns: A generator of user dicts.
+
+    See pp.user.model.user.iter_dump() for the arguments.
+
+    """
+    from pp.user.model.user import iter_dump
+    return iter_dump(after=after, before=before, batch_size=batch_size)
+
+
+def load(data, batch_size=1000):
     """Load the users into the user service.
 
-    :param data: See the return from a call to dump().
+    :param data: See the return from a call to dump(). Any iterable of user
+    dicts can be given e.g. the generator iter_dump() returns.
+
+    :returns: See pp.user.model.user.load().
 
     """
     from pp.user.model.user import load
-    return load(data)
+    return load(data, batch_size=batch_size)
 
 
 def init(config={}):
@@ -140,6 +377,26 @@ def init(config={}):
     __db = DB(config)
 
 
+def use(instance):
+    """Make the given DB instance the one a call to db() returns.
+
+    This restores the instance in use before an init(), e.g.::
+
+        previous = db.use(db.DB(config))
+        try:
+            :
+        finally:
+            db.use(previous)
+
+    :returns: The DB instance used before or None.
+
+    """
+    global __db
+    previous = __db
+    __db = instance
+    return previous
+
+
 def db():
     """Recover the current configured DB instance.
 
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Backfill the access token index of the users stored before it existed, see
+pp.user.model.user.index_tokens().
+
+This is run once against the database when upgrading, before the upgraded
+service is started::
+
+    user-model-index-tokens --config production.ini
+
+"""
+import sys
+import logging
+import argparse
+import ConfigParser
+
+from pp.user.model import db
+from pp.user.model import user
+
+
+def db_config(args):
+    """Return the DB() config from the command line arguments.
+
+    The mongodb.* settings of the service's ini file are used if one is
+    given, otherwise the --dbname, --host and --port.
+
+    """
+    if not args.config:
+        return dict(dbname=args.dbname, host=args.host, port=args.port)
+
+    cp = ConfigParser.ConfigParser()
+    if not cp.read(args.config):
+        raise ValueError("The config <{!r}> can't be read.".format(
+            args.config
+        ))
+
+    # All the mongodb.* settings are passed on as the service does:
+    cfg = dict(
+        (key[len("mongodb."):], value)
+        for key, value in cp.items(args.section, raw=True)
+        if key.startswith("mongodb.")
+    )
+    cfg.setdefault('dbname', "ppusertestdb")
+    cfg.setdefault('host', "127.0.0.1")
+
+    return cfg
+
+
+def main(argv=None):
+    """user-model-index-tokens main script as set up in the 'setup.py'."""
+    parser = argparse.ArgumentParser(
+        description="Backfill the access token index of every user."
+    )
+    parser.add_argument(
+        '--config',
+        help="The service's ini file to read the mongodb.* settings from."
+    )
+    parser.add_argument(
+        '--section', default="app:main",
+        help='The ini file section of the settings (%(default)s).'
+    )
+    parser.add_argument('--dbname', default="userservice")
+    parser.add_argument('--host', default="localhost")
+    parser.add_argument('--port', type=int, default=27017)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s',
+    )
+
+    db.init(db_config(args))
+    updated = user.index_tokens()
+    sys.stdout.write("{} users indexed.\n".format(updated))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Password hashing and verification done in a bounded pool of processes.
+
+The pwtools hashing is deliberately CPU expensive. Doing it in worker
+processes keeps it off the threads serving cheap requests and uses every
+core. No more than max_pending passwords are queued at a time, beyond that
+ServiceBusyError is raised straight away rather than waiting.
+
+Many passwords are worked on a batch_size() chunk at a time, so single
+passwords such as logins still have room while a batch is hashed. Only the
+first chunk is refused when busy, the later ones wait for room.
+
+"""
+import os
+import time
+import logging
+import threading
+import multiprocessing
+
+from pp.auth import pwtools
+from pp.user.validate import tracing
+from pp.user.validate.error import ServiceBusyError
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+# See configure() for these:
+__config = dict(processes=None, max_pending=64, timeout=30)
+__pool = None
+__pool_pid = None
+__lock = threading.Lock()
+# Notified as pending passwords finish:
+__room = threading.Condition(__lock)
+__counts = dict(pending=0, completed=0, rejected=0)
+
+
+def _validate(args):
+    """Worker side of validate_many(), given a (plain_pw, hash) pair."""
+    plain_pw, password_hash = args
+    return pwtools.validate_password(plain_pw, password_hash)
+
+
+def _guarded(args):
+    """Worker side of _run(), given a (func, item) pair.
+
+    The error is returned rather than raised so the pool always reports
+    the chunk finished and its pending places are released.
+
+    :returns: (True, result) or (False, exception).
+
+    """
+    func, item = args
+    try:
+        return True, func(item)
+
+    except Exception as e:
+        return False, e
+
+
+def configure(processes=None, max_pending=64, timeout=30):
+    """Set up the worker pool, replacing any existing one.
+
+    :param processes: The number of worker processes. None for one per CPU
+    or 0 to hash in the calling thread without a pool.
+
+    :param max_pending: The most passwords queued or being worked on.
+
+    :param timeout: The seconds to wait for a result before giving up.
+
+    """
+    global __pool
+    with __lock:
+        if __pool and __pool_pid == os.getpid():
+            __pool.terminate()
+        __pool = None
+        # The terminated work will never report finishing:
+        __counts['pending'] = 0
+        __room.notify_all()
+        __config.update(
+            processes=processes, max_pending=max_pending, timeout=timeout,
+        )
+
+
+def pool():
+    """Recover the worker pool, creating it on first use.
+
+    :returns: A multiprocessing.Pool or None if configured with 0 processes.
+
+    """
+    global __pool
+    global __pool_pid
+    if __config['processes'] == 0:
+        return None
+
+    with __lock:
+        # A pool inherited over a fork has no threads to feed its workers:
+        if not __pool or __pool_pid != os.getpid():
+            get_log("pool").info("starting password worker pool.")
+            # The parent's pending work isn't this process's:
+            __counts['pending'] = 0
+            __pool = multiprocessing.Pool(__config['processes'])
+            __pool_pid = os.getpid()
+    return __pool
+
+
+def batch_size():
+    """Return the most passwords of a batch worked on at a time.
+
+    This is half of max_pending, leaving room for single passwords.
+
+    """
+    return max(1, __config['max_pending'] // 2)
+
+
+def _reserve(count, wait):
+    """Take count of the max_pending places.
+
+    :param wait: True to wait up to the timeout for room rather than
+    raising ServiceBusyError straight away.
+
+    """
+    deadline = time.time() + __config['timeout']
+    with __lock:
+        while __counts['pending'] + count > __config['max_pending']:
+            remaining = deadline - time.time()
+            if not wait or remaining <= 0:
+                __counts['rejected'] += count
+                raise ServiceBusyError(
+                    "Password pool busy with '{}' pending.".format(
+                        __counts['pending']
+                    )
+                )
+            __room.wait(remaining)
+        __counts['pending'] += count
+
+
+def _release(count):
+    """Give back count places once their passwords are worked on."""
+    with __lock:
+        __counts['pending'] = max(0, __counts['pending'] - count)
+        __counts['completed'] += count
+        __room.notify_all()
+
+
+def _run_chunk(workers, func, chunk):
+    """Run func over a chunk of items whose places are reserved.
+
+    The places are given back when the work finishes, even if the wait for
+    it times out.
+
+    :param workers: The pool() to run in, None to run in this thread.
+
+    :returns: A list of the results in the same order as the items.
+
+    """
+    if not workers:
+        try:
+            return [func(item) for item in chunk]
+
+        finally:
+            _release(len(chunk))
+
+    try:
+        result = workers.map_async(
+            _guarded,
+            [(func, item) for item in chunk],
+            callback=lambda found: _release(len(chunk)),
+        )
+
+    except Exception:
+        _release(len(chunk))
+        raise
+
+    try:
+        found = result.get(__config['timeout'])
+
+    except multiprocessing.TimeoutError:
+        raise ServiceBusyError("Password pool result timed out.")
+
+    for ok, value in found:
+        if not ok:
+            raise value
+
+    return [value for ok, value in found]
+
+
+def _iter_run(func, items, name):
+    """Run func over the items in the pool a batch_size() chunk at a time.
+
+    Each chunk has its own timeout. The first is refused if the pool is
+    busy, the rest wait for room.
+
+    :param name: The name of the span each chunk is traced in.
+
+    :returns: A generator of the list of results of each chunk, in the
+    same order as the items.
+
+    """
+    if not items:
+        return
+
+    # Before reserving, as a new pool starts with nothing pending:
+    workers = pool()
+    size = batch_size()
+    for start in range(0, len(items), size):
+        chunk = items[start:start + size]
+        with tracing.start_span(name, passwords=len(chunk)):
+            _reserve(len(chunk), wait=start > 0)
+            yield _run_chunk(workers, func, chunk)
+
+
+def _run(func, items, name):
+    """Run func over the items in the pool within the pending limit.
+
+    :param name: The name of the span the work is traced in.
+
+    :returns: A list of the results in the same order as the items.
+
+    """
+    results = []
+    for found in _iter_run(func, items, name):
+        results.extend(found)
+    return results
+
+
+def hash_password(plain_pw):
+    """Hash the password in the worker pool.
+
+    :returns: See pwtools.hash_password().
+
+    """
+    return _run(pwtools.hash_password, [plain_pw], "pwpool.hash")[0]
+
+
+def hash_many(passwords):
+    """Hash many passwords at once across the worker pool.
+
+    :returns: A list of the hashes in the same order as the passwords.
+
+    """
+    return _run(pwtools.hash_password, passwords, "pwpool.hash")
+
+
+def iter_hash_many(passwords):
+    """Hash many passwords across the worker pool a chunk at a time.
+
+    :returns: A generator of the list of hashes of each batch_size()
+    chunk, in the same order as the passwords. ServiceBusyError is raised
+    from the chunk the pool couldn't hash in time.
+
+    """
+    return _iter_run(pwtools.hash_password, passwords, "pwpool.hash")
+
+
+def validate_password(plain_pw, password_hash):
+    """Validate the password against its hash in the worker pool.
+
+    :returns: True if the password validates otherwise False.
+
+    """
+    return validate_many([(plain_pw, password_hash)])[0]
+
+
+def validate_many(pairs):
+    """Validate many passwords against their hashes in the worker pool.
+
+    :param pairs: A list of (plain_pw, password_hash) tuples.
+
+    :returns: A list of True or False in the same order as the pairs.
+
+    """
+    return _run(_validate, pairs, "pwpool.validate")
+
+
+def stats():
+    """Return the pool utilisation.
+
+    :returns: A dict of the form::
+
+        dict(
+            processes=<worker processes, 0 is no pool>,
+            max_pending=<most passwords queued>,
+            pending=<passwords queued or in progress>,
+            completed=<count>,
+            rejected=<count turned away as busy>,
+            utilisation=<0.0 idle to 1.0 all workers in use>,
+        )
+
+    """
+    processes = __config['processes']
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    pending = __counts['pending']
+    utilisation = min(pending, processes) / float(processes or 1)
+
+    return dict(
+        processes=processes,
+        max_pending=__config['max_pending'],
+        pending=pending,
+        completed=__counts['completed'],
+        rejected=__counts['rejected'],
+        utilisation=utilisation,
+    )
@@ -40,6 +40,7 @@ def mongodb(request):
     """Set up a mongo connection reset and ready to roll.
     """
     from pp.user.model import db as mongo
+    from pp.user.model import user
 
     log = get_log('mongodb')
 
@@ -48,6 +49,8 @@ def mongodb(request):
     mongo.init(dict(db_name=db_name))
     db = mongo.db()
     db.hard_reset()
+    # A new cache so each test starts with the default settings and counters:
+    user.configure_secret_cache()
     log.info('database ready for testing "{}"'.format(db_name))
 
     def db_teardown(x=None):
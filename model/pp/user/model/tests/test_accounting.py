@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Test the round trip accounting and the model's round trip budgets.
+
+"""
+import pytest
+
+from pp.user.model import user
+from pp.user.model import accounting
+
+
+def test_shapes():
+    """Test the literals are removed from query shapes.
+    """
+    assert accounting.shape({"username": "bob", "n": {"$gt": 3}}) == {
+        "username": "?", "n": {"$gt": "?"}
+    }
+    assert accounting.shape({"username": {"$in": ["a", "b", "c"]}}) == {
+        "username": {"$in": ["?"]}
+    }
+
+    assert accounting.command_shape(
+        "find", {"find": "everyone", "filter": {"username": "bob"}}
+    ) == 'find everyone {"username": "?"}'
+    assert accounting.command_shape(
+        "update", {"update": "everyone", "updates": [{"q": {"_id": "x"}}]}
+    ) == 'update everyone {"_id": "?"}'
+    assert accounting.command_shape(
+        "insert", {"insert": "everyone", "documents": [{}]}
+    ) == 'insert everyone'
+    assert accounting.command_shape(
+        "getMore", {"getMore": 123456789, "collection": "everyone"}
+    ) == 'getMore everyone'
+
+
+def test_track(logger, mongodb):
+    """Test the round trips, documents and bytes are accounted for.
+    """
+    user.add(username='bob', password='11amcoke', email='bob@example.net')
+
+    with accounting.track() as usage:
+        with accounting.track() as inner:
+            assert user.get('bob')['username'] == 'bob'
+        assert user.has('fred') is False
+
+    assert inner.round_trips == 1
+    assert usage.round_trips == 2
+    assert usage.docs_returned == 1
+    assert usage.bytes_sent > 0
+    assert usage.bytes_received > 0
+    assert usage.shapes() == [
+        'find everyone {"username": "?"}',
+        'find everyone {"username": "?"}',
+    ]
+    assert usage.summary()['commands'][0]['duration_ms'] >= 0
+
+    # Nothing is recorded outside of a track():
+    user.get('bob')
+    assert usage.round_trips == 2
+
+    with accounting.track(measure_bytes=False) as usage:
+        user.remove('bob')
+    assert usage.bytes_sent == 0
+    # The remove, its change sequence number and its change log entry:
+    assert usage.docs_written == 1
+    assert usage.shapes() == [
+        'findAndModify everyone {"username": "?"}',
+        'findAndModify counters {"_id": "?"}',
+        'insert changes',
+    ]
+
+
+def test_max_round_trips(logger, mongodb):
+    """Test the budget helper fails when it is exceeded.
+    """
+    user.add(username='bob', password='11amcoke', email='bob@example.net')
+
+    with accounting.max_round_trips(2):
+        user.get('bob')
+        user.get('bob')
+
+    with pytest.raises(AssertionError) as info:
+        with accounting.max_round_trips(1):
+            user.get('bob')
+            user.has('bob')
+    assert 'find everyone {"username": "?"}' in str(info.value)
+
+
+def test_model_round_trip_budgets(logger, mongodb):
+    """Test the user model calls stay within their round trip budgets.
+    """
+    token = "3c2e8a9ad6184a0c8ce0bdd6a3c39f6a"
+    user.add(username='fred', password='11amcoke', email='fred@example.net')
+
+    # Each write also takes a sequence number and appends to the change log,
+    # see pp.user.model.changes:
+    with accounting.max_round_trips(3):
+        user.add(
+            username='bob',
+            password='11amcoke',
+            email='bob@example.net',
+            tokens={token: {"access_secret": "secret"}},
+        )
+
+    with accounting.max_round_trips(1):
+        user.has('bob')
+
+    with accounting.max_round_trips(1):
+        user.get('bob')
+
+    with accounting.max_round_trips(1):
+        user.get_many(['bob', 'fred', 'unknown'])
+
+    with accounting.max_round_trips(1):
+        user.page(limit=10)
+
+    with accounting.max_round_trips(1):
+        user.find(email='bob@example.net')
+
+    # Only the changed fields are sent, the result comes back with them:
+    with accounting.max_round_trips(3):
+        user.update(username='bob', display_name='Bob')
+
+    with accounting.max_round_trips(3):
+        user.update(username='bob', remove=['display_name'])
+
+    user.secret_cache.clear()
+    with accounting.max_round_trips(1):
+        assert user.secret_for_access_token(token) == "secret"
+
+    # Cached now so no round trip is needed:
+    with accounting.max_round_trips(0):
+        assert user.secret_for_access_token(token) == "secret"
+
+    with accounting.max_round_trips(1):
+        assert user.validate_password('bob', '11amcoke') is True
+
+    with accounting.max_round_trips(1):
+        user.validate_passwords([
+            ('bob', '11amcoke'), ('fred', 'wrong'), ('unknown', 'x'),
+        ])
+
+    with accounting.max_round_trips(3):
+        user.remove('bob')
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Test the model benchmark suite runs and is reproducible.
+
+"""
+from pp.user.model import db
+from pp.user.model import user
+from pp.user.model.benchmark import runner
+from pp.user.model.benchmark.generate import synthetic_users
+
+
+def test_synthetic_users_are_reproducible():
+    """Test the same users are generated for the same seed.
+    """
+    first = list(synthetic_users(3, start=5, tokens=3, password_hash='x'))
+    again = list(synthetic_users(3, start=5, tokens=3, password_hash='x'))
+    assert first == again
+
+    assert [u['username'] for u in first] == [
+        'user00000005', 'user00000006', 'user00000007'
+    ]
+    assert len(first[0]['tokens']) == 3
+
+    other = list(synthetic_users(3, start=5, seed=2, password_hash='x'))
+    assert other[0]['tokens'] != first[0]['tokens']
+
+
+def test_percentile():
+    """Test the nearest-rank percentiles.
+    """
+    ordered = range(1, 101)
+    assert runner.percentile(ordered, 0.50) == 50
+    assert runner.percentile(ordered, 0.99) == 99
+    assert runner.percentile([7], 0.95) == 7
+    assert runner.percentile([], 0.95) == 0.0
+
+
+def test_small_run(logger, mongodb):
+    """Test a run at small sizes reports every operation.
+    """
+    secret_cache = user.secret_cache
+    results = runner.run(
+        sizes=[20, 40], ops=10, load_batch=5, large_extra_bytes=8192,
+    )
+
+    # The tests which follow keep their database and secret cache:
+    assert db.db() is mongodb
+    assert user.secret_cache is secret_cache
+
+    assert results['meta']['sizes'] == [20, 40]
+    for size in ["20", "40"]:
+        found = results['results'][size]
+        for operation in [
+            'populate', 'has', 'get', 'find', 'count',
+            'secret_for_access_token', 'update', 'add', 'remove', 'load',
+            'dump',
+        ]:
+            assert found[operation]['count'] > 0
+            for figure in ['ops_per_sec', 'p50_ms', 'p95_ms', 'p99_ms']:
+                assert found[operation][figure] >= 0
+
+    # Partial updates of large users send far less than the whole user:
+    large = results['results']['large_documents']
+    assert large['update_replace']['round_trips_per_op'] == (
+        large['update_set']['round_trips_per_op'] + 1
+    )
+    assert (
+        large['update_set']['bytes_sent_per_op'] * 4 <
+        large['update_replace']['bytes_sent_per_op']
+    )
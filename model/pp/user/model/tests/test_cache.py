@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Test the in-process LRU cache.
+
+"""
+from pp.user.model import cache
+
+
+class Clock(object):
+    """A clock the tests move forward by hand."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction_and_counters():
+    """Test the least recently used entry is evicted when full.
+    """
+    lru = cache.LRUCache(max_size=2, ttl=60)
+
+    lru.set('a', 1)
+    lru.set('b', 2)
+    # 'a' is now the most recently used:
+    assert lru.get('a') == 1
+
+    lru.set('c', 3)
+    assert lru.get('b') is None
+    assert lru.get('a') == 1
+    assert lru.get('c') == 3
+
+    assert lru.stats() == dict(
+        size=2, max_size=2, hits=3, misses=1, evictions=1,
+    )
+
+
+def test_ttl_expiry():
+    """Test entries expire after their own or the default TTL.
+    """
+    clock = Clock()
+    lru = cache.LRUCache(max_size=10, ttl=60, clock=clock)
+
+    lru.set('found', 'secret')
+    lru.set('unknown', None, ttl=5)
+
+    clock.now += 6
+    assert lru.get('found') == 'secret'
+    assert lru.get('unknown', 'missing') == 'missing'
+
+    clock.now += 60
+    assert lru.get('found') is None
+
+
+def test_discard():
+    """Test removing entries by key and by value.
+    """
+    lru = cache.LRUCache(max_size=10, ttl=60)
+    lru.set('t1', ('user-1', 's1'))
+    lru.set('t2', ('user-1', 's2'))
+    lru.set('t3', ('user-2', 's3'))
+
+    lru.discard('t3', 'not-present')
+    assert lru.get('t3') is None
+
+    lru.discard_if(lambda entry: entry[0] == 'user-1')
+    assert len(lru) == 0
+
+    # A max_size of 0 disables caching:
+    lru = cache.LRUCache(max_size=0)
+    lru.set('a', 1)
+    assert lru.get('a') is None
+
+
+def test_discard_group():
+    """Test the entries of a group are removed and groups kept tidy.
+    """
+    lru = cache.LRUCache(max_size=3, ttl=60)
+    lru.set('t1', ('user-1', 's1'), group='user-1')
+    lru.set('t2', ('user-1', 's2'), group='user-1')
+    lru.set('t3', ('user-2', 's3'), group='user-2')
+    lru.set('u1', (None, None))
+
+    # Evicting 't1' also takes it out of its group:
+    assert lru.get('t1') is None
+    assert lru._groups == {'user-1': set(['t2']), 'user-2': set(['t3'])}
+
+    lru.discard_group('user-1', 'unknown')
+    assert lru.get('t2') is None
+    assert lru.get('t3') == ('user-2', 's3')
+    assert lru.get('u1') == (None, None)
+
+    lru.discard('t3')
+    assert lru._groups == {}
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Test the change log every user write appends to.
+
+"""
+import time
+
+from pp.user.model import db
+from pp.user.model import user
+from pp.user.model import changes
+
+
+def test_changes_since(logger, mongodb):
+    """Test each write is a change in order, removes as tombstones.
+    """
+    assert changes.latest() == 0
+    assert changes.since(0) == dict(changes=[], last_seq=0, reset=False)
+
+    bob = user.add(username='bob', password='11amcoke', email='bob@a.net')
+    user.update(username='bob', display_name='Bob')
+    user.add(username='fred', password='11amcoke', email='fred@a.net')
+    user.remove('fred')
+
+    found = changes.since(0)
+    assert found['reset'] is False
+    assert found['last_seq'] == changes.latest() == 4
+    assert [
+        (change['seq'], change['op'], change['username'])
+        for change in found['changes']
+    ] == [
+        (1, changes.ADD, 'bob'),
+        (2, changes.UPDATE, 'bob'),
+        (3, changes.ADD, 'fred'),
+        (4, changes.REMOVE, 'fred'),
+    ]
+    assert found['changes'][0]['user_id'] == bob['_id']
+    assert found['changes'][1]['version'] == 2
+
+    # The user is as it is now, the tombstone has none:
+    assert found['changes'][0]['user']['display_name'] == 'Bob'
+    assert found['changes'][2]['user'] is None
+    assert found['changes'][3]['user'] is None
+
+    # A consumer resumes from the last seq it has:
+    found = changes.since(2, limit=1)
+    assert [change['seq'] for change in found['changes']] == [3]
+    assert found['last_seq'] == 3
+    assert changes.since(4)['changes'] == []
+
+    report = user.load([dict(user.get('bob'), display_name='Loaded')])
+    assert report['loaded'] == 1
+    found = changes.since(4)
+    assert [change['op'] for change in found['changes']] == [changes.LOAD]
+
+
+def test_changes_gaps(logger, mongodb):
+    """Test changes stop at a recent gap and reset once dropped.
+    """
+    user.add(username='bob', password='11amcoke', email='bob@a.net')
+
+    # A writer has taken seq 2 but not yet appended its change:
+    assert changes.next_seqs(1) == [2]
+    user.update(username='bob', display_name='Bob')
+
+    found = changes.since(0)
+    assert [change['seq'] for change in found['changes']] == [1]
+    assert changes.since(1)['changes'] == []
+
+    # A gap older than the grace is taken to be a failed writer:
+    conn = db.db().changes_conn()
+    conn.update_one({'_id': 3}, {'$set': {'at': time.time() - 60}})
+    found = changes.since(1)
+    assert [change['seq'] for change in found['changes']] == [3]
+
+    # Once the changes after a seq are dropped the consumer must reset:
+    conn.drop()
+    mongodb._changes_ready = False
+    changes.record(changes.UPDATE, [user.get('bob')])
+    conn.update_one({'_id': 4}, {'$set': {'at': time.time() - 60}})
+    assert changes.since(1) == dict(changes=[], last_seq=1, reset=True)
+    assert changes.since(3)['changes'][0]['seq'] == 4
+
+
+def test_changes_slow_record(logger, mongodb, monkeypatch):
+    """Test a change appended after readers skipped its gap is appended
+    again so it is still seen.
+    """
+    monkeypatch.setattr(changes, 'GAP_GRACE', 0.5)
+    user.add(username='bob', password='11amcoke', email='bob@a.net')
+
+    skipped = []
+    next_seqs = changes.next_seqs
+
+    def slow_next_seqs(count):
+        seqs = next_seqs(count)
+        if not skipped:
+            skipped.append(seqs)
+            # A later change is appended and read past the gap meanwhile:
+            changes.record(changes.UPDATE, [user.get('bob')])
+            time.sleep(changes.GAP_GRACE + 0.1)
+            found = changes.since(1)
+            skipped.extend(change['seq'] for change in found['changes'])
+        return seqs
+
+    monkeypatch.setattr(changes, 'next_seqs', slow_next_seqs)
+    seqs = changes.record(changes.UPDATE, [user.get('bob')])
+
+    # Seq 2 was skipped, so the change was appended again as seq 4:
+    assert skipped == [[2], 3]
+    assert seqs == [4]
+    found = changes.since(3)
+    assert [
+        (change['seq'], change['op'], change['username'])
+        for change in found['changes']
+    ] == [(4, changes.UPDATE, 'bob')]
+
+
+def test_changes_wait(logger, mongodb):
+    """Test waiting for changes returns once there are some or times out.
+    """
+    started = time.time()
+    assert changes.wait(0, timeout=0.5)['changes'] == []
+    assert time.time() - started >= 0.25
+
+    user.add(username='bob', password='11amcoke', email='bob@a.net')
+    found = changes.wait(0, timeout=10)
+    assert [change['op'] for change in found['changes']] == [changes.ADD]
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Test the DB connection configuration.
+
+"""
+import os
+import threading
+
+import pytest
+from pymongo import ReadPreference
+
+from pp.user.model import db
+
+
+def test_client_options():
+    """Test the MongoClient options recovered from the config.
+    """
+    # Nothing is set so the driver defaults are used:
+    assert db.DB({}).client_options() == {}
+
+    config = dict(
+        dbname="userservice",
+        max_pool_size="50",
+        min_pool_size="5",
+        connect_timeout_ms="2000",
+        socket_timeout_ms="",
+        server_selection_timeout_ms="3000",
+        w="majority",
+        j="yes",
+        wtimeout_ms="5000",
+        read_preference="secondaryPreferred",
+    )
+    mongo = db.DB(config)
+    assert mongo.client_options() == dict(
+        maxPoolSize=50,
+        minPoolSize=5,
+        connectTimeoutMS=2000,
+        serverSelectionTimeoutMS=3000,
+        w="majority",
+        j=True,
+        wtimeout=5000,
+    )
+    assert mongo.read_preference == ReadPreference.SECONDARY_PREFERRED
+
+    assert db.DB(dict(w="2")).client_options() == dict(w=2)
+
+    listener = object()
+    assert db.DB(dict(event_listeners=[listener])).client_options() == dict(
+        event_listeners=[listener]
+    )
+
+    with pytest.raises(KeyError):
+        db.DB(dict(read_preference="anywhere"))
+
+
+def test_read_and_write_collections(logger, mongodb):
+    """Test reads use the read preference and writes the primary.
+    """
+    mongo = db.DB(dict(
+        dbname=mongodb.dbname, read_preference="nearest", w=1, j="yes",
+    ))
+
+    assert mongo.conn().read_preference == ReadPreference.PRIMARY
+    assert mongo.conn(read=True).read_preference == ReadPreference.NEAREST
+
+    # The model's writes use the configured write concern:
+    assert mongo.conn().write_concern.document == dict(w=1, j=True)
+
+    # Which can be changed for the writes where durability matters:
+    collection = mongo.conn(write_concern=dict(w='majority'))
+    assert collection.write_concern.document == dict(w='majority', j=True)
+    assert mongo.conn().write_concern.document == dict(w=1, j=True)
+
+
+def test_one_connection_per_process(logger, mongodb):
+    """Test threads share a connection and a forked child makes its own.
+    """
+    mongo = db.DB(dict(dbname=mongodb.dbname))
+
+    clients = []
+    workers = [
+        threading.Thread(target=lambda: clients.append(mongo.mongo_conn()))
+        for i in range(10)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert len(set(id(client) for client in clients)) == 1
+    parent_client = clients[0]
+
+    pid = os.fork()
+    if pid == 0:
+        # The child must not reuse the parent's client:
+        try:
+            ok = mongo.mongo_conn() is not parent_client
+            ok = ok and mongo.conn().count_documents({}) == 0
+        except Exception:
+            ok = False
+        os._exit(0 if ok else 1)
+
+    child_pid, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+
+    # The parent carries on with its own client:
+    assert mongo.mongo_conn() is parent_client
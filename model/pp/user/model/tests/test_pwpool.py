@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Test the password worker pool.
+
+"""
+import time
+import threading
+
+import pytest
+
+from pp.auth import pwtools
+from pp.user.model import pwpool
+from pp.user.validate.error import ServiceBusyError
+
+
+@pytest.fixture(scope='function')
+def inline_pool(request):
+    """Hash in the calling thread and restore the default pool afterwards.
+    """
+    pwpool.configure(processes=0, max_pending=1)
+    request.addfinalizer(pwpool.configure)
+    return pwpool
+
+
+def test_hash_and_validate(logger):
+    """Test hashing and validating passwords in the worker processes.
+    """
+    password_hash = pwpool.hash_password('11amcoke')
+    assert pwtools.validate_password('11amcoke', password_hash) is True
+
+    assert pwpool.validate_password('11amcoke', password_hash) is True
+    assert pwpool.validate_many([
+        ('11amcoke', password_hash),
+        ('wrong', password_hash),
+    ]) == [True, False]
+    assert pwpool.validate_many([]) == []
+
+    hashes = pwpool.hash_many(['11amcoke', '12amcoke'])
+    assert pwtools.validate_password('11amcoke', hashes[0]) is True
+    assert pwtools.validate_password('12amcoke', hashes[1]) is True
+    assert pwpool.hash_many([]) == []
+
+    assert pwpool.stats()['pending'] == 0
+
+
+def test_busy_pool_is_refused(logger, inline_pool, monkeypatch):
+    """Test passwords beyond max_pending are refused rather than queued.
+    """
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_hash(plain_pw):
+        started.set()
+        release.wait()
+        return "hashed"
+
+    monkeypatch.setattr(pwtools, "hash_password", slow_hash)
+
+    results = []
+    worker = threading.Thread(
+        target=lambda: results.append(pwpool.hash_password('first'))
+    )
+    worker.start()
+    started.wait()
+
+    assert pwpool.stats()['pending'] == 1
+    with pytest.raises(ServiceBusyError):
+        pwpool.hash_password('second')
+
+    release.set()
+    worker.join()
+    assert results == ["hashed"]
+
+    stats = pwpool.stats()
+    assert stats['pending'] == 0
+    assert stats['rejected'] == 1
+
+    # Once free it accepts work again:
+    assert pwpool.hash_password('third') == "hashed"
+
+
+def test_batches_leave_room(logger, request, monkeypatch):
+    """Test a batch is worked on in chunks leaving room for single ones.
+    """
+    pwpool.configure(processes=0, max_pending=4)
+    request.addfinalizer(pwpool.configure)
+    seen = []
+
+    def recording_hash(plain_pw):
+        seen.append(pwpool.stats()['pending'])
+        return "hashed"
+
+    monkeypatch.setattr(pwtools, "hash_password", recording_hash)
+
+    assert pwpool.batch_size() == 2
+    assert pwpool.hash_many(['a', 'b', 'c', 'd', 'e']) == ["hashed"] * 5
+    assert max(seen) == 2
+    assert pwpool.stats()['pending'] == 0
+
+
+def test_timed_out_work_stays_pending(logger, request):
+    """Test the places of work which timed out are held until it finishes.
+    """
+    pwpool.configure(processes=1, max_pending=4, timeout=0.001)
+    request.addfinalizer(pwpool.configure)
+    completed = pwpool.stats()['completed']
+
+    with pytest.raises(ServiceBusyError):
+        pwpool.hash_many(['11amcoke', '12amcoke'])
+
+    for i in range(100):
+        if pwpool.stats()['pending'] == 0:
+            break
+        time.sleep(0.1)
+
+    stats = pwpool.stats()
+    assert stats['pending'] == 0
+    assert stats['completed'] == completed + 2
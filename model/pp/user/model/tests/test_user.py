@@ -54,6 +54,90 @@ def test_user_recovery_for_access_token(logger, mongodb):
     assert user.secret_for_access_token('fake-token') is None
 
 
+def test_access_secret_cache(logger, mongodb):
+    """Test the access secret cache is used and invalidated by writes.
+    """
+    access_token = "0b6d3c8e5f1a4d2b9e7c6a5f4d3c2b1a"
+    access_secret = "1f2e3d4c5b6a79880f1e2d3c4b5a6978"
+
+    # The unknown token is cached as such until bob is added with it:
+    assert user.secret_for_access_token(access_token) is None
+    assert user.secret_for_access_token(access_token) is None
+    stats = user.secret_cache.stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 1
+
+    user.add(
+        username='bob',
+        password='11amcoke',
+        email='bob@example.net',
+        tokens={access_token: {"access_secret": access_secret}},
+    )
+    assert user.secret_for_access_token(access_token) == access_secret
+    assert user.secret_for_access_token(access_token) == access_secret
+    assert user.secret_cache.stats()['hits'] == 2
+
+    # Changing the secret is seen straight away:
+    user.update(
+        username='bob',
+        tokens={access_token: {"access_secret": "changed"}},
+    )
+    assert user.secret_for_access_token(access_token) == "changed"
+
+    # As is removing the user:
+    user.remove('bob')
+    assert user.secret_for_access_token(access_token) is None
+
+
+def test_access_token_index(logger, mongodb):
+    """Test the access token index is maintained and used for lookups.
+    """
+    access_token = "3c2e8a9ad6184a0c8ce0bdd6a3c39f6a"
+    access_secret = "bd87df3e20e246a7a0bb1c6d1e7ce6c0"
+
+    bob = user.add(
+        username='bob',
+        password='11amcoke',
+        email='bob@example.net',
+        tokens={access_token: {"access_secret": access_secret}},
+    )
+    assert bob[user.TOKEN_INDEX_FIELD] == [access_token]
+    assert user.secret_for_access_token(access_token) == access_secret
+
+    # The lookup must use the index rather than scan the collection:
+    conn = mongodb.conn()
+    plan = str(conn.find({user.TOKEN_INDEX_FIELD: access_token}).explain())
+    assert "IXSCAN" in plan or "BtreeCursor" in plan
+
+    # Replacing the tokens drops the old one from the index:
+    new_token = "a6f5d3b8b4d64e5e9f0f7c3c0c6f2e1d"
+    user.update(
+        username='bob',
+        tokens={new_token: {"access_secret": access_secret}},
+    )
+    assert user.secret_for_access_token(access_token) is None
+    assert user.secret_for_access_token(new_token) == access_secret
+
+    # Once removed the user's tokens are no longer found:
+    user.remove('bob')
+    assert user.secret_for_access_token(new_token) is None
+
+    # Users stored before the index existed are found once backfilled:
+    conn.insert_one({
+        "_id": "user-2719963b00964c01b42b5d81c998fd05",
+        "username": "fred",
+        "email": "fred@example.net",
+        "password_hash": pwtools.hash_password('11amcoke'),
+        "tokens": {access_token: {"access_secret": access_secret}},
+    })
+    assert user.secret_for_access_token(access_token) is None
+    assert user.index_tokens() == 1
+    assert user.secret_for_access_token(access_token) == access_secret
+
+    # Running it again has nothing left to do:
+    assert user.index_tokens() == 0
+
+
 def test_validate_password(logger, mongodb):
 
     assert user.count() == 0
@@ -155,6 +239,165 @@ def test_dump_and_load(logger, mongodb):
     assert item1['phone'] == user_dict['phone']
 
 
+def test_iter_dump(logger, mongodb):
+    """Test streaming the users in '_id' order and in '_id' ranges.
+    """
+    assert list(user.iter_dump()) == []
+
+    for i in range(5):
+        user.add(
+            _id="user-{}".format(i),
+            username="user{}".format(i),
+            password_hash=pwtools.hash_password('11amcoke'),
+            email="user{}@example.net".format(i),
+        )
+
+    dumped = list(user.iter_dump(batch_size=2))
+    assert [u['_id'] for u in dumped] == [
+        "user-0", "user-1", "user-2", "user-3", "user-4",
+    ]
+    assert dumped == user.dump()
+
+    dumped = list(user.iter_dump(after="user-1"))
+    assert [u['_id'] for u in dumped] == ["user-2", "user-3", "user-4"]
+
+    dumped = list(user.iter_dump(after="user-1", before="user-4"))
+    assert [u['_id'] for u in dumped] == ["user-2", "user-3"]
+
+
+def test_bulk_load(logger, mongodb):
+    """Test loading from an iterator in batches and the report returned.
+    """
+    password_hash = pwtools.hash_password('11amcoke')
+
+    def users(count):
+        for i in range(count):
+            yield {
+                "_id": "user-{}".format(i),
+                "username": "user{}".format(i),
+                "email": "user{}@example.net".format(i),
+                "password_hash": password_hash,
+            }
+
+    reports = []
+    report = user.load(users(5), batch_size=2, progress=reports.append)
+    assert report == dict(batches=3, loaded=5, errors=0)
+    assert [r['loaded'] for r in reports] == [2, 4, 5]
+    assert user.count() == 5
+
+    # Loading again replaces the users with the same '_id':
+    changed = list(users(5))
+    changed[0]['email'] = "changed@example.net"
+    report = user.load(changed)
+    assert report == dict(batches=1, loaded=5, errors=0)
+    assert user.count() == 5
+    assert user.get("user0")['email'] == "changed@example.net"
+
+    # A user which takes another's username is reported and not loaded:
+    clash = {
+        "_id": "user-clash",
+        "username": "user1",
+        "email": "clash@example.net",
+        "password_hash": password_hash,
+    }
+    report = user.load([clash, {
+        "_id": "user-new",
+        "username": "new",
+        "email": "new@example.net",
+        "password_hash": password_hash,
+    }])
+    assert report == dict(batches=1, loaded=1, errors=1)
+    assert user.count() == 6
+    assert user.get("user1")['_id'] == "user-1"
+
+    # The cached secrets are dropped even if the load fails part way:
+    user.secret_cache.set("a token", ("user-0", "a secret"))
+
+    def failing():
+        for userdict in users(3):
+            yield userdict
+        raise ValueError("The source failed.")
+
+    with pytest.raises(ValueError):
+        user.load(failing(), batch_size=2)
+    assert user.secret_cache.get("a token") is None
+
+
+def test_page(logger, mongodb):
+    """Test recovering the users a page at a time.
+    """
+    assert user.page(limit=2) == ([], None)
+
+    for i in range(5):
+        user.add(
+            _id="user-{}".format(i),
+            username="user{}".format(i),
+            password_hash=pwtools.hash_password('11amcoke'),
+            email="user{}@example.net".format(i),
+            team="odd" if i % 2 else "even",
+        )
+
+    users, after = user.page(limit=2)
+    assert [u['_id'] for u in users] == ["user-0", "user-1"]
+    assert after == "user-1"
+
+    users, after = user.page(limit=2, after=after)
+    assert [u['_id'] for u in users] == ["user-2", "user-3"]
+
+    users, after = user.page(limit=2, after=after)
+    assert [u['_id'] for u in users] == ["user-4"]
+    assert after is None
+
+    # An exact last page has no following page:
+    users, after = user.page(limit=5)
+    assert len(users) == 5
+    assert after is None
+
+    # Only the asked for fields are returned:
+    users, after = user.page(
+        dict(team="odd"), fields=['username'], limit=10
+    )
+    assert users == [
+        dict(_id="user-1", username="user1"),
+        dict(_id="user-3", username="user3"),
+    ]
+
+    # No limit returns all matching users:
+    users, after = user.page(dict(team="even"))
+    assert [u['_id'] for u in users] == ["user-0", "user-2", "user-4"]
+
+
+def test_get_many_and_validate_passwords(logger, mongodb):
+    """Test recovering and authenticating many users at once.
+    """
+    unicode_name = u'andrés.bolívar'
+    for username in ['bob', 'fred', unicode_name]:
+        user.add(
+            username=username,
+            password='{}-pw'.format(username.encode('utf-8')),
+            email='user@example.net',
+        )
+
+    found = user.get_many(['fred', 'unknown', 'bob', unicode_name, 'fred'])
+    assert [u and u['username'] for u in found] == [
+        'fred', None, 'bob', unicode_name, 'fred'
+    ]
+    assert user.get_many([]) == []
+
+    # Only the fields asked for are recovered:
+    found = user.get_many(['bob', 'unknown'], fields=['email'])
+    assert found[1] is None
+    assert sorted(found[0].keys()) == ['_id', 'email', 'username']
+
+    results = user.validate_passwords([
+        ('bob', 'bob-pw'),
+        ('fred', 'wrong'),
+        ('unknown', 'bob-pw'),
+        (unicode_name.encode('utf-8'), 'andrés.bolívar-pw'),
+    ])
+    assert results == [True, False, None, True]
+
+
 @pytest.mark.xfail
 def test_change_password(logger, mongodb):
     """The the single call to change a users password.
@@ -401,3 +644,290 @@ def testBasicCRUD(logger, mongodb):
 
     with pytest.raises(user.UserRemoveError):
         user.remove(item2['username'])
+
+
+def test_concurrent_add_of_the_same_username(logger, mongodb):
+    """Test only one of many concurrent adds of a username succeeds.
+    """
+    import threading
+
+    results = []
+
+    def add_bob(index):
+        try:
+            user.add(
+                username='bob',
+                password_hash='hash-{}'.format(index),
+                email='bob{}@example.net'.format(index),
+            )
+
+        except user.UserPresentError:
+            results.append('present')
+
+        else:
+            results.append('added')
+
+    workers = [
+        threading.Thread(target=add_bob, args=(i,)) for i in range(20)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert results.count('added') == 1
+    assert results.count('present') == 19
+    assert user.count() == 1
+
+
+def test_rename_to_a_username_in_use(logger, mongodb):
+    """Test a rename cannot take another user's username.
+    """
+    for username in ['bob', 'fred']:
+        user.add(
+            username=username,
+            password='11amcoke',
+            email='{}@example.net'.format(username),
+        )
+
+    with pytest.raises(user.UserPresentError):
+        user.update(username='bob', new_username='fred')
+
+    renamed = user.update(username='bob', new_username='robert')
+    assert renamed['username'] == 'robert'
+    assert user.has('bob') is False
+    assert user.get('robert')['email'] == 'bob@example.net'
+
+    with pytest.raises(user.UserNotFoundError):
+        user.update(username='bob', phone='12121212')
+
+
+def test_user_versions(logger, mongodb):
+    """Test every write gives the user a new version and ETag.
+    """
+    bob = user.add(username='bob', password='11amcoke', email='bob@a.net')
+    assert bob[user.VERSION_FIELD] == 1
+    assert user.get_version('bob') == (bob['_id'], 1)
+
+    # The version can't be set by the caller:
+    updated = user.update(username='bob', display_name='Bob', _version=10)
+    assert updated[user.VERSION_FIELD] == 2
+    assert user.get_version(u'bob') == (bob['_id'], 2)
+    assert user.etag_for(bob['_id'], 2) == "{}.2".format(bob['_id'])
+
+    # Users from before versioning are version 0:
+    assert user.etag_for(bob['_id'], None) == "{}.0".format(bob['_id'])
+
+    # Loaded users get a version no ETag served before the load has:
+    dumped = user.dump()
+    user.load(dumped)
+    _id, version = user.get_version('bob')
+    assert version > 2
+    user.update(username='bob', display_name='Bobby')
+    assert user.get_version('bob') == (_id, version + 1)
+
+    with pytest.raises(user.UserNotFoundError):
+        user.get_version('fred')
+
+
+def test_update_version_conflicts(logger, mongodb, monkeypatch):
+    """Test updates are only written to the version of the user they read.
+    """
+    from pp.user.model import db
+
+    bob = user.add(username='bob', password='11amcoke', email='bob@a.net')
+    assert user.parse_etag('"{}.1"'.format(bob['_id'])) == (bob['_id'], 1)
+    assert user.parse_etag('W/"{}.1"'.format(bob['_id'])) == (bob['_id'], 1)
+    assert user.parse_etag('"nothing"') is None
+
+    with pytest.raises(user.UserVersionConflictError):
+        user.update(expected_version=5, username='bob', display_name='Bob')
+
+    with pytest.raises(user.UserVersionConflictError):
+        user.update(
+            expected_id='user-other', expected_version=1,
+            username='bob', display_name='Bob',
+        )
+
+    updated = user.update(
+        expected_id=bob['_id'], expected_version=1,
+        username='bob', display_name='Bob',
+    )
+    assert updated[user.VERSION_FIELD] == 2
+
+    # Another writer's change is kept by an update of other fields:
+    mongodb.conn().update_one(
+        {'_id': bob['_id']},
+        {'$set': {'email': 'bob@b.net'}, '$inc': {'_version': 1}},
+    )
+    updated = user.update(username='bob', display_name='Bobby')
+    assert updated['display_name'] == 'Bobby'
+    assert updated['email'] == 'bob@b.net'
+    assert updated[user.VERSION_FIELD] == 4
+
+    # It is a conflict to a caller expecting the version before it:
+    with pytest.raises(user.UserVersionConflictError):
+        user.update(expected_version=3, username='bob', display_name='Rob')
+
+    assert user.get('bob')['display_name'] == 'Bobby'
+    assert user.get_version('bob') == (bob['_id'], 4)
+
+    with pytest.raises(user.UserNotFoundError):
+        user.update(expected_version=1, username='fred', display_name='Fred')
+
+
+def test_partial_updates(logger, mongodb):
+    """Test only the given fields and paths are changed by an update.
+    """
+    from pp.user.model import accounting
+
+    old_token = "3c2e8a9ad6184a0c8ce0bdd6a3c39f6a"
+    new_token = "a6f5d3b8b4d64e5e9f0f7c3c0c6f2e1d"
+    user.add(
+        username='bob',
+        password='11amcoke',
+        email='bob@example.net',
+        extra=dict(role="user", notes="x" * 10000),
+        tokens={old_token: {"access_secret": "old"}},
+    )
+
+    # Only the change is sent, not the large document. The user is written
+    # in one round trip, the others take a sequence number and append to
+    # the change log:
+    with accounting.track() as usage:
+        updated = user.update(username='bob', **{'extra.role': 'admin'})
+    assert usage.shapes() == [
+        'findAndModify everyone {"username": "?"}',
+        'findAndModify counters {"_id": "?"}',
+        'insert changes',
+    ]
+    assert usage.bytes_sent < 1000
+    assert updated['extra'] == dict(role="admin", notes="x" * 10000)
+
+    updated = user.update(username='bob', remove=['extra.notes', 'phone'])
+    assert updated['extra'] == dict(role="admin")
+
+    # Single tokens can be added and removed, the index follows them:
+    updated = user.update(
+        username='bob', **{'tokens.' + new_token: {"access_secret": "new"}}
+    )
+    assert updated[user.TOKEN_INDEX_FIELD] == [old_token, new_token]
+    assert user.secret_for_access_token(new_token) == "new"
+
+    updated = user.update(username='bob', remove=['tokens.' + old_token])
+    assert updated[user.TOKEN_INDEX_FIELD] == [new_token]
+    assert user.secret_for_access_token(old_token) is None
+
+    updated = user.update(
+        username='bob',
+        remove=['tokens.' + new_token],
+        **{'tokens.' + old_token: {"access_secret": "again"}}
+    )
+    assert user.get('bob')[user.TOKEN_INDEX_FIELD] == [old_token]
+    assert user.secret_for_access_token(new_token) is None
+    assert user.secret_for_access_token(old_token) == "again"
+
+    # Removing a field of a token leaves the token usable:
+    user.update(username='bob', **{'tokens.' + old_token + '.note': "x"})
+    updated = user.update(
+        username='bob', remove=['tokens.' + old_token + '.note']
+    )
+    assert updated[user.TOKEN_INDEX_FIELD] == [old_token]
+    assert updated['tokens'][old_token] == {"access_secret": "again"}
+    assert user.secret_for_access_token(old_token) == "again"
+
+    for bad in (
+        dict(extra={}, remove=['extra.role']),
+        {'_version': 1, 'remove': ['_id']},
+        {'$set': 1},
+    ):
+        with pytest.raises(ValueError):
+            user.update(username='bob', **bad)
+
+    fields, remove = user.flatten_patch(dict(
+        display_name="Bob",
+        phone=None,
+        extra=dict(role=None, team=dict(name="a")),
+        tokens={},
+    ))
+    assert fields == {'display_name': "Bob", 'extra.team.name': "a"}
+    assert sorted(remove) == ['extra.role', 'phone']
+
+
+def test_add_many(logger, mongodb):
+    """Test adding a batch reports each user without failing the others.
+    """
+    from pp.user.model import changes
+
+    user.add(username='bob', password='11amcoke', email='bob@a.net')
+
+    results = user.add_many([
+        dict(username='fred', password='11amcoke', email='fred@a.net'),
+        dict(username='bob', password='11amcoke', email='bob@b.net'),
+        dict(username='sam', email='sam@a.net'),
+        dict(username='fred', password='11amcoke', email='fred@b.net'),
+        dict(username='tim', password_hash='hash', email='tim@a.net'),
+    ])
+    assert [(r['username'], r['status']) for r in results] == [
+        ('fred', user.ADDED),
+        ('bob', user.CONFLICT),
+        ('sam', user.INVALID),
+        ('fred', user.CONFLICT),
+        ('tim', user.ADDED),
+    ]
+    assert results[0]['_id'] == user.get('fred')['_id']
+    assert results[1]['_id'] is None
+    assert results[2]['message']
+
+    fred = user.get('fred')
+    assert 'password' not in fred
+    assert user.validate_password('fred', '11amcoke') is True
+    assert fred[user.VERSION_FIELD] == 1
+    assert user.get('bob')['email'] == 'bob@a.net'
+    assert user.count() == 3
+
+    # Only the users added are changes:
+    assert [
+        change['username'] for change in changes.since(1)['changes']
+    ] == ['fred', 'tim']
+
+    assert user.add_many([]) == []
+
+
+def test_add_many_busy(logger, mongodb, monkeypatch):
+    """Test the users not hashed when the pool is busy are FAILED.
+    """
+    from pp.user.model import pwpool
+    from pp.user.validate.error import ServiceBusyError
+
+    def busy_after_one(passwords):
+        yield [pwpool.pwtools.hash_password(passwords[0])]
+        raise ServiceBusyError("Password pool result timed out.")
+
+    monkeypatch.setattr(pwpool, "iter_hash_many", busy_after_one)
+
+    results = user.add_many([
+        dict(username='fred', password='11amcoke', email='fred@a.net'),
+        dict(username='bob', password='11amcoke', email='bob@a.net'),
+        dict(username='tim', password_hash='hash', email='tim@a.net'),
+    ])
+    assert [(r['username'], r['status']) for r in results] == [
+        ('fred', user.ADDED),
+        ('bob', user.FAILED),
+        ('tim', user.ADDED),
+    ]
+    assert results[1]['_id'] is None
+    assert user.validate_password('fred', '11amcoke') is True
+    assert user.has('bob') is False
+
+    # Nothing is added if no password could be hashed:
+    def busy(passwords):
+        raise ServiceBusyError("Password pool busy.")
+        yield
+
+    monkeypatch.setattr(pwpool, "iter_hash_many", busy)
+    with pytest.raises(ServiceBusyError):
+        user.add_many([
+            dict(username='sam', password='11amcoke', email='sam@a.net'),
+        ])
+    assert user.has('sam') is False
@@ -4,15 +4,57 @@ The mongodb implementation of the methods that the sql user implementation
 provides.
 
 """
+import time
 import logging
-import pprint
 
-from pp.auth import pwtools
+from pymongo import ReplaceOne
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+from pymongo.errors import OperationFailure
+from pymongo.errors import DuplicateKeyError
+
 from pp.user.model import db
+from pp.user.model import cache
+from pp.user.model import changes
+from pp.user.model import pwpool
+from pp.user.validate.error import ServiceBusyError
 from pp.user.validate.userdata import UserAddError
+from pp.user.validate.userdata import UserServiceError
 from pp.user.validate.userdata import UserRemoveError
 from pp.user.validate.userdata import UserNotFoundError
 from pp.user.validate.userdata import UserPresentError
+from pp.user.validate.userdata import UserVersionConflictError
+from pp.user.validate.userdata import creation_required_fields
+
+
+# The indexed list of access tokens a user owns. This is maintained from the
+# user's 'tokens' dict by add(), update() and load():
+TOKEN_INDEX_FIELD = "_access_tokens"
+
+# The version of each user, changed by every write through this module. The
+# ETag of a user is made from its '_id' and version, see etag_for():
+VERSION_FIELD = "_version"
+
+# The status of each user given to add_many():
+ADDED = "added"
+CONFLICT = "conflict"
+INVALID = "invalid"
+FAILED = "failed"
+
+# The mongodb error codes for a unique index violation:
+DUPLICATE_KEY_CODES = (11000, 11001)
+
+# The write concern of the bulk writes of add_many() and load(). These are
+# only reported done once a majority of the replica set has them, so a
+# failover can't roll back part of a batch:
+BULK_WRITE_CONCERN = dict(w='majority')
+
+# Caches access_token -> (user _id, access_secret) in front of
+# secret_for_access_token(). Unknown tokens are cached as (None, None) for
+# secret_negative_ttl seconds. Writes through this module invalidate it, other
+# processes see changes once the TTL expires. See configure_secret_cache().
+secret_cache = cache.LRUCache(max_size=10000, ttl=60)
+secret_negative_ttl = 5
 
 
 def get_log(extra=None):
@@ -20,6 +62,92 @@ def get_log(extra=None):
     return logging.getLogger(m)
 
 
+def token_index(user):
+    """Return the access tokens the given user dict owns.
+
+    :param user: A user dict which may have a 'tokens' field.
+
+    :returns: A sorted list of access token strings or an empty list.
+
+    """
+    return sorted((user.get('tokens') or {}).keys())
+
+
+def configure_secret_cache(max_size=10000, ttl=60, negative_ttl=5):
+    """Replace the access secret cache with one of the given settings.
+
+    :param max_size: The most access tokens cached. 0 disables caching.
+
+    :param ttl: The seconds a found secret is cached for.
+
+    :param negative_ttl: The seconds an unknown access token is cached for.
+
+    """
+    global secret_cache
+    global secret_negative_ttl
+    secret_cache = cache.LRUCache(max_size=max_size, ttl=ttl)
+    secret_negative_ttl = negative_ttl
+
+
+def forget_secrets(userdict):
+    """Drop the cached access secrets of the given user.
+
+    This removes the secrets the user owned as well as any "unknown token"
+    entries for the tokens the user now has. The secrets are found by the
+    user's '_id' they were cached in the group of, so only the user's own
+    entries are visited.
+
+    """
+    secret_cache.discard(*token_index(userdict))
+    secret_cache.discard_group(userdict.get('_id'))
+
+
+def etag_for(_id, version):
+    """Return the entity tag of the given version of a user.
+
+    Users stored before versioning have no version and are treated as 0.
+
+    """
+    return "{}.{}".format(_id, version or 0)
+
+
+def parse_etag(etag):
+    """Recover the (_id, version) an ETag from etag_for() was made from.
+
+    :returns: The (_id, version) tuple or None if it isn't a user ETag.
+
+    """
+    etag = etag.strip()
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    _id, _, version = etag.strip('"').rpartition(".")
+    if not _id or not version.isdigit():
+        return None
+
+    return _id, int(version)
+
+
+def get_version(username):
+    """Recover just the '_id' and version of a user.
+
+    If the username is not found the UserNotFoundError will be raised.
+
+    :returns: A (_id, version) tuple.
+
+    """
+    if isinstance(username, unicode):
+        username = username.encode('utf-8')
+
+    conn = db.db().conn(read=True)
+    returned = conn.find_one(
+        dict(username=username), projection={VERSION_FIELD: True}
+    )
+    if not returned:
+        raise UserNotFoundError("Unknown username <{!r}>".format(username))
+
+    return returned['_id'], returned.get(VERSION_FIELD, 0)
+
+
 def has(username):
     """Check if the given user name is on the system.
 
@@ -30,7 +158,7 @@ def has(username):
     log = get_log("has")
 
     log.debug("looking for <{!r}>".format(username))
-    conn = db.db().conn()
+    conn = db.db().conn(read=True)
 
     if conn.find_one(dict(username=username)):
         log.debug("has: found <{!r}>".format(username))
@@ -39,11 +167,14 @@ def has(username):
     return returned
 
 
-def get(username):
+def get(username, primary=False):
     """Recover the detail of a user on the system.
 
     :param username: The unique user name to look for.
 
+    :param primary: True to read from the primary rather than as the read
+    preference allows, e.g. to read a user before changing it.
+
     If the username is not found the UserNotFoundError will be raised.
 
     :returns: The user dict.
@@ -55,7 +186,7 @@ def get(username):
         username = username.encode('utf-8')
 
     # log.debug("looking for <{!r}>".format(username))
-    conn = db.db().conn()
+    conn = db.db().conn(read=not primary)
 
     returned = conn.find_one(dict(username=username))
     if not returned:
@@ -65,6 +196,42 @@ def get(username):
     return returned
 
 
+def get_many(usernames, fields=None):
+    """Recover the details of many users in one query.
+
+    :param usernames: A list of user names to look for.
+
+    :param fields: A list of the field names to return. The '_id' and
+    'username' are always returned. None returns all fields.
+
+    :returns: A list of user dicts in the same order as the usernames. None
+    is in place of any username not found.
+
+    """
+    log = get_log("get_many")
+
+    def as_unicode(username):
+        if isinstance(username, str):
+            username = username.decode('utf-8')
+        return username
+
+    usernames = [as_unicode(username) for username in usernames]
+    log.debug("looking for <{}> users".format(len(usernames)))
+    conn = db.db().conn(read=True)
+
+    if fields is not None:
+        fields = list(set(fields) | set(['username']))
+
+    found = dict(
+        (as_unicode(userdict['username']), userdict)
+        for userdict in conn.find(
+            {'username': {'$in': list(set(usernames))}}, projection=fields
+        )
+    )
+
+    return [found.get(username) for username in usernames]
+
+
 def find(**kwargs):
     """Find one or many users.
 
@@ -74,13 +241,57 @@ def find(**kwargs):
     log = get_log("find")
 
     log.debug("looking users with criteria <{!r}>".format(kwargs))
-    conn = db.db().conn()
+    conn = db.db().conn(read=True)
 
     returned = list(conn.find(kwargs))
 
     return returned
 
 
+def page(criteria=None, limit=None, after=None, fields=None):
+    """Recover a page of users in '_id' order.
+
+    Pages are found by an '_id' range rather than skipping so each one
+    costs the same however far through the users it is.
+
+    :param criteria: A dict of field values the users must have.
+
+    :param limit: The most users to return or None for all of them.
+
+    :param after: Only users with an '_id' greater than this are returned.
+    Give the '_id' returned for the previous page to get the next one.
+
+    :param fields: A list of the field names to return. The '_id' is
+    always returned. None returns all fields.
+
+    :returns: (users, after) the list of user dicts and the '_id' to ask for
+    the following page with. The after is None if there are no more users.
+
+    """
+    log = get_log("page")
+
+    spec = dict(criteria or {})
+    if after:
+        spec['_id'] = {'$gt': after}
+
+    log.debug("page of {} users with criteria <{!r}>".format(limit, spec))
+    conn = db.db().conn(read=True)
+
+    cursor = conn.find(spec, projection=fields).sort('_id', 1)
+    if limit:
+        # The extra user tells whether there is a following page:
+        cursor = cursor.limit(limit + 1)
+
+    users = list(cursor)
+
+    next_after = None
+    if limit and len(users) > limit:
+        users = users[:limit]
+        next_after = users[-1]['_id']
+
+    return users, next_after
+
+
 def remove(username):
     """Remove a user from the system.
 
@@ -93,12 +304,14 @@ def remove(username):
     log.debug("Attempting to remove user <{!r}>".format(username))
     conn = db.db().conn()
 
-    if not conn.find_one(u):
+    found = conn.find_one_and_delete(u)
+    if not found:
         raise UserRemoveError(
             "The user '{!r}' is not present to remove.".format(username)
         )
 
-    conn.remove(u)
+    forget_secrets(found)
+    changes.record(changes.REMOVE, [found])
     log.debug("'{!r}' removed OK.".format(username))
 
 
@@ -118,13 +331,6 @@ def add(**user):
     username = user['username']
     log.debug("Given user <{!r}> to add.".format(username))
 
-    if has(username):
-        raise UserPresentError(
-            "The username <{!r}> is present & cannot be added.".format(
-                username
-            )
-        )
-
     if "password" not in user and "password_hash" not in user:
         raise UserAddError("No password or hash given when its required!")
 
@@ -133,75 +339,364 @@ def add(**user):
         # password is never stored in plain text:
         user.pop('password')
         # Set the new password hash to store, replacing the current one:
-        new_password = pwtools.hash_password(new_password)
+        new_password = pwpool.hash_password(new_password)
         user['password_hash'] = new_password
 
     if "_id" not in user:
         user['_id'] = db.doc_id_for('user')
 
-    log.debug(
-        "The username <{!r}> is not present. OK to add.".format(username)
-    )
+    user[TOKEN_INDEX_FIELD] = token_index(user)
+    user[VERSION_FIELD] = 1
 
+    # The unique username index makes this fail if the username is taken:
     conn = db.db().conn()
-    conn.insert(user)
+    try:
+        conn.insert_one(user)
+
+    except DuplicateKeyError:
+        raise UserPresentError(
+            "The username <{!r}> is present & cannot be added.".format(
+                username
+            )
+        )
+
+    forget_secrets(user)
+    changes.record(changes.ADD, [user])
 
     log.debug("The user <{!r}> was added OK.".format(username))
 
-    return get(username)
+    return user
+
+
+def add_many(users):
+    """Add many new users to the system at once.
+
+    The whole batch is validated first. The passwords of the valid users
+    are then hashed in parallel in the pwpool workers a chunk at a time,
+    and the users are inserted in one unordered bulk write. The unique
+    username index turns away the usernames already present without
+    stopping the others.
+
+    If the pool is too busy to hash any of the passwords ServiceBusyError
+    is raised. If it becomes too busy part way through, the users whose
+    passwords weren't hashed are FAILED and the rest still added.
+
+    :param users: A list of user dicts as add() accepts. Each must pass
+    userdata.creation_required_fields().
+
+    :returns: A list in the same order as the users of::
 
+        dict(
+            username=<the username given>,
+            status=ADDED | CONFLICT | INVALID | FAILED,
+            # The new user's '_id' when added:
+            _id=<'_id' or None>,
+            # Why the user wasn't added:
+            message=<description or None>,
+        )
+
+    """
+    log = get_log('add_many')
+
+    results = []
+    valid = []
+    usernames = set()
+    for data in users:
+        if not isinstance(data, dict):
+            data = {}
+        result = dict(
+            username=data.get('username'), status=ADDED, _id=None, message=None
+        )
+        results.append(result)
+        try:
+            data = creation_required_fields(dict(data))
 
-def update(**user):
+        except UserServiceError as e:
+            result.update(status=INVALID, message=str(e))
+            continue
+
+        if data['username'] in usernames:
+            result.update(
+                status=CONFLICT, message="The username is given twice."
+            )
+            continue
+
+        usernames.add(data['username'])
+        valid.append((result, data))
+
+    log.debug("adding <{}> of <{}> users given.".format(
+        len(valid), len(results)
+    ))
+
+    to_hash = [
+        (result, data) for result, data in valid if "password" in data
+    ]
+    hashed = 0
+    try:
+        for hashes in pwpool.iter_hash_many(
+            [data['password'] for result, data in to_hash]
+        ):
+            chunk = to_hash[hashed:hashed + len(hashes)]
+            for (result, data), password_hash in zip(chunk, hashes):
+                # password is never stored in plain text:
+                data.pop('password')
+                data['password_hash'] = password_hash
+            hashed += len(hashes)
+
+    except ServiceBusyError as e:
+        if not hashed:
+            raise
+        log.warn("'{}' passwords not hashed: {}".format(
+            len(to_hash) - hashed, e
+        ))
+        for result, data in to_hash[hashed:]:
+            result.update(status=FAILED, message=str(e))
+        valid = [
+            (result, data) for result, data in valid
+            if result['status'] == ADDED
+        ]
+
+    for result, data in valid:
+        if "_id" not in data:
+            data['_id'] = db.doc_id_for('user')
+        data[TOKEN_INDEX_FIELD] = token_index(data)
+        data[VERSION_FIELD] = 1
+        result['_id'] = data['_id']
+
+    failed = {}
+    if valid:
+        conn = db.db().conn(write_concern=BULK_WRITE_CONCERN)
+        try:
+            conn.insert_many([data for result, data in valid], ordered=False)
+
+        except BulkWriteError as e:
+            for write_error in e.details.get('writeErrors', []):
+                failed[write_error['index']] = write_error
+
+    added = []
+    for index, (result, data) in enumerate(valid):
+        write_error = failed.get(index)
+        if write_error is None:
+            added.append(data)
+        elif write_error['code'] in DUPLICATE_KEY_CODES:
+            result.update(
+                status=CONFLICT, _id=None,
+                message="The username <{!r}> is present.".format(
+                    data['username']
+                ),
+            )
+        else:
+            log.error("user <{!r}> not added: {}".format(
+                data['username'], write_error['errmsg']
+            ))
+            result.update(
+                status=FAILED, _id=None, message=write_error['errmsg']
+            )
+
+    # New users have no cached secrets, only "unknown token" entries:
+    secret_cache.discard(*[
+        token for data in added for token in token_index(data)
+    ])
+    changes.record(changes.ADD, added)
+
+    log.debug("'{}' of '{}' users added OK.".format(len(added), len(results)))
+
+    return results
+
+
+def flatten_patch(patch, prefix=""):
+    """Turn a JSON merge patch (RFC 7396) into fields for update().
+
+    Nested dicts are merged into the stored ones field by field, a None
+    value removes the field::
+
+        flatten_patch(dict(display_name="Bob", extra=dict(role=None)))
+        >>> ({'display_name': 'Bob'}, ['extra.role'])
+
+    :returns: A (fields, remove) tuple of the dotted field paths to set and
+    the list of dotted field paths to remove.
+
+    """
+    fields = {}
+    remove = []
+    for key, value in patch.items():
+        path = prefix + key
+        if value is None:
+            remove.append(path)
+        elif isinstance(value, dict) and value:
+            found, removed = flatten_patch(value, path + ".")
+            fields.update(found)
+            remove.extend(removed)
+        elif not isinstance(value, dict):
+            fields[path] = value
+
+    return fields, remove
+
+
+def modifier_for(fields, remove=()):
+    """Compile the fields to change into a single update modifier.
+
+    :param fields: A dict of field names or dotted paths, e.g. 'extra.role'
+    or 'tokens.<access token>', to the value to set.
+
+    :param remove: A list of field names or dotted paths to remove.
+
+    The token index is maintained to match the 'tokens' changes. Setting a
+    'tokens.<access token>' path or a field under it adds the token, only
+    removing the whole 'tokens.<access token>' removes it. If single
+    tokens are both added and removed the index can't be changed by the
+    same modifier and is left to the caller, see update().
+
+    :returns: A (modifier, index_changed) tuple. The index_changed is True
+    if the token index still needs setting from the updated user.
+
+    """
+    paths = list(fields) + list(remove)
+    for path in paths:
+        top = path.split(".")[0]
+        if path.startswith("$") or top in (
+            "_id", TOKEN_INDEX_FIELD, VERSION_FIELD,
+        ):
+            raise ValueError("The field <{!r}> can't be updated.".format(path))
+
+    for index, path in enumerate(paths):
+        for other in paths[:index] + paths[index + 1:]:
+            if other == path or other.startswith(path + "."):
+                raise ValueError(
+                    "The field changes <{!r}> and <{!r}> overlap.".format(
+                        path, other
+                    )
+                )
+
+    modifier = {'$inc': {VERSION_FIELD: 1}}
+    if fields:
+        modifier['$set'] = dict(fields)
+    if remove:
+        modifier['$unset'] = dict((path, "") for path in remove)
+
+    def token_of(path, whole):
+        parts = path.split(".")
+        if parts[0] != "tokens" or len(parts) < 2:
+            return None
+        if whole and len(parts) > 2:
+            # A field of the token, the token itself is still present:
+            return None
+        return parts[1]
+
+    index_changed = False
+    if "tokens" in fields:
+        modifier['$set'][TOKEN_INDEX_FIELD] = token_index(fields)
+    elif "tokens" in remove:
+        modifier['$set'] = dict(modifier.get('$set', {}))
+        modifier['$set'][TOKEN_INDEX_FIELD] = []
+    else:
+        added = set(filter(None, [token_of(path, False) for path in fields]))
+        removed = set(filter(None, [token_of(path, True) for path in remove]))
+        if added and removed:
+            index_changed = True
+        elif added:
+            modifier['$addToSet'] = {
+                TOKEN_INDEX_FIELD: {'$each': sorted(added)}
+            }
+        elif removed:
+            modifier['$pull'] = {TOKEN_INDEX_FIELD: {'$in': sorted(removed)}}
+
+    return modifier, index_changed
+
+
+def update(expected_version=None, expected_id=None, remove=None, **user):
     """Called to update the details of an exiting user on the system.
 
-    This handles the 'new_password' field before passing on to the update.
+    This handles the 'new_password' and 'new_username' fields before
+    passing on to the update.
+
+    Only the given fields are changed, by a single atomic modifier which
+    also returns the updated user. Field names may be dotted paths into
+    the user e.g. 'extra.role' or 'tokens.<access token>'. Concurrent
+    updates of different fields don't lose each other's changes.
+
+    :param expected_version: The version the caller last saw, e.g. from
+    the user's ETag. If the stored user has another version the update is
+    refused with UserVersionConflictError.
 
-    Only password can be changed at the moment.
+    :param expected_id: The '_id' the caller last saw. If given and the
+    user was removed and added again since, the update is refused too.
+
+    :param remove: A list of the field names or dotted paths to remove.
+
+    :returns: The updated user dict.
 
     """
     log = get_log('update')
+    username = user.pop('username')
 
-    # Make sure the user if present before attempting to add.
-    current = get(user['username'])
+    log.debug("Given user <{!r}> to update.".format(username))
 
-    log.debug("Given user <{!r}> to update.".format(user['username']))
+    # The db id, token index and version are only ever set here:
+    user.pop('_id', None)
+    user.pop(TOKEN_INDEX_FIELD, None)
+    user.pop(VERSION_FIELD, None)
 
     if "new_password" in user:
-        new_password = user['new_password']
-        user.pop('new_password')
         # Set the new password hash to store, replacing the current one:
-        new_password = pwtools.hash_password(new_password)
-        current['password_hash'] = new_password
-
-    if "new_username" in user:
-        new_username = user['new_username']
-        user.pop('new_username')
-        if not has(user['new_username']):
-            current['username'] = new_username
-        else:
-            raise UserPresentError(
-                "Cannot rename to username <{!r}> as it is used.".format(
-                    new_username
-                )
-            )
+        user['password_hash'] = pwpool.hash_password(user.pop('new_password'))
 
-    # update current with the date preserving the db id:
-    _id = current['_id']
-    for key in user:
-        current[key] = user[key]
-    else:
-        current['_id'] = _id
+    new_username = user.pop('new_username', None)
+    if new_username:
+        user['username'] = new_username
+
+    modifier, index_changed = modifier_for(user, remove or [])
 
-    # log.debug(
-    #     "updated current instance to save:\n\n <{!r}>\n\n\n".format(current)
-    # )
+    spec = dict(username=username)
+    if expected_id is not None:
+        spec['_id'] = expected_id
+    if expected_version is not None:
+        # None matches users stored before versioning:
+        spec[VERSION_FIELD] = int(expected_version) or None
+
+    # The unique username index stops a rename to a username in use:
     conn = db.db().conn()
-    conn.save(current)
+    try:
+        updated = conn.find_one_and_update(
+            spec, modifier, return_document=ReturnDocument.AFTER
+        )
+
+    except OperationFailure as e:
+        # commands report the duplicate key by code only:
+        if e.code not in DUPLICATE_KEY_CODES:
+            raise
+        raise UserPresentError(
+            "Cannot rename to username <{!r}> as it is used.".format(
+                new_username
+            )
+        )
+
+    if not updated:
+        # Tell a user which has changed from one which isn't present:
+        _id, version = get_version(username)
+        raise UserVersionConflictError(
+            "The user <{!r}> is now '{}' not the version expected.".format(
+                username, etag_for(_id, version)
+            )
+        )
+
+    if index_changed:
+        updated[TOKEN_INDEX_FIELD] = token_index(updated)
+        conn.update_one(
+            {'_id': updated['_id'], VERSION_FIELD: updated[VERSION_FIELD]},
+            {'$set': {TOKEN_INDEX_FIELD: updated[TOKEN_INDEX_FIELD]}},
+        )
+
+    if index_changed or any(
+        path.split(".")[0] == "tokens" for path in list(user) + (remove or [])
+    ):
+        forget_secrets(updated)
 
-    log.debug("<{!r}> updated OK.".format(user['username']))
+    changes.record(changes.UPDATE, [updated])
 
-    # Return the updated user details:
-    return get(user['username'])
+    log.debug("<{!r}> updated OK.".format(username))
+
+    return updated
 
 
 def change_password(username, plain_pw, confirm_plain_pw, new_plain_pw):
@@ -228,13 +723,38 @@ def validate_password(username, plain_pw):
     """
     found_user = get(username)
 
-    result = pwtools.validate_password(
+    result = pwpool.validate_password(
         plain_pw, found_user['password_hash']
     )
 
     return result
 
 
+def validate_passwords(credentials):
+    """Validate many users' passwords at once.
+
+    The users are recovered in one query and their passwords checked in
+    the pwpool worker processes.
+
+    :param credentials: A list of (username, plain_pw) tuples.
+
+    :returns: A list in the same order as the credentials of True if the
+    password validates, False if it doesn't or None if the user was not
+    found.
+
+    """
+    found_users = get_many([username for username, plain_pw in credentials])
+
+    pairs = [
+        (plain_pw, found['password_hash'])
+        for (username, plain_pw), found in zip(credentials, found_users)
+        if found
+    ]
+    results = iter(pwpool.validate_many(pairs))
+
+    return [next(results) if found else None for found in found_users]
+
+
 def secret_for_access_token(access_token):
     """Recover the user's for the given access_token.
 
@@ -246,32 +766,27 @@ def secret_for_access_token(access_token):
     access_secret = None
     log = get_log('user_for_access_token')
 
-    log.debug("Looking for access token '{}' owner".format(access_token))
-
-    for userdict in find():
-        if 'tokens' not in userdict:
-            log.debug(
-                "user '{}' has no tokens field. Skipping.".format(
-                    userdict['username']
-                )
-            )
-            continue
+    cached = secret_cache.get(access_token)
+    if cached:
+        return cached[1]
 
-        if access_token in userdict['tokens']:
-            access_secret = userdict['tokens'][access_token]['access_secret']
-            log.debug(
-                "secret found for access_token '{}' owner:'{}'" .format(
-                    access_token, userdict['username']
-                )
-            )
-            break
+    log.debug("Looking for access token '{}' owner".format(access_token))
+    conn = db.db().conn(read=True)
 
-        else:
-            log.debug(
-                "user '{}' access token doesn't match.".format(
-                    userdict['username']
-                )
+    userdict = conn.find_one(
+        {TOKEN_INDEX_FIELD: access_token}, projection=['username', 'tokens']
+    )
+    if userdict and access_token in userdict.get('tokens', {}):
+        access_secret = userdict['tokens'][access_token]['access_secret']
+        log.debug(
+            "secret found for access_token '{}' owner:'{}'" .format(
+                access_token, userdict['username']
             )
+        )
+        secret_cache.set(
+            access_token, (userdict['_id'], access_secret),
+            group=userdict['_id'],
+        )
 
     if not access_secret:
         log.debug(
@@ -279,25 +794,128 @@ def secret_for_access_token(access_token):
                 access_token
             )
         )
+        secret_cache.set(
+            access_token, (None, None), ttl=secret_negative_ttl
+        )
 
     return access_secret
 
 
-def load(data):
+def index_tokens():
+    """Backfill the access token index of every user on the system.
+
+    This only needs running once against users stored before the token
+    index existed. Users added or changed since then are already indexed.
+
+    :returns: The number of users whose index was updated.
+
+    """
+    log = get_log('index_tokens')
+    conn = db.db().conn()
+
+    updated = 0
+    for userdict in conn.find({}, projection=['tokens', TOKEN_INDEX_FIELD]):
+        index = token_index(userdict)
+        if userdict.get(TOKEN_INDEX_FIELD) != index:
+            conn.update_one(
+                {'_id': userdict['_id']}, {'$set': {TOKEN_INDEX_FIELD: index}}
+            )
+            forget_secrets(userdict)
+            updated += 1
+
+    log.warn("access token index updated for '{}' users.".format(updated))
+
+    return updated
+
+
+def load(data, batch_size=1000, progress=None):
     """Load all users into the system.
+
+    Each user replaces the stored user with the same '_id' or is added if
+    not present. The users are written in unordered bulk operations of
+    batch_size users. Each user loaded is recorded in the change log.
+
+    The loaded users are versioned with the load time in milliseconds. This
+    is beyond the small versions updates count up to, so no ETag served
+    before the load matches a loaded user.
+
+    :param data: An iterable of user dicts, each with an '_id'.
+
+    :param batch_size: The number of users written per bulk operation.
+
+    :param progress: An optional callable given the report after each batch.
+
+    :returns: A report dict of the form::
+
+        dict(
+            batches=<bulk operations done>,
+            loaded=<users written>,
+            errors=<users which could not be written>,
+        )
+
     """
     log = get_log('load')
-    conn = db.db().conn()
-    log.warn("loading '{}' users.".format(len(data)))
-    for user in data:
-        log.info("Looking for user {}".format(user['_id']))
-        existing = conn.find_one(user['_id'])
-        log.info(pprint.pformat(existing))
-        if existing:
-            res = conn.update(existing, user)
-        else:
-            res = conn.insert(user)
-        log.info(pprint.pformat(res))
+    conn = db.db().conn(write_concern=BULK_WRITE_CONCERN)
+
+    report = dict(batches=0, loaded=0, errors=0)
+
+    def write(batch):
+        requests = [
+            ReplaceOne({'_id': user['_id']}, user, upsert=True)
+            for user in batch
+        ]
+
+        failed = set()
+        try:
+            conn.bulk_write(requests, ordered=False)
+
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            for write_error in write_errors:
+                log.error("user <{!r}> not loaded: {}".format(
+                    batch[write_error['index']]['_id'], write_error['errmsg']
+                ))
+                failed.add(write_error['index'])
+
+        errors = len(failed)
+        changes.record(changes.LOAD, [
+            user for index, user in enumerate(batch) if index not in failed
+        ])
+
+        report['batches'] += 1
+        report['loaded'] += len(batch) - errors
+        report['errors'] += errors
+        log.info("batch {batches}: loaded {loaded} errors {errors}".format(
+            **report
+        ))
+        if progress:
+            progress(dict(report))
+
+    log.warn("loading users in batches of '{}'.".format(batch_size))
+    version = int(time.time() * 1000)
+    batch = []
+    try:
+        for user in data:
+            user[TOKEN_INDEX_FIELD] = token_index(user)
+            user[VERSION_FIELD] = version
+            batch.append(user)
+            if len(batch) >= batch_size:
+                write(batch)
+                batch = []
+
+        if batch:
+            write(batch)
+
+    finally:
+        # Any of the cached secrets could have changed, even if a batch
+        # failed part way through the load:
+        secret_cache.clear()
+
+    log.warn("loaded '{loaded}' users with '{errors}' errors.".format(
+        **report
+    ))
+
+    return report
 
 
 def dump():
@@ -311,11 +929,43 @@ def dump():
     return returned
 
 
+def iter_dump(after=None, before=None, batch_size=1000):
+    """Yield every user in '_id' order without holding them all in memory.
+
+    :param after: Only users with an '_id' greater than this are returned.
+
+    :param before: Only users with an '_id' less than this are returned.
+
+    :param batch_size: The number of users recovered from mongodb at a time.
+
+    The after and before give a range of '_id' so a large dump can be taken
+    in parts, or resumed from the last '_id' received.
+
+    :returns: A generator of user dicts.
+
+    """
+    log = get_log('iter_dump')
+
+    criteria = {}
+    if after:
+        criteria['$gt'] = after
+    if before:
+        criteria['$lt'] = before
+    spec = {'_id': criteria} if criteria else {}
+
+    log.warn("streaming users of the system matching {!r}.".format(spec))
+    conn = db.db().conn(read=True)
+    cursor = conn.find(spec).sort('_id', 1).batch_size(batch_size)
+
+    for userdict in cursor:
+        yield userdict
+
+
 def count():
     """Return the number of users on the system.
 
     :returns: a number greater or equal to zero.
 
     """
-    conn = db.db().conn()
-    return conn.count()
+    conn = db.db().conn(read=True)
+    return conn.count_documents({})
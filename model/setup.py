@@ -35,7 +35,7 @@ ShortDescription = Summary
 
 needed = [
     'evasion-common',
-    'pymongo',
+    'pymongo>=3.7',
     'pp-apiaccesstoken',
     'pp-user-validate',
 ]
@@ -58,7 +58,10 @@ PackageData = {
 }
 
 EntryPoints = {
-
+    'console_scripts': [
+        'user-model-benchmark = pp.user.model.benchmark.runner:main',
+        'user-model-index-tokens = pp.user.model.indextokens:main',
+    ]
 }
 
 
@@ -6,12 +6,21 @@ PythonPro REST Service 'pp-user-service'
 import logging
 import httplib
 
+from pyramid.tweens import EXCVIEW
 from pyramid.config import Configurator
 
 from pp.web.base import restfulhelpers
 from pp.web.base import pp_auth_middleware
 
 from pp.user.model import db
+from pp.user.model import user
+from pp.user.model import pwpool
+from pp.user.service import metrics
+from pp.user.service import useradminviews
+from pp.user.service import tracing
+from pp.user.service import slowlog
+from pp.user.service import profiling
+from pp.user.service.tracing import TracedMiddleware
 
 
 def main(global_config, **settings):
@@ -21,14 +30,51 @@ def main(global_config, **settings):
 
     config = Configurator(settings=settings)
 
+    # All the mongodb.* settings are passed on, see pp.user.model.db.DB:
     cfg = dict(
+        (key[len("mongodb."):], value)
+        for key, value in settings.items()
+        if key.startswith("mongodb.")
+    )
+    cfg.update(
         dbname=settings.get("mongodb.dbname", "ppusertestdb"),
         port=int(settings.get("mongodb.port", 27017)),
         host=settings.get("mongodb.host", "127.0.0.1"),
     )
-    log.info("MongoDB config<{:s}>".format(cfg))
+    log.info("MongoDB config<{}>".format(cfg))
+    # Time every command sent to MongoDB, see /metrics, and trace it:
+    cfg['event_listeners'] = [
+        metrics.CommandListener(), tracing.CommandListener()
+    ]
     db.init(cfg)
 
+    tracing.configure(settings)
+
+    user.configure_secret_cache(
+        max_size=int(settings.get("secret_cache.max_size", 10000)),
+        ttl=float(settings.get("secret_cache.ttl", 60)),
+        negative_ttl=float(settings.get("secret_cache.negative_ttl", 5)),
+    )
+
+    useradminviews.configure_body_cache(
+        max_size=int(settings.get("body_cache.max_size", 10000)),
+        ttl=float(settings.get("body_cache.ttl", 3600)),
+    )
+
+    useradminviews.configure_changes_wait(
+        max_waiters=int(settings.get("changes.max_waiters", 1)),
+        max_wait=float(settings.get("changes.max_wait", 10)),
+    )
+
+    # The password hashing worker processes. No setting means a process per
+    # CPU, 0 hashes in the request thread:
+    processes = settings.get("pwpool.processes", "").strip()
+    pwpool.configure(
+        processes=int(processes) if processes else None,
+        max_pending=int(settings.get("pwpool.max_pending", 64)),
+        timeout=float(settings.get("pwpool.timeout", 30)),
+    )
+
     # Custom 404 json response handler. This returns a useful JSON
     # response in the body of the 404.
     # XXX this is conflicting
@@ -42,18 +88,66 @@ def main(global_config, **settings):
         bad_request, context='pyramid.httpexceptions.HTTPBadRequest'
     )
 
+    forbidden = restfulhelpers.xyz_handler(httplib.FORBIDDEN)
+    config.add_view(
+        forbidden, context='pyramid.httpexceptions.HTTPForbidden'
+    )
+
+    busy = restfulhelpers.xyz_handler(httplib.SERVICE_UNAVAILABLE)
+    config.add_view(busy, context='pp.user.validate.error.ServiceBusyError')
+
+    # Time and count every request, see /metrics:
+    config.add_tween('pp.user.service.metrics.tween_factory', over=EXCVIEW)
+    config.add_tween('pp.user.service.tracing.tween_factory', over=EXCVIEW)
+
+    # Count each request's MongoDB round trips and log the slow requests:
+    slowlog.configure(settings)
+    config.add_tween('pp.user.service.slowlog.tween_factory', over=EXCVIEW)
+
+    # On-demand profiling is only installed when an admin token is set:
+    if profiling.configure(settings):
+        config.add_tween(
+            'pp.user.service.profiling.tween_factory', over=EXCVIEW
+        )
+    metrics.registry.gauge(
+        "userservice_secret_cache_size",
+        "Entries in the access secret cache.",
+        lambda: user.secret_cache.stats()['size'],
+    )
+    metrics.registry.gauge(
+        "userservice_password_pool_pending",
+        "Passwords queued or being hashed in the worker pool.",
+        lambda: pwpool.stats()['pending'],
+    )
+
     # Maps to the status page:
     config.add_route('home', '/')
 
+    # Prometheus text exposition of the service metrics:
+    config.add_route('metrics', '/metrics')
+
     # sysadmin actions
     config.add_route('dump', '/usiverse/dump/')
     config.add_route('load', '/usiverse/load/')
+    config.add_route('profile', '/usiverse/profile/')
+    config.add_route('profile-status', '/usiverse/profile/{capture_id}/')
+    config.add_route(
+        'profile-download', '/usiverse/profile/{capture_id}/{kind}/'
+    )
 
     # User management
 
     config.add_route('the_users', '/users')
     config.add_route('the_users-1', '/users/')
 
+    config.add_route('the_users-batch', '/users/batch/')
+
+    config.add_route('user-changes', '/users/changes')
+    config.add_route('user-changes-1', '/users/changes/')
+
+    # This must come before user-auth so 'batch' isn't taken as a username:
+    config.add_route('user-auth-batch', '/access/auth/batch/')
+
     config.add_route('user-auth', '/access/auth/{username}/')
     config.add_route('user-auth-1', '/access/auth/{username}')
 
@@ -70,15 +164,21 @@ def main(global_config, **settings):
 
     # Make the pyramid app I'll then wrap in other middleware:
     app = config.make_wsgi_app()
+    app = TracedMiddleware(app, "pyramid")
 
     # Add in the configured pp_auth magic.
     app = pp_auth_middleware(settings, app)
+    app = TracedMiddleware(app, "pp_auth_middleware")
 
     # RESTful helper class to handle PUT, DELETE over POST requests:
     app = restfulhelpers.HttpMethodOverrideMiddleware(app)
+    app = TracedMiddleware(app, "HttpMethodOverrideMiddleware")
 
     # Should be last to catch all errors of below wsgi apps. This
     # returns useful JSON response in the body of the 500:
     app = restfulhelpers.JSONErrorHandler(app)
 
+    # The outer most span continues the caller's trace:
+    app = TracedMiddleware(app, "JSONErrorHandler")
+
     return app
@@ -5,9 +5,11 @@ pp-allotment-service
 PythonPro Limited
 
 """
+import json
+import zlib
 import logging
-import pprint
 
+from pyramid.response import Response
 from pyramid.view import view_config
 
 from pp.user.model import db
@@ -18,15 +20,83 @@ def get_log(extra=None):
     return logging.getLogger(m)
 
 
+# The content type of newline-delimited JSON: one user dict per line.
+NDJSON_CT = 'application/x-ndjson'
+
+
+def ndjson_chunks(users, batch_size=1000):
+    """Render the users as newline-delimited JSON.
+
+    :param users: An iterable of user dicts.
+
+    :param batch_size: The number of users rendered into each chunk.
+
+    :returns: A generator of strings each holding up to batch_size lines.
+
+    """
+    lines = []
+    for userdict in users:
+        lines.append(json.dumps(userdict))
+        if len(lines) >= batch_size:
+            yield "\n".join(lines) + "\n"
+            lines = []
+
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def gzip_chunks(chunks, level=6):
+    """Gzip compress the given chunks as they are produced.
+
+    :returns: A generator of the compressed strings.
+
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
 @view_config(route_name='dump', request_method='GET', renderer='json')
 def dump_everyone(request):
     """JSON dump of everything.
 
     Not meant for anything other then testing!
 
+    With the 'stream=yes' parameter the users are written out as they are
+    read from mongodb as newline-delimited JSON, gzipped if the client
+    accepts it. The optional 'after' and 'before' parameters give an '_id'
+    range for dumping in parts or resuming an interrupted dump.
+
     """
-    get_log("dump_everyone").warn("Dumping the entire system to JSON.")
-    return db.dump()
+    log = get_log("dump_everyone")
+
+    stream = request.params.get('stream', 'no').lower()
+    if stream not in ('yes', 'true', '1'):
+        log.warn("Dumping the entire system to JSON.")
+        return db.dump()
+
+    log.warn("Streaming the entire system as newline-delimited JSON.")
+    users = db.iter_dump(
+        after=request.params.get('after'),
+        before=request.params.get('before'),
+    )
+    app_iter = ndjson_chunks(users)
+
+    content_encoding = None
+    if 'gzip' in request.accept_encoding:
+        content_encoding = 'gzip'
+        app_iter = gzip_chunks(app_iter)
+
+    return Response(
+        app_iter=app_iter,
+        content_type=NDJSON_CT,
+        charset='utf-8',
+        content_encoding=content_encoding,
+    )
 
 
 @view_config(route_name='load', request_method='POST', renderer='json')
@@ -35,8 +105,26 @@ def load_everyone(request):
 
     Not meant for anything other then testing!
 
+    The body is either a JSON list of user dicts or, with the content type
+    'application/x-ndjson', a user dict per line which is loaded as it is
+    read. The optional 'batch_size' parameter sets the users written per
+    bulk operation.
+
+    :returns: The load report see pp.user.model.user.load().
+
     """
-    get_log("load_everyone").warn("Loading from JSON.")
-    data = request.json_body
-    get_log("load_everyone").debug(pprint.pformat(data))
-    db.load(data)
+    log = get_log("load_everyone")
+
+    batch_size = int(request.params.get('batch_size', 1000))
+
+    if request.content_type == NDJSON_CT:
+        log.warn("Loading from newline-delimited JSON.")
+        data = (
+            json.loads(line) for line in request.body_file if line.strip()
+        )
+
+    else:
+        log.warn("Loading from JSON.")
+        data = request.json_body
+
+    return db.load(data, batch_size=batch_size)
@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+"""
+Drive a running user service with concurrent clients and measure it.
+
+The service is started by the tests ServerRunner against a throwaway
+database seeded with synthetic users. Many client threads then make a mix
+of requests to these routes for a fixed time or number of requests:
+
+    get:    GET /user/{username}/
+    auth:   POST /access/auth/{username}/
+    secret: GET /access/secret/{access_token}/
+    users:  GET /users/?limit=<page_size>
+
+The results are JSON of the form::
+
+    dict(
+        meta=dict(clients=16, duration=30, mix=dict(get=40, ..), ..),
+        routes={
+            "get": dict(
+                count=<requests made>,
+                errors=<failed requests>,
+                rps=<requests per second>,
+                p50_ms=.., p95_ms=.., p99_ms=.., max_ms=..,
+                histogram=[dict(le_ms=1, count=..), .., dict(le_ms=None, ..)]
+            ),
+            :
+            etc
+        },
+    )
+
+Two result files can be compared to flag regressions::
+
+    user-service-loadtest run --duration 60 --output new.json
+    user-service-loadtest compare baseline.json new.json --threshold 0.1
+
+"""
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import threading
+from urlparse import urljoin
+from timeit import default_timer
+
+from pp.auth import pwtools
+from pp.user.model import db
+from pp.user.model import user
+from pp.user.client import session as pooled
+from pp.user.model.benchmark.runner import percentile
+from pp.user.model.benchmark.generate import synthetic_users
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+# The relative weight of each route in the traffic:
+DEFAULT_MIX = dict(get=40, auth=10, secret=40, users=10)
+
+# The upper bound in ms of each latency histogram bucket, None is the rest:
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, None)
+
+# The password every synthetic user is given:
+PASSWORD = "password"
+
+JSON_CT = {'content-type': 'application/json'}
+
+
+def parse_mix(text):
+    """Recover a route mix from "get=40,auth=10,..".
+
+    :returns: A dict of route name to integer weight.
+
+    """
+    mix = {}
+    for part in text.split(","):
+        route, weight = part.split("=")
+        route = route.strip()
+        if route not in DEFAULT_MIX:
+            raise ValueError("Unknown route '{}' in the mix.".format(route))
+        mix[route] = int(weight)
+    return mix
+
+
+class Recorder(object):
+    """Collect the latency of each request per route from many threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, route, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, elapsed):
+        """Return the per route figures described in this module's docs."""
+        routes = {}
+        for route, latencies in self.latencies.items():
+            ordered = sorted(latencies)
+            routes[route] = dict(
+                count=len(ordered),
+                errors=self.errors.get(route, 0),
+                rps=len(ordered) / elapsed if elapsed else 0.0,
+                p50_ms=percentile(ordered, 0.50) * 1000,
+                p95_ms=percentile(ordered, 0.95) * 1000,
+                p99_ms=percentile(ordered, 0.99) * 1000,
+                max_ms=ordered[-1] * 1000,
+                histogram=histogram(ordered),
+            )
+        return routes
+
+
+def histogram(ordered):
+    """Count the sorted latencies (seconds) into the BUCKETS_MS."""
+    counts = []
+    index = 0
+    for bound in BUCKETS_MS:
+        count = 0
+        while index < len(ordered) and (
+            bound is None or ordered[index] * 1000 <= bound
+        ):
+            count += 1
+            index += 1
+        counts.append(dict(le_ms=bound, count=count))
+    return counts
+
+
+def seed(size, tokens=2, seed=1):
+    """Load the synthetic users into the current database.
+
+    :returns: A list of (username, access_token) for the clients to use.
+
+    """
+    password_hash = pwtools.hash_password(PASSWORD)
+    users = list(synthetic_users(
+        size, tokens=tokens, seed=seed, password_hash=password_hash,
+    ))
+    user.load(users)
+    return [
+        (u['username'], sorted(u['tokens'])[0] if u['tokens'] else "none")
+        for u in users
+    ]
+
+
+class Client(object):
+    """Make a random mix of requests to the service recording each one."""
+
+    def __init__(self, uri, session, known, mix, rng, page_size, recorder):
+        self.uri = uri
+        self.session = session
+        self.known = known
+        self.rng = rng
+        self.page_size = page_size
+        self.recorder = recorder
+        self.choices = []
+        for route, weight in sorted(mix.items()):
+            self.choices.extend([route] * weight)
+
+    def get(self, username, access_token):
+        return self.session.get(
+            urljoin(self.uri, "/user/{}/".format(username)),
+            headers=JSON_CT,
+        )
+
+    def auth(self, username, access_token):
+        return self.session.post(
+            urljoin(self.uri, "/access/auth/{}/".format(username)),
+            json.dumps(dict(password=PASSWORD.encode("base64"))),
+            headers=JSON_CT,
+        )
+
+    def secret(self, username, access_token):
+        return self.session.get(
+            urljoin(self.uri, "/access/secret/{}/".format(access_token)),
+            headers=JSON_CT,
+        )
+
+    def users(self, username, access_token):
+        return self.session.get(
+            urljoin(self.uri, "/users/"),
+            params=dict(limit=self.page_size),
+            headers=JSON_CT,
+        )
+
+    def request(self):
+        route = self.rng.choice(self.choices)
+        username, access_token = self.rng.choice(self.known)
+        started = default_timer()
+        try:
+            response = getattr(self, route)(username, access_token)
+            ok = response.status_code == 200 and response.json()['success']
+        except Exception:
+            get_log("Client.request").exception("{} failed.".format(route))
+            ok = False
+        self.recorder.record(route, default_timer() - started, ok)
+
+
+def drive(
+    uri, known, clients=16, duration=30, requests=None, mix=DEFAULT_MIX,
+    page_size=50, rng_seed=1,
+):
+    """Run the clients against the service until done.
+
+    :param duration: The seconds to run for, ignored if requests is given.
+
+    :param requests: The total number of requests to make.
+
+    :returns: (recorder, elapsed seconds)
+
+    """
+    recorder = Recorder()
+    session = pooled.new_session(pool_size=clients, retries=0)
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def more(deadline):
+        if requests is None:
+            return default_timer() < deadline
+        with lock:
+            remaining[0] -= 1
+            return remaining[0] >= 0
+
+    def run(index):
+        client = Client(
+            uri, session, known, mix, random.Random(rng_seed + index),
+            page_size, recorder,
+        )
+        while more(deadline):
+            client.request()
+
+    started = default_timer()
+    deadline = started + duration
+    workers = [
+        threading.Thread(target=run, args=(i,)) for i in range(clients)
+    ]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        session.close()
+
+    return recorder, default_timer() - started
+
+
+def run(
+    clients=16, duration=30, requests=None, mix=DEFAULT_MIX, users=1000,
+    tokens=2, page_size=50, rng_seed=1, cmd=None, ready_timeout=10,
+    mongo_host="127.0.0.1", mongo_port=27017,
+):
+    """Start the service against a seeded database and load test it.
+
+    :param cmd: The command to run the service with, see ServerRunner. By
+    default pserve is used.
+
+    :returns: The results dict described in this module's docs.
+
+    """
+    from pp.user.service.tests.conftest import ServerRunner
+
+    log = get_log("run")
+
+    dbname = "loadtestdb-{}".format(uuid.uuid4().hex)
+    db.init(dict(dbname=dbname, host=mongo_host, port=mongo_port))
+    mongo = db.db()
+    mongo.hard_reset()
+    log.info('database ready for load testing "{}"'.format(dbname))
+
+    config = dict(
+        interface='127.0.0.1',
+        mongo_host=mongo_host,
+        mongo_port=mongo_port,
+        mongo_dbname=dbname,
+        ready_timeout=ready_timeout,
+    )
+    if cmd:
+        config['cmd'] = cmd
+    server = ServerRunner(config)
+
+    try:
+        log.info("seeding '{}' users.".format(users))
+        known = seed(users, tokens=tokens, seed=rng_seed)
+
+        server.start()
+        log.info("driving <{}> with '{}' clients.".format(
+            server.URI, clients
+        ))
+        recorder, elapsed = drive(
+            server.URI, known, clients=clients, duration=duration,
+            requests=requests, mix=mix, page_size=page_size,
+            rng_seed=rng_seed,
+        )
+
+    finally:
+        server.stop()
+        server.cleanup()
+        mongo.hard_reset()
+        log.warn('load test database dropped "{}"'.format(dbname))
+
+    return dict(
+        meta=dict(
+            clients=clients,
+            duration=duration,
+            requests=requests,
+            elapsed=elapsed,
+            mix=mix,
+            users=users,
+            tokens=tokens,
+            page_size=page_size,
+            seed=rng_seed,
+            cmd=server.cmd,
+            started=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        ),
+        routes=recorder.report(elapsed),
+    )
+
+
+def compare(baseline, current, threshold=0.1):
+    """Find the routes which got worse between two results.
+
+    Lower throughput, higher p50/p95/p99 latency or a higher error rate by
+    more than the threshold fraction count as a regression.
+
+    :returns: A list of regressions of the form::
+
+        dict(route="get", metric="p95_ms", baseline=4.1, current=5.3,
+             change=0.29)
+
+    """
+    # metric, True if bigger is better:
+    metrics = [
+        ('rps', True), ('p50_ms', False), ('p95_ms', False),
+        ('p99_ms', False), ('error_rate', False),
+    ]
+
+    def figures(route):
+        found = dict(route)
+        found['error_rate'] = (
+            route['errors'] / float(route['count']) if route['count'] else 0.0
+        )
+        return found
+
+    regressions = []
+    for name in sorted(baseline['routes']):
+        if name not in current['routes']:
+            continue
+        before = figures(baseline['routes'][name])
+        after = figures(current['routes'][name])
+        for metric, higher_is_better in metrics:
+            was, now = before[metric], after[metric]
+            if was:
+                change = (now - was) / float(was)
+            else:
+                change = 1.0 if now else 0.0
+            worse = -change if higher_is_better else change
+            if worse > threshold:
+                regressions.append(dict(
+                    route=name, metric=metric, baseline=was, current=now,
+                    change=change,
+                ))
+
+    return regressions
+
+
+def main(argv=None):
+    """user-service-loadtest main script as set up in the 'setup.py'."""
+    parser = argparse.ArgumentParser(
+        description="Load test the user service or compare two results."
+    )
+    commands = parser.add_subparsers(dest='command')
+
+    runner = commands.add_parser('run', help='Run a load test.')
+    runner.add_argument('--clients', type=int, default=16)
+    runner.add_argument(
+        '--duration', type=float, default=30,
+        help='The seconds to drive the service for (%(default)s).'
+    )
+    runner.add_argument(
+        '--requests', type=int, default=None,
+        help='Make this many requests instead of running for a duration.'
+    )
+    runner.add_argument(
+        '--mix', default="get=40,auth=10,secret=40,users=10",
+        help='The relative weight of each route (%(default)s).'
+    )
+    runner.add_argument('--users', type=int, default=1000)
+    runner.add_argument('--tokens', type=int, default=2)
+    runner.add_argument('--page-size', type=int, default=50)
+    runner.add_argument('--seed', type=int, default=1)
+    runner.add_argument(
+        '--cmd', default=None,
+        help='Serve with this e.g. "exec user-service --workers 4 {config}"'
+    )
+    runner.add_argument('--mongo-host', default="127.0.0.1")
+    runner.add_argument('--mongo-port', type=int, default=27017)
+    runner.add_argument(
+        '--output', default="-",
+        help='The file to write the JSON results to, - for stdout.'
+    )
+
+    comparer = commands.add_parser('compare', help='Compare two results.')
+    comparer.add_argument('baseline')
+    comparer.add_argument('current')
+    comparer.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='The fraction worse which counts as a regression.'
+    )
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s',
+    )
+
+    if args.command == 'compare':
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)
+        with open(args.current) as fd:
+            current = json.load(fd)
+        regressions = compare(baseline, current, args.threshold)
+        for found in regressions:
+            sys.stdout.write(
+                "REGRESSION {route} {metric}: {baseline:.2f} -> "
+                "{current:.2f} ({change:+.0%})\n".format(**found)
+            )
+        if not regressions:
+            sys.stdout.write("No regressions above {:.0%}.\n".format(
+                args.threshold
+            ))
+        return 1 if regressions else 0
+
+    results = run(
+        clients=args.clients,
+        duration=args.duration,
+        requests=args.requests,
+        mix=parse_mix(args.mix),
+        users=args.users,
+        tokens=args.tokens,
+        page_size=args.page_size,
+        rng_seed=args.seed,
+        cmd=args.cmd,
+        mongo_host=args.mongo_host,
+        mongo_port=args.mongo_port,
+    )
+
+    rendered = json.dumps(results, indent=4, sort_keys=True)
+    if args.output == "-":
+        sys.stdout.write(rendered + "\n")
+    else:
+        with open(args.output, "w") as fd:
+            fd.write(rendered)
+
+    return 0
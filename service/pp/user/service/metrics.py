@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Request and MongoDB metrics exposed in the Prometheus text format.
+
+Every request is timed by the tween per route, method and status. Every
+command the driver sends to MongoDB is timed by the CommandListener. The
+/metrics route renders the registry for a Prometheus server to scrape::
+
+    # HELP userservice_request_duration_seconds Time serving each request.
+    # TYPE userservice_request_duration_seconds histogram
+    userservice_request_duration_seconds_bucket{route="user",le="0.005"} 3
+    :
+    etc
+
+Each worker process has its own registry, so scrape each worker or run a
+single worker per port.
+
+"""
+import bisect
+import logging
+import threading
+from timeit import default_timer
+
+from pymongo import monitoring
+from pyramid.view import view_config
+from pyramid.response import Response
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+# The text exposition format content type:
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# The upper bounds in seconds of the latency histogram buckets:
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0,
+)
+
+
+def _escape(value):
+    return unicode(value).replace(
+        u"\\", u"\\\\"
+    ).replace(u"\n", u"\\n").replace(u'"', u'\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return u""
+    return u"{" + u",".join(
+        u'{}="{}"'.format(name, _escape(value)) for name, value in pairs
+    ) + u"}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return u"+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """A count per label values which only goes up."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name, _labels(self.labels, labels), value
+
+
+class Histogram(object):
+    """Observations counted into buckets per label values."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label values: [bucket counts.., +Inf count, sum]
+        self._values = {}
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            found = self._values.get(labels)
+            if found is None:
+                found = self._values[labels] = [0] * (len(self.buckets) + 1)
+                found.append(0.0)
+            found[index] += 1
+            found[-1] += value
+
+    def count(self, labels=()):
+        found = self._values.get(labels)
+        return sum(found[:-1]) if found else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted(
+                (labels, list(found)) for labels, found in self._values.items()
+            )
+        bounds = self.buckets + (float("inf"),)
+        for labels, found in values:
+            total = 0
+            for bound, count in zip(bounds, found[:-1]):
+                total += count
+                yield (
+                    self.name + "_bucket",
+                    _labels(self.labels, labels, [("le", _number(bound))]),
+                    total,
+                )
+            rendered = _labels(self.labels, labels)
+            yield self.name + "_sum", rendered, found[-1]
+            yield self.name + "_count", rendered, total
+
+
+class Gauge(object):
+    """A value read from a function each time the registry is rendered."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, recover):
+        self.name = name
+        self.help = help
+        self.recover = recover
+
+    def samples(self):
+        yield self.name, u"", self.recover()
+
+
+class Registry(object):
+    """The metrics of this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _add(self, metric):
+        with self._lock:
+            # Registering the same name again returns the existing metric:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, recover):
+        """Add a gauge whose value is recover() when rendered."""
+        with self._lock:
+            self._metrics[name] = Gauge(name, help, recover)
+            return self._metrics[name]
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def render(self):
+        """Return all the metrics in the text exposition format."""
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+
+        lines = []
+        for name, metric in metrics:
+            lines.append(u"# HELP {} {}".format(name, metric.help))
+            lines.append(u"# TYPE {} {}".format(name, metric.kind))
+            for sample, labels, value in metric.samples():
+                lines.append(u"{}{} {}".format(sample, labels, _number(value)))
+
+        return u"\n".join(lines) + u"\n"
+
+
+# The metrics of this process:
+registry = Registry()
+
+REQUESTS = registry.counter(
+    "userservice_requests_total",
+    "Requests served by route, method and status code.",
+    ("route", "method", "status"),
+)
+
+REQUEST_DURATION = registry.histogram(
+    "userservice_request_duration_seconds",
+    "Time serving each request by route.",
+    ("route",),
+)
+
+MONGO_COMMANDS = registry.counter(
+    "userservice_mongo_commands_total",
+    "MongoDB commands sent by command name and outcome.",
+    ("command", "outcome"),
+)
+
+MONGO_DURATION = registry.histogram(
+    "userservice_mongo_command_duration_seconds",
+    "Time MongoDB took to answer each command by command name.",
+    ("command",),
+)
+
+
+def route_name(request):
+    """Return the matched route with aliases like 'user-1' as 'user'."""
+    route = getattr(request, 'matched_route', None)
+    if route is None:
+        return "notfound"
+    name = route.name
+    if name.endswith("-1"):
+        name = name[:-2]
+    return name
+
+
+def tween_factory(handler, pyramid_registry):
+    """Time every request and count its status code.
+
+    It is placed over the exception view tween so errors turned into JSON
+    responses are counted with their status code.
+
+    """
+    def metrics_tween(request):
+        started = default_timer()
+        status = 500
+        try:
+            response = handler(request)
+            status = response.status_code
+            return response
+
+        finally:
+            route = route_name(request)
+            REQUEST_DURATION.observe(default_timer() - started, (route,))
+            REQUESTS.inc((route, request.method, status))
+
+    return metrics_tween
+
+
+class CommandListener(monitoring.CommandListener):
+    """Time each command the driver sends, see DB event_listeners."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_DURATION.observe(
+            event.duration_micros / 1e6, (event.command_name,)
+        )
+        MONGO_COMMANDS.inc((event.command_name, "succeeded"))
+
+    def failed(self, event):
+        MONGO_DURATION.observe(
+            event.duration_micros / 1e6, (event.command_name,)
+        )
+        MONGO_COMMANDS.inc((event.command_name, "failed"))
+
+
+@view_config(route_name='metrics', request_method='GET')
+def metrics(request):
+    """Return the registry in the Prometheus text exposition format."""
+    response = Response(body=registry.render().encode("utf-8"))
+    response.headers['Content-Type'] = CONTENT_TYPE
+    return response
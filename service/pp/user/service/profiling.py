@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+Profile the next requests the running service handles, on demand.
+
+An admin POSTs to /usiverse/profile/ to capture the next N requests, or the
+next N to a given route. Each is run under cProfile and the combined stats
+are written to the profiling directory along with a memory report::
+
+    <capture id>.pstats   load with pstats.Stats(path)
+    <capture id>.memory   JSON: RSS and the object types which grew
+    <capture id>.json     the capture details, present once it is done
+
+If the tracemalloc module is available a snapshot is also written to
+<capture id>.tracemalloc. The files can be downloaded with 'user-admin
+profile'.
+
+The capture is made in the worker process which received the POST. The
+files are read from the shared directory so any worker can return them.
+
+A capture ends after its timeout even if too few requests were made, and
+can be cancelled with a DELETE of /usiverse/profile/<capture id>/. Either
+way the requests captured so far are saved.
+
+Nothing is installed unless an admin token is configured, so a service
+without one pays no cost::
+
+    profiling.admin_token = <secret the admin sends in X-Admin-Token>
+    profiling.dir = %(here)s/profiles
+
+"""
+import os
+import gc
+import hmac
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import logging
+import resource
+import tempfile
+import threading
+from collections import Counter
+
+from pyramid.view import view_config
+from pyramid.response import Response
+from pyramid.interfaces import IRoutesMapper
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.httpexceptions import HTTPForbidden
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+# The header the admin token is sent in:
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+
+# The files a capture can be downloaded as:
+KINDS = ("pstats", "memory", "tracemalloc", "json")
+
+# The seconds a capture runs for unless told otherwise, and at most:
+DEFAULT_TIMEOUT = 300
+MAX_TIMEOUT = 3600
+
+# Why a capture ended before all its requests were captured:
+EXPIRED = "expired"
+CANCELLED = "cancelled"
+
+# The settings profiling was configured with, see configure():
+__config = dict(admin_token=None, directory=None)
+
+# The capture in progress in this process or None:
+__capture = None
+__lock = threading.Lock()
+
+
+def configure(settings):
+    """Set up profiling from the profiling.* settings.
+
+    :returns: True if profiling is enabled i.e. an admin token is set.
+
+    """
+    admin_token = settings.get("profiling.admin_token", "").strip()
+    directory = settings.get("profiling.dir", "").strip()
+    if not directory:
+        directory = os.path.join(tempfile.gettempdir(), "pp-user-profiles")
+
+    __config.update(admin_token=admin_token or None, directory=directory)
+    return bool(admin_token)
+
+
+def path_for(capture_id, kind):
+    """Return the path of one of a capture's files."""
+    return os.path.join(
+        __config['directory'], "{}.{}".format(capture_id, kind)
+    )
+
+
+def type_counts():
+    """Return a Counter of the live objects by type name."""
+    return Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Capture(object):
+    """Profile requests until the wanted number have been captured."""
+
+    def __init__(self, requests, route=None, timeout=DEFAULT_TIMEOUT):
+        self.id = uuid.uuid4().hex
+        self.requests = requests
+        self.route = route
+        self.captured = 0
+        self.started = time.time()
+        self.expires = self.started + timeout
+        self.ended = None
+        self.stats = None
+        self.lock = threading.Lock()
+        self.rss_before = max_rss_kb()
+        self.objects_before = type_counts()
+        if tracemalloc:
+            tracemalloc.start()
+
+    def wants(self, route):
+        return self.route is None or self.route == route
+
+    def expired(self):
+        return time.time() >= self.expires
+
+    def add(self, profile):
+        """Add a request's profile.
+
+        :returns: True once all the requests have been captured.
+
+        """
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.captured += 1
+            return self.captured >= self.requests
+
+    def save(self):
+        """Write the capture's files to the profiling directory."""
+        directory = os.path.dirname(path_for(self.id, "json"))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        if self.stats is not None:
+            self.stats.dump_stats(path_for(self.id, "pstats"))
+
+        if tracemalloc:
+            tracemalloc.take_snapshot().dump(path_for(self.id, "tracemalloc"))
+            tracemalloc.stop()
+
+        grown = type_counts()
+        grown.subtract(self.objects_before)
+        with open(path_for(self.id, "memory"), "w") as fd:
+            fd.write(json.dumps(dict(
+                max_rss_kb_before=self.rss_before,
+                max_rss_kb_after=max_rss_kb(),
+                objects_grown=[
+                    dict(type=name, count=count)
+                    for name, count in grown.most_common(50) if count > 0
+                ],
+            ), indent=4))
+
+        # Written last as its presence means the capture is done:
+        with open(path_for(self.id, "json"), "w") as fd:
+            fd.write(json.dumps(self.details()))
+
+        get_log("Capture.save").info(
+            "capture '{}' of '{}' requests saved.".format(
+                self.id, self.captured
+            )
+        )
+
+    def details(self):
+        return dict(
+            capture_id=self.id,
+            requests=self.requests,
+            route=self.route,
+            captured=self.captured,
+            started=self.started,
+            pid=os.getpid(),
+            expires=self.expires,
+            # None, EXPIRED or CANCELLED:
+            ended=self.ended,
+            done=self.captured >= self.requests or self.ended is not None,
+            files=[
+                kind for kind in KINDS
+                if kind != "json" and os.path.isfile(path_for(self.id, kind))
+            ],
+        )
+
+
+def start(requests, route=None, timeout=DEFAULT_TIMEOUT):
+    """Start capturing the next requests in this process.
+
+    A capture in progress which has expired is ended first.
+
+    :returns: The new Capture.
+
+    """
+    global __capture
+    capture = __capture
+    if capture is not None and capture.expired():
+        stop(capture, EXPIRED)
+
+    with __lock:
+        if __capture is not None:
+            raise ValueError(
+                "Capture '{}' is in progress.".format(__capture.id)
+            )
+        __capture = Capture(requests, route, timeout)
+        return __capture
+
+
+def stop(capture, ended=None):
+    """End the capture if it is in progress, saving what it captured.
+
+    :param ended: None if all its requests were captured, otherwise EXPIRED
+    or CANCELLED.
+
+    :returns: True if it was in progress in this process.
+
+    """
+    global __capture
+    with __lock:
+        if __capture is not capture:
+            return False
+        __capture = None
+
+    capture.ended = ended
+    capture.save()
+    return True
+
+
+def tween_factory(handler, pyramid_registry):
+    """Profile the requests a capture wants.
+
+    This is only added when profiling is enabled. Without a capture in
+    progress it costs a global lookup per request.
+
+    """
+    mapper = pyramid_registry.queryUtility(IRoutesMapper)
+
+    def route_name(request):
+        # Routing happens after the tweens so it is matched here:
+        route = mapper(request)['route']
+        if route is None:
+            return "notfound"
+        return route.name[:-2] if route.name.endswith("-1") else route.name
+
+    def profiling_tween(request):
+        capture = __capture
+        if capture is None:
+            return handler(request)
+
+        if capture.expired():
+            stop(capture, EXPIRED)
+            return handler(request)
+
+        route = route_name(request)
+        if route.startswith("profile") or not capture.wants(route):
+            return handler(request)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(handler, request)
+
+        finally:
+            if capture.add(profile):
+                stop(capture)
+
+    return profiling_tween
+
+
+def admin_only(request):
+    """Raise HTTPForbidden unless the request has the admin token."""
+    admin_token = __config['admin_token']
+    given = request.headers.get(ADMIN_TOKEN_HEADER) or ""
+
+    def as_bytes(text):
+        return text.encode('utf-8') if isinstance(text, unicode) else text
+
+    # Compared in constant time so the token can't be guessed by timing:
+    if not admin_token or not hmac.compare_digest(
+        as_bytes(given), as_bytes(admin_token)
+    ):
+        raise HTTPForbidden("The admin token is missing or wrong.")
+
+
+@view_config(route_name='profile', request_method='POST', renderer='json')
+def profile_start(request):
+    """Profile the next requests handled by this worker.
+
+    The JSON body is::
+
+        dict(
+            requests=<count>,
+            # Optional, only capture requests to this route:
+            route="<route name>",
+            # Optional, the seconds to capture for, DEFAULT_TIMEOUT by
+            # default and at most MAX_TIMEOUT:
+            timeout=<seconds>,
+        )
+
+    :returns: The capture details including its 'capture_id'.
+
+    """
+    admin_only(request)
+    data = request.json_body
+    requests = int(data.get('requests', 10))
+    timeout = float(data.get('timeout') or DEFAULT_TIMEOUT)
+    if requests < 1 or not 0 < timeout <= MAX_TIMEOUT:
+        raise ValueError(
+            "The requests must be 1 or more and the timeout 0 to {}.".format(
+                MAX_TIMEOUT
+            )
+        )
+
+    capture = start(requests, data.get('route'), timeout)
+    get_log("profile_start").warn(
+        "capturing the next '{}' requests as '{}'.".format(
+            requests, capture.id
+        )
+    )
+    return capture.details()
+
+
+@view_config(
+    route_name='profile-status', request_method='GET', renderer='json'
+)
+def profile_status(request):
+    """Return the capture details, 'done' is True once it can be fetched.
+    """
+    admin_only(request)
+    capture_id = request.matchdict['capture_id']
+    if not capture_id.isalnum():
+        raise HTTPNotFound("No capture '{}'.".format(capture_id))
+
+    path = path_for(capture_id, "json")
+    if os.path.isfile(path):
+        with open(path) as fd:
+            return json.loads(fd.read())
+
+    capture = __capture
+    if capture is not None and capture.id == capture_id:
+        if capture.expired():
+            stop(capture, EXPIRED)
+        return capture.details()
+
+    # Another worker may be capturing it:
+    return dict(capture_id=capture_id, done=False)
+
+
+@view_config(
+    route_name='profile-status', request_method='DELETE', renderer='json'
+)
+def profile_cancel(request):
+    """End a capture in progress, saving the requests captured so far.
+
+    The capture can only be cancelled by the worker making it. Others
+    return its details as profile_status() does.
+
+    :returns: The capture details.
+
+    """
+    admin_only(request)
+    capture_id = request.matchdict['capture_id']
+    capture = __capture
+    if capture is not None and capture.id == capture_id:
+        if stop(capture, CANCELLED):
+            get_log("profile_cancel").warn(
+                "capture '{}' cancelled.".format(capture_id)
+            )
+        return capture.details()
+
+    return profile_status(request)
+
+
+@view_config(route_name='profile-download', request_method='GET')
+def profile_download(request):
+    """Download one of a done capture's files."""
+    admin_only(request)
+    capture_id = request.matchdict['capture_id']
+    kind = request.matchdict['kind']
+    if kind not in KINDS or not capture_id.isalnum() or (
+        not os.path.isfile(path_for(capture_id, kind))
+    ):
+        raise HTTPNotFound("No '{}' for capture '{}'.".format(
+            kind, capture_id
+        ))
+
+    with open(path_for(capture_id, kind), "rb") as fd:
+        body = fd.read()
+
+    return Response(
+        body=body,
+        content_type='application/octet-stream',
+        content_disposition='attachment; filename="{}.{}"'.format(
+            capture_id, kind
+        ),
+    )
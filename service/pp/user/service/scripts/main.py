@@ -1,6 +1,120 @@
 # -*- coding: utf-8 -*-
 """
+The production serving entry point for the user service.
+
+This runs the service from its Pyramid ini file with gunicorn worker
+processes each serving requests from a number of threads::
+
+    user-service --workers 4 --threads 8 production.ini
+
+The [server:main] host and port are used to bind to unless --bind is given.
+Send the master process a HUP to gracefully reload the workers, or a TERM
+to gracefully shut down.
+
 """
-def main():
-    """
+import logging
+import argparse
+import ConfigParser
+import multiprocessing
+
+from gunicorn.app.base import BaseApplication
+from pyramid.paster import get_app
+from pyramid.paster import setup_logging
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+class UserServiceApplication(BaseApplication):
+    """Serve the Pyramid app from the given ini with gunicorn."""
+
+    def __init__(self, config_uri, options):
+        """
+        :param config_uri: The path of the Pyramid ini file.
+
+        :param options: A dict of gunicorn settings e.g. workers, threads.
+
+        """
+        self.config_uri = config_uri
+        self.options = options
+        super(UserServiceApplication, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        return get_app(self.config_uri, 'main')
+
+
+def server_bind(config_uri):
+    """Recover the host:port from the [server:main] section of the ini.
+
+    :returns: A "host:port" string or None if not configured.
+
     """
+    config = ConfigParser.ConfigParser()
+    config.read(config_uri)
+    if not config.has_section('server:main'):
+        return None
+
+    server = dict(config.items('server:main'))
+    return "{}:{}".format(
+        server.get('host', '127.0.0.1'), server.get('port', 16801)
+    )
+
+
+def options_from(args):
+    """Return the gunicorn settings from the parsed command line."""
+    return dict(
+        bind=args.bind or server_bind(args.config_uri),
+        workers=args.workers,
+        threads=args.threads,
+        worker_class='gthread' if args.threads > 1 else 'sync',
+        timeout=args.timeout,
+        graceful_timeout=args.graceful_timeout,
+        max_requests=args.max_requests,
+        max_requests_jitter=args.max_requests // 10,
+        # The app is loaded in each worker so no mongodb connection or
+        # worker pool is made before forking:
+        preload_app=False,
+    )
+
+
+def main(argv=None):
+    """user-service main script as set up in the 'setup.py'."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument('config_uri', help='The service ini file.')
+    parser.add_argument(
+        '--bind', default=None,
+        help='The host:port to listen on, [server:main] by default.'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=multiprocessing.cpu_count(),
+        help='The number of worker processes, one per CPU by default.'
+    )
+    parser.add_argument(
+        '--threads', type=int, default=4,
+        help='The number of threads serving requests in each worker.'
+    )
+    parser.add_argument(
+        '--timeout', type=int, default=30,
+        help='The seconds a silent worker has before being restarted.'
+    )
+    parser.add_argument(
+        '--graceful-timeout', type=int, default=30,
+        help='The seconds workers have to finish requests on reload.'
+    )
+    parser.add_argument(
+        '--max-requests', type=int, default=0,
+        help='Restart a worker after this many requests, 0 for never.'
+    )
+    args = parser.parse_args(argv)
+
+    setup_logging(args.config_uri)
+    get_log("main").info("serving <{}>".format(args.config_uri))
+
+    UserServiceApplication(args.config_uri, options_from(args)).run()
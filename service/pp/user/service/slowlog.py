@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Log the requests which are slow or make too many MongoDB round trips.
+
+The MongoDB round trips of every request are accounted for, see
+pp.user.model.accounting. A request crossing either threshold is logged as
+a warning to the 'pp.user.service.slowlog' logger with the query shape,
+documents and bytes of each round trip::
+
+    slowlog.request_ms = 250
+    slowlog.round_trips = 10
+
+    # Yes to also measure the bytes, which re-encodes each command and
+    # reply so is off by default:
+    slowlog.measure_bytes = no
+
+"""
+import json
+import logging
+
+from pp.user.model import accounting
+from pp.user.service import metrics
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+# The thresholds, see configure():
+__config = dict(request_ms=250.0, round_trips=10, measure_bytes=False)
+
+ROUND_TRIPS = metrics.registry.histogram(
+    "userservice_request_mongo_round_trips",
+    "MongoDB round trips made serving each request by route.",
+    ("route",),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+
+
+def configure(settings):
+    """Set the thresholds from the slowlog.* settings."""
+    __config.update(
+        request_ms=float(settings.get("slowlog.request_ms", 250)),
+        round_trips=int(settings.get("slowlog.round_trips", 10)),
+        measure_bytes=settings.get(
+            "slowlog.measure_bytes", "no"
+        ).strip().lower() in ("yes", "true", "1"),
+    )
+
+
+def is_slow(usage):
+    """Return True if the request's usage crossed a threshold."""
+    return (
+        usage.duration * 1000 >= __config['request_ms'] or
+        usage.round_trips >= __config['round_trips']
+    )
+
+
+def tween_factory(handler, pyramid_registry):
+    """Account for each request's round trips and log the slow ones."""
+    log = get_log()
+
+    def finished(request, usage, status):
+        route = metrics.route_name(request)
+        ROUND_TRIPS.observe(usage.round_trips, (route,))
+        if is_slow(usage):
+            found = usage.summary()
+            found.update(
+                route=route,
+                method=request.method,
+                path=request.path,
+                status=status,
+            )
+            log.warn("slow request: {}".format(json.dumps(found)))
+
+    def slowlog_tween(request):
+        response = None
+        try:
+            with accounting.track(__config['measure_bytes']) as usage:
+                response = handler(request)
+            return response
+
+        finally:
+            status = response.status_code if response is not None else 500
+            finished(request, usage, status)
+
+    return slowlog_tween
@@ -80,6 +80,7 @@ class ServerRunner(object):
         self.mongo_host = config.get('mongo_host', '127.0.0.1')
         self.mongo_port = config.get('mongo_port', 27017)
         self.mongo_dbname = config.get('mongo_dbname', 'testing')
+        self.ready_timeout = config.get('ready_timeout', 2)
 
         self.URI = "http://%s:%s" % (self.interface, self.port)
 
@@ -90,8 +91,18 @@ class ServerRunner(object):
         # Get template in the tests dir:
         self.temp_config = os.path.join(self.test_dir, 'test_cfg.ini')
 
-        # The service to run with the rendered configuration:
-        self.cmd = "pserve {}".format(self.temp_config)
+        # The spans of every request are appended here:
+        self.trace_file = os.path.join(self.test_dir, 'spans.json')
+
+        # The token and directory for profiling requests:
+        self.admin_token = config.get('admin_token', uuid.uuid4().hex)
+        self.profile_dir = os.path.join(self.test_dir, 'profiles')
+
+        # The service to run with the rendered configuration. A different
+        # command can be given with '{config}' where the ini path goes:
+        self.cmd = config.get('cmd', 'pserve {config}').format(
+            config=self.temp_config
+        )
 
         self.test_cfg = resource_string(__name__, 'test_cfg.ini.template')
         cfg_tmpl = Template(self.test_cfg)
@@ -101,6 +112,9 @@ class ServerRunner(object):
             mongo_host=self.mongo_host,
             mongo_port=self.mongo_port,
             mongo_dbname=self.mongo_dbname,
+            trace_file=self.trace_file,
+            admin_token=self.admin_token,
+            profile_dir=self.profile_dir,
         )
         self.log.info('ServerRunner template config: {}'.format(data))
         data = cfg_tmpl.substitute(data)
@@ -121,7 +135,9 @@ class ServerRunner(object):
     def cleanup(self):
         """Clean up temp files and directories.
         """
-        for f in [self.temp_config]:
+        for f in [self.temp_config, self.trace_file]:
+            if not os.path.exists(f):
+                continue
             try:
                 os.remove(f)
             except OSError:
@@ -156,7 +172,7 @@ class ServerRunner(object):
             raise SystemError("%s did not start!" % self.cmd)
 
         #self.log.debug("start: waiting for '%s' readiness." % self.URI)
-        net.wait_for_ready(self.URI + "/ping", timeout=2)
+        net.wait_for_ready(self.URI + "/ping", timeout=self.ready_timeout)
 
         return pid
 
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Test the client's opt-in read through cache of users and secrets.
+
+"""
+import time
+
+from pp.user.client import cache
+from pp.user.client.user import UserManagement
+
+
+class Clock(object):
+    """A clock the tests move forward by hand."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_states():
+    """Test entries are fresh, then stale, then missing.
+    """
+    clock = Clock()
+    ttl_cache = cache.TTLCache(max_size=2, ttl=10, stale_ttl=5, clock=clock)
+
+    assert ttl_cache.lookup('a') == (cache.MISSING, None)
+    ttl_cache.set('a', 1)
+    assert ttl_cache.lookup('a') == (cache.FRESH, 1)
+
+    clock.now += 12
+    assert ttl_cache.lookup('a') == (cache.STALE, 1)
+
+    clock.now += 5
+    assert ttl_cache.lookup('a') == (cache.MISSING, None)
+
+    # The least recently used is evicted when full:
+    ttl_cache.set('a', 1)
+    ttl_cache.set('b', 2)
+    ttl_cache.lookup('a')
+    ttl_cache.set('c', 3)
+    assert ttl_cache.peek('b') is None
+
+    # A value fetched before a discard isn't stored:
+    marker = ttl_cache.marker()
+    ttl_cache.discard('a')
+    ttl_cache.set('a', "old", marker)
+    assert ttl_cache.peek('a') is None
+
+    stats = ttl_cache.stats()
+    assert stats['hits'] == 2
+    assert stats['stale_hits'] == 1
+    assert stats['misses'] == 2
+    assert stats['evictions'] == 1
+    assert stats['hit_rate'] == 0.6
+
+
+def test_ttl_cache_revalidate():
+    """Test a stale entry is refreshed once in the background.
+    """
+    clock = Clock()
+    ttl_cache = cache.TTLCache(max_size=10, ttl=10, stale_ttl=60, clock=clock)
+    ttl_cache.set('a', 1)
+    clock.now += 20
+
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.2)
+        return 2
+
+    ttl_cache.revalidate('a', fetch)
+    ttl_cache.revalidate('a', fetch)
+    for i in range(50):
+        if ttl_cache.stats()['refreshes']:
+            break
+        time.sleep(0.1)
+
+    assert calls == [1]
+    assert ttl_cache.lookup('a') == (cache.FRESH, 2)
+
+
+def test_cached_user_management(logger, mongodb, user_svc):
+    """Test the client answers from its cache and forgets what it changes.
+    """
+    token = "3c2e8a9ad6184a0c8ce0bdd6a3c39f6a"
+    user_svc.api.user.add(dict(
+        username="bob",
+        password="11amb",
+        email="bob@example.net",
+        tokens={token: dict(access_secret="secret")},
+    ))
+
+    ttl_cache = cache.TTLCache(max_size=100, ttl=60)
+    with UserManagement(user_svc.URI, cache=ttl_cache) as api:
+        bob = api.get("bob")
+        bob['display_name'] = "Changed by the caller"
+        assert api.get("bob")['display_name'] != "Changed by the caller"
+        assert api.secret_for_access_token(token) == "secret"
+        assert api.secret_for_access_token(token) == "secret"
+        assert ttl_cache.stats()['hits'] == 2
+
+        # Unknown tokens aren't cached so they are seen once added:
+        assert api.secret_for_access_token("unknown") is None
+        assert ttl_cache.peek(('secret', "unknown")) is None
+
+        # Changes through another client are seen once the TTL expires:
+        user_svc.api.user.update(dict(username="bob", display_name="Bob"))
+        assert api.get("bob").get('display_name') != "Bob"
+
+        # Changes through this one are seen straight away:
+        api.update(dict(
+            username="bob",
+            display_name="Robert",
+            tokens={token: dict(access_secret="changed")},
+        ))
+        assert api.get("bob")['display_name'] == "Robert"
+        assert api.secret_for_access_token(token) == "changed"
+
+        api.remove("bob")
+        assert api.secret_for_access_token(token) is None
+        assert ttl_cache.peek(('user', "bob")) is None
+
+        assert 0.0 < ttl_cache.stats()['hit_rate'] < 1.0
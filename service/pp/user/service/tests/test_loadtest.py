@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Test the REST load test harness and its regression comparison.
+
+"""
+from pp.user.service import loadtest
+
+
+def result(rps=100.0, p95_ms=10.0, errors=0):
+    return dict(routes=dict(get=dict(
+        count=1000, errors=errors, rps=rps, p50_ms=5.0, p95_ms=p95_ms,
+        p99_ms=20.0, max_ms=30.0, histogram=[],
+    )))
+
+
+def test_compare():
+    """Test only changes worse than the threshold are regressions.
+    """
+    baseline = result()
+    assert loadtest.compare(baseline, result()) == []
+    assert loadtest.compare(baseline, result(rps=95.0, p95_ms=10.5)) == []
+
+    # Faster is never a regression:
+    assert loadtest.compare(baseline, result(rps=200.0, p95_ms=1.0)) == []
+
+    regressions = loadtest.compare(baseline, result(rps=80.0, errors=5))
+    assert [(r['route'], r['metric']) for r in regressions] == [
+        ('get', 'rps'), ('get', 'error_rate'),
+    ]
+    assert regressions[0]['change'] == -0.2
+
+    assert loadtest.compare(baseline, result(p95_ms=12.0)) != []
+    assert loadtest.compare(baseline, result(p95_ms=12.0), 0.5) == []
+
+
+def test_histogram_and_mix():
+    """Test the latency buckets and route mix parsing.
+    """
+    counts = loadtest.histogram([0.0005, 0.001, 0.003, 0.250, 9.0])
+    assert sum(bucket['count'] for bucket in counts) == 5
+    assert counts[0] == dict(le_ms=1, count=2)
+    assert counts[2] == dict(le_ms=5, count=1)
+    assert counts[-1] == dict(le_ms=None, count=1)
+
+    assert loadtest.parse_mix("get=3, auth=1") == dict(get=3, auth=1)
+
+
+def test_load_test_run(logger):
+    """Test a short load test against a running service.
+    """
+    results = loadtest.run(
+        clients=4, requests=200, users=50, ready_timeout=10,
+    )
+
+    assert sorted(results['routes']) == ['auth', 'get', 'secret', 'users']
+    assert sum(
+        route['count'] for route in results['routes'].values()
+    ) == 200
+    for route in results['routes'].values():
+        assert route['errors'] == 0
+        assert route['rps'] > 0
+        assert route['p50_ms'] <= route['p95_ms'] <= route['p99_ms']
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Test the request and MongoDB metrics and the /metrics route.
+
+"""
+from timeit import default_timer
+from urlparse import urljoin
+
+import requests
+
+from pp.user.service import metrics
+
+
+class FakeRoute(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeRequest(object):
+    method = "GET"
+
+    def __init__(self, route=None):
+        if route:
+            self.matched_route = FakeRoute(route)
+
+
+class FakeResponse(object):
+    status_code = 200
+
+
+def test_registry_render():
+    """Test counters, histograms and gauges in the text format.
+    """
+    registry = metrics.Registry()
+    hits = registry.counter("hits_total", "Hits.", ("route",))
+    took = registry.histogram(
+        "took_seconds", "Took.", ("route",), buckets=(0.1, 1.0)
+    )
+    registry.gauge("size", "Size.", lambda: 3)
+
+    # Registering again returns the same metric:
+    assert registry.counter("hits_total", "Hits.", ("route",)) is hits
+
+    hits.inc(("user",))
+    hits.inc(("user",), 2)
+    took.observe(0.05, ("user",))
+    took.observe(0.5, ("user",))
+    took.observe(5, ("user",))
+
+    assert hits.value(("user",)) == 3
+    assert took.count(("user",)) == 3
+
+    assert registry.render().splitlines() == [
+        u'# HELP hits_total Hits.',
+        u'# TYPE hits_total counter',
+        u'hits_total{route="user"} 3',
+        u'# HELP size Size.',
+        u'# TYPE size gauge',
+        u'size 3',
+        u'# HELP took_seconds Took.',
+        u'# TYPE took_seconds histogram',
+        u'took_seconds_bucket{route="user",le="0.1"} 1',
+        u'took_seconds_bucket{route="user",le="1.0"} 2',
+        u'took_seconds_bucket{route="user",le="+Inf"} 3',
+        u'took_seconds_sum{route="user"} 5.55',
+        u'took_seconds_count{route="user"} 3',
+    ]
+
+
+def test_tween():
+    """Test requests are timed by route and counted by status.
+    """
+    def handler(request):
+        return FakeResponse()
+
+    def broken(request):
+        raise ValueError("boom")
+
+    tween = metrics.tween_factory(handler, None)
+    before = metrics.REQUESTS.value(("user", "GET", 200))
+    tween(FakeRequest("user-1"))
+    assert metrics.REQUESTS.value(("user", "GET", 200)) == before + 1
+
+    before = metrics.REQUESTS.value(("notfound", "GET", 500))
+    try:
+        metrics.tween_factory(broken, None)(FakeRequest())
+    except ValueError:
+        pass
+    assert metrics.REQUESTS.value(("notfound", "GET", 500)) == before + 1
+
+
+def test_tween_overhead():
+    """Test the tween adds no more than a few microseconds per request.
+    """
+    def handler(request):
+        return response
+
+    response = FakeResponse()
+    request = FakeRequest("user")
+    tween = metrics.tween_factory(handler, None)
+    calls = 20000
+
+    started = default_timer()
+    for i in xrange(calls):
+        handler(request)
+    bare = default_timer() - started
+
+    started = default_timer()
+    for i in xrange(calls):
+        tween(request)
+    timed = default_timer() - started
+
+    overhead_us = (timed - bare) / calls * 1e6
+    assert overhead_us < 10
+
+
+def test_metrics_restapi(logger, mongodb, user_svc):
+    """Test /metrics reports the requests made and the MongoDB commands.
+    """
+    user_svc.api.user.add(dict(
+        username="bob",
+        password="11amb",
+        email="bob@example.net",
+    ))
+    user_svc.api.user.get("bob")
+    assert user_svc.api.user.secret_for_access_token("none") is None
+
+    res = requests.get(urljoin(user_svc.URI, "/metrics"))
+    assert res.status_code == 200
+    assert res.headers['content-type'].startswith("text/plain")
+    assert "version=0.0.4" in res.headers['content-type']
+
+    body = res.text
+    assert (
+        'userservice_requests_total{route="user",method="GET",status="200"} 1'
+    ) in body
+    for route in ["the_users", "user", "user-secret"]:
+        assert (
+            'userservice_request_duration_seconds_count{{route="{}"}}'.format(
+                route
+            )
+        ) in body
+    assert 'userservice_mongo_commands_total{command="find",' in body
+    assert 'userservice_mongo_commands_total{command="insert",' in body
+    assert 'userservice_mongo_command_duration_seconds_bucket{' in body
+    assert 'userservice_secret_cache_size ' in body
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Test on-demand profiling of the running service.
+
+"""
+import os
+import json
+import time
+import pstats
+
+import pytest
+
+from pp.user.validate import error
+
+
+def test_profile_is_admin_only(logger, mongodb, user_svc):
+    """Test a capture can't be started without the admin token.
+    """
+    with pytest.raises(error.CommunicationError):
+        user_svc.api.profile("wrong-token", requests=1)
+
+    with pytest.raises(error.CommunicationError):
+        user_svc.api.profile_status("wrong-token", "abc")
+
+
+def test_profile_route(logger, mongodb, user_svc):
+    """Test the next requests to a route are profiled and downloaded.
+    """
+    token = user_svc.admin_token
+    user_svc.api.user.add(dict(
+        username="bob",
+        password="11amb",
+        email="bob@example.net",
+    ))
+
+    details = user_svc.api.profile(token, requests=3, route="user")
+    capture_id = details['capture_id']
+    assert details['done'] is False
+
+    # A second capture can't start while one is in progress:
+    with pytest.raises(error.CommunicationError):
+        user_svc.api.profile(token, requests=1)
+
+    # Other routes aren't captured:
+    user_svc.api.user.all()
+    status = user_svc.api.profile_status(token, capture_id)
+    assert status['captured'] == 0
+
+    for i in range(3):
+        user_svc.api.user.get("bob")
+
+    details = user_svc.api.profile_wait(token, capture_id, timeout=10)
+    assert details['captured'] == 3
+    assert "pstats" in details['files']
+    assert "memory" in details['files']
+
+    path = os.path.join(user_svc.test_dir, "downloaded.pstats")
+    with open(path, "wb") as fd:
+        fd.write(user_svc.api.profile_download(token, capture_id, "pstats"))
+    functions = [
+        name for (filename, line, name) in pstats.Stats(path).stats
+    ]
+    assert "user_get" in functions
+    assert "the_users" not in functions
+    os.remove(path)
+
+    memory = json.loads(
+        user_svc.api.profile_download(token, capture_id, "memory")
+    )
+    assert memory['max_rss_kb_after'] >= memory['max_rss_kb_before']
+
+    with pytest.raises(error.CommunicationError):
+        user_svc.api.profile_download(token, capture_id, "passwd")
+
+
+def test_profile_cancel_and_expiry(logger, mongodb, user_svc):
+    """Test a capture ends when cancelled or timed out without traffic.
+    """
+    token = user_svc.admin_token
+
+    details = user_svc.api.profile(token, requests=5, route="user")
+    details = user_svc.api.profile_cancel(token, details['capture_id'])
+    assert details['done'] is True
+    assert details['ended'] == "cancelled"
+
+    # A capture of a route with no traffic doesn't block the next one:
+    details = user_svc.api.profile(
+        token, requests=5, route="user", timeout=0.5
+    )
+    time.sleep(1)
+    status = user_svc.api.profile_status(token, details['capture_id'])
+    assert status['done'] is True
+    assert status['ended'] == "expired"
+
+    details = user_svc.api.profile(token, requests=1, timeout=60)
+    user_svc.api.profile_cancel(token, details['capture_id'])
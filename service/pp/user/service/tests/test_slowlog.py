@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Test the slow request log and the per request round trip counts.
+
+"""
+import json
+import logging
+from urlparse import urljoin
+
+import requests
+
+from pp.user.model import user
+from pp.user.service import slowlog
+
+
+class FakeRoute(object):
+    name = "user-1"
+
+
+class FakeRequest(object):
+    method = "GET"
+    path = "/user/bob/"
+    matched_route = FakeRoute()
+
+
+class FakeResponse(object):
+    status_code = 200
+
+
+class Recorded(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_slow_requests_are_logged(logger, mongodb):
+    """Test only requests crossing a threshold are logged with shapes.
+    """
+    user.add(username='bob', password='11amcoke', email='bob@example.net')
+
+    def handler(request):
+        user.get('bob')
+        user.has('bob')
+        return FakeResponse()
+
+    recorded = Recorded()
+    logging.getLogger(slowlog.__name__).addHandler(recorded)
+    try:
+        tween = slowlog.tween_factory(handler, None)
+
+        slowlog.configure({
+            "slowlog.request_ms": "10000", "slowlog.round_trips": "3",
+        })
+        tween(FakeRequest())
+        assert recorded.messages == []
+
+        slowlog.configure({
+            "slowlog.request_ms": "10000", "slowlog.round_trips": "2",
+        })
+        tween(FakeRequest())
+        assert len(recorded.messages) == 1
+
+    finally:
+        logging.getLogger(slowlog.__name__).removeHandler(recorded)
+        slowlog.configure({})
+
+    message = recorded.messages[0]
+    assert message.startswith("slow request: ")
+    found = json.loads(message[len("slow request: "):])
+    assert found['route'] == "user"
+    assert found['status'] == 200
+    assert found['round_trips'] == 2
+    assert found['docs_returned'] == 2
+    assert found['bytes_received'] > 0
+    assert [c['shape'] for c in found['commands']] == [
+        'find everyone {"username": "?"}',
+        'find everyone {"username": "?"}',
+    ]
+
+
+def test_round_trips_restapi(logger, mongodb, user_svc):
+    """Test each request's round trips are in the /metrics histogram.
+    """
+    user_svc.api.user.add(dict(
+        username="bob",
+        password="11amb",
+        email="bob@example.net",
+    ))
+    user_svc.api.user.get("bob")
+
+    body = requests.get(urljoin(user_svc.URI, "/metrics")).text
+    assert (
+        'userservice_request_mongo_round_trips_bucket'
+        '{route="user",le="1"} 1'
+    ) in body
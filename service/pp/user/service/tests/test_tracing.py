@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Test a trace is carried from the client through the service into MongoDB.
+
+"""
+from pp.user.validate import tracing
+from pp.user.validate.tracing import FileExporter
+from pp.user.validate.tracing import InMemoryExporter
+
+
+def test_authenticate_is_traced_end_to_end(logger, mongodb, user_svc):
+    """Test the client, middleware, view, hashing and MongoDB spans join up.
+    """
+    user_svc.api.user.add(dict(
+        username="bob",
+        password="11amb",
+        email="bob@example.net",
+    ))
+
+    exporter = InMemoryExporter()
+    tracing.configure(sample_rate=1.0, exporter=exporter)
+    try:
+        assert user_svc.api.user.authenticate("bob", "11amb") is True
+    finally:
+        tracing.configure()
+
+    client = dict((span['name'], span) for span in exporter.spans)
+    assert sorted(client) == [
+        "UserManagement.authenticate", "client POST /access/auth/bob/",
+    ]
+    call = client["client POST /access/auth/bob/"]
+    assert call['parent_id'] == (
+        client["UserManagement.authenticate"]['span_id']
+    )
+    assert call['attributes']['status'] == 200
+
+    # The service's spans for the request are in the same trace:
+    spans = [
+        span for span in FileExporter(user_svc.trace_file).read()
+        if span['trace_id'] == call['trace_id']
+    ]
+    service = dict((span['name'], span) for span in spans)
+
+    # Each layer is a child of the one wrapping it:
+    chain = [
+        "JSONErrorHandler", "HttpMethodOverrideMiddleware",
+        "pp_auth_middleware", "pyramid", "view user-auth",
+    ]
+    assert service[chain[0]]['parent_id'] == call['span_id']
+    for outer, inner in zip(chain, chain[1:]):
+        assert service[inner]['parent_id'] == service[outer]['span_id']
+    assert service["view user-auth"]['attributes']['status'] == 200
+
+    view = service["view user-auth"]['span_id']
+    assert service["pwpool.validate"]['parent_id'] == view
+    assert service["pwpool.validate"]['attributes']['passwords'] == 1
+    assert service["mongo find"]['parent_id'] == view
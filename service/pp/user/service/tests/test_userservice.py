@@ -5,10 +5,16 @@ Integration Test verifing the client REST interface against the service.
 PythonPro Limited
 
 """
+import json
+import time
+import logging
+
 import pkg_resources
 import pytest
+import requests
 
 from pp.auth import pwtools
+from pp.user.validate import error
 from pp.user.validate import userdata
 
 
@@ -77,6 +83,48 @@ def test_RestClientPing(logger, mongodb, user_svc):
     assert report['name'] == 'pp-user-service'
     assert report['version'] == pkg.version
 
+    # The access secret cache counters are reported:
+    assert report['secret_cache']['max_size'] == 10000
+    for counter in ['size', 'hits', 'misses', 'evictions']:
+        assert counter in report['secret_cache']
+
+
+def test_pooled_connections(logger, mongodb, user_svc):
+    """Test the client reuses its connection rather than one per call.
+
+    The calls/sec with and without the pooled session are logged as a
+    benchmark of the difference.
+
+    """
+    from pp.user.client.rest import UserService
+
+    log = logging.getLogger("test_pooled_connections")
+    calls = 200
+
+    with UserService(uri=user_svc.URI) as api:
+        # The service and its user management share the one session:
+        assert api.user.session is api.session
+
+        started = time.time()
+        for i in range(calls):
+            api.user.secret_for_access_token('a fake token')
+        pooled = calls / (time.time() - started)
+
+        # All the calls went over a single kept alive connection:
+        pools = api.session.get_adapter(user_svc.URI).poolmanager.pools
+        connections = [pools[key].num_connections for key in pools.keys()]
+        assert connections == [1]
+
+    uri = "{}/access/secret/a fake token/".format(user_svc.URI)
+    started = time.time()
+    for i in range(calls):
+        requests.get(uri)
+    unpooled = calls / (time.time() - started)
+
+    log.info("calls/sec pooled: {:.1f} connection per call: {:.1f}".format(
+        pooled, unpooled
+    ))
+
 
 def test_UserLoadingAndDumping(logger, mongodb, user_svc):
     """Test the rest client's ping of the user service.
@@ -137,6 +185,94 @@ def test_UserLoadingAndDumping(logger, mongodb, user_svc):
     assert item1['phone'] == user_dict['phone']
 
 
+def test_streaming_dump(logger, mongodb, user_svc):
+    """Test the newline-delimited JSON dump of the user universe.
+    """
+    assert list(user_svc.api.dump(stream=True)) == []
+
+    data = [
+        {
+            "username": "user{}".format(i),
+            "_id": "user-{}".format(i),
+            "email": "user{}@example.net".format(i),
+            "password_hash": pwtools.hash_password('11amcoke'),
+        }
+        for i in range(5)
+    ]
+    user_svc.api.load(data)
+
+    dumped = list(user_svc.api.dump(stream=True))
+    assert dumped == user_svc.api.dump()
+    assert [u['_id'] for u in dumped] == [u['_id'] for u in data]
+
+    # The same with no gzip compression:
+    assert list(user_svc.api.dump(stream=True, compress=False)) == dumped
+
+    # Dump only part of the '_id' range:
+    dumped = user_svc.api.dump(stream=True, after="user-1", before="user-4")
+    assert [u['_id'] for u in dumped] == ["user-2", "user-3"]
+
+
+def test_streaming_load(logger, mongodb, user_svc):
+    """Test loading the user universe as newline-delimited JSON chunks.
+    """
+    password_hash = pwtools.hash_password('11amcoke')
+    data = (
+        {
+            "username": "user{}".format(i),
+            "_id": "user-{}".format(i),
+            "email": "user{}@example.net".format(i),
+            "password_hash": password_hash,
+        }
+        for i in range(5)
+    )
+
+    report = user_svc.api.load(data, stream=True, batch_size=2)
+    assert report == dict(batches=3, loaded=5, errors=0)
+    assert len(user_svc.api.user.all()) == 5
+
+    # A dump can be streamed straight back in:
+    report = user_svc.api.load(user_svc.api.dump(stream=True), stream=True)
+    assert report == dict(batches=1, loaded=5, errors=0)
+    assert len(user_svc.api.user.all()) == 5
+
+
+def test_user_paging(logger, mongodb, user_svc):
+    """Test recovering the users a page at a time with filters and fields.
+    """
+    data = [
+        {
+            "username": "user{}".format(i),
+            "_id": "user-{}".format(i),
+            "email": "user{}@example.net".format(i),
+            "team": "odd" if i % 2 else "even",
+            "password_hash": pwtools.hash_password('11amcoke'),
+        }
+        for i in range(5)
+    ]
+    user_svc.api.load(data)
+
+    page = user_svc.api.user.page(limit=2)
+    assert [u['_id'] for u in page['users']] == ["user-0", "user-1"]
+    assert page['after'] == "user-1"
+
+    found = list(user_svc.api.user.iter_all(page_size=2))
+    assert [u['_id'] for u in found] == [u['_id'] for u in data]
+
+    found = list(user_svc.api.user.iter_all(
+        page_size=1, fields=['username'], team='odd'
+    ))
+    assert found == [
+        dict(_id="user-1", username="user1"),
+        dict(_id="user-3", username="user3"),
+    ]
+
+    # Query operators can't be given as filters:
+    for name in ["$where", "$ne", "extra.team"]:
+        with pytest.raises(userdata.UserServiceError):
+            user_svc.api.user.page(limit=2, **{name: "1"})
+
+
 def test_existing_username(logger, mongodb, user_svc):
     """Test that a username must be unique for created accounts.
     """
@@ -195,6 +331,167 @@ def test_password_change(logger, mongodb, user_svc):
     assert user_svc.api.user.authenticate(username, new_plain_pw) is True
 
 
+def test_authenticate_many(logger, mongodb, user_svc):
+    """Test verifying many users' passwords in one request.
+    """
+    for username in ['bob', 'fred']:
+        user_svc.api.user.add(dict(
+            username=username,
+            password="{}-password".format(username),
+            email="{}@example.com".format(username),
+        ))
+
+    results = user_svc.api.user.authenticate_many([
+        ("fred", "fred-password"),
+        ("bob", "not bob's password"),
+        ("unknown", "fred-password"),
+        ("bob", "bob-password"),
+    ])
+    assert results == [True, False, False, True]
+
+    assert user_svc.api.user.authenticate_many([]) == []
+
+    # Requests of many credentials are sent in chunks:
+    results = user_svc.api.user.authenticate_many(
+        [("fred", "fred-password"), ("bob", "wrong"), ("bob", "bob-password")],
+        chunk_size=2,
+    )
+    assert results == [True, False, True]
+
+    # A bad item is reported without failing the others:
+    from urlparse import urljoin
+    uri = urljoin(user_svc.URI, "/access/auth/batch/")
+    res = requests.post(uri, json.dumps([
+        dict(username="bob", password="bob-password".encode("base64")),
+        dict(username="fred", password="not base64!"),
+        "bob",
+    ]), headers={'content-type': 'application/json'})
+    found = res.json()['data']
+    assert [item['authenticated'] for item in found] == [True, False, False]
+    assert found[0]['message'] is None
+    assert found[1]['username'] == "fred" and found[1]['message']
+    assert found[2]['message']
+
+    # At most MAX_BATCH can be given:
+    res = requests.post(uri, json.dumps(
+        [dict(username="bob", password="x")] * 1001
+    ), headers={'content-type': 'application/json'})
+    assert res.json()['success'] is False
+
+
+def test_async_client(logger, mongodb, user_svc):
+    """Test the non-blocking client fanning out calls concurrently.
+    """
+    from pp.user.client.asyncuser import gather
+    from pp.user.client.asyncuser import AsyncUserService
+
+    usernames = ["user{}".format(i) for i in range(10)]
+
+    with AsyncUserService(uri=user_svc.URI, workers=5) as api:
+        assert api.ping().get()['data']['status'] == 'ok'
+
+        added = gather([
+            api.user.add(dict(
+                username=username,
+                password="{}-password".format(username),
+                email="{}@example.com".format(username),
+            ))
+            for username in usernames
+        ])
+        assert [u['username'] for u in added] == usernames
+
+        found = gather([api.user.get(username) for username in usernames])
+        assert [u['username'] for u in found] == usernames
+
+        assert api.user.authenticate("user1", "user1-password").get() is True
+
+        # The blocking client's errors are raised by get():
+        result = api.user.get("unknown")
+        with pytest.raises(userdata.UserServiceError):
+            result.get()
+
+        # The later calls are offered too:
+        found = api.user.get_many(["user1", "unknown"]).get()
+        assert found['missing'] == ["unknown"]
+
+        results = api.user.add_many([dict(
+            username="user10", password="user10-password",
+            email="user10@example.com",
+        )]).get()
+        assert results[0]['status'] == "added"
+
+        updated = api.user.patch(dict(
+            username="user1", display_name="One",
+        )).get()
+        with pytest.raises(userdata.UserVersionConflictError):
+            api.user.update(
+                dict(username="user1", _id=updated['_id'], phone="1"),
+                expected_version=api.user.version("user1") - 1,
+            ).get()
+
+        found = api.user.changes(since=0, limit=1000).get()
+        assert found['changes'][-1]['op'] == "update"
+
+
+def test_many_workers_stress(logger, mongodb):
+    """Test the multi-process, multi-threaded service under concurrent load.
+    """
+    import threading
+    from pp.user.client.rest import UserService
+    from pp.user.service.tests.conftest import ServerRunner
+
+    server = ServerRunner(dict(
+        interface='127.0.0.1',
+        mongo_port=mongodb.port,
+        mongo_host=mongodb.host,
+        mongo_dbname=mongodb.dbname,
+        cmd="exec user-service --workers 4 --threads 4 {config}",
+        ready_timeout=10,
+    ))
+    server.start()
+
+    clients = 16
+    calls = 10
+    errors = []
+
+    def client(index):
+        username = "user{}".format(index)
+        try:
+            with UserService(uri=server.URI) as api:
+                api.user.add(dict(
+                    username=username,
+                    password="{}-password".format(username),
+                    email="{}@example.com".format(username),
+                ))
+                for i in range(calls):
+                    assert api.user.get(username)['username'] == username
+                    assert api.user.authenticate(
+                        username, "{}-password".format(username)
+                    ) is True
+                    assert api.user.secret_for_access_token("none") is None
+
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        workers = [
+            threading.Thread(target=client, args=(i,))
+            for i in range(clients)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        assert errors == []
+        with UserService(uri=server.URI) as api:
+            assert len(api.user.all()) == clients
+
+    finally:
+        server.stop()
+        server.cleanup()
+
+
 def test_user_management(logger, mongodb, user_svc):
     """Test the REST based interface to add/remove/update users.
     """
@@ -268,3 +565,324 @@ def test_user_management(logger, mongodb, user_svc):
     user_svc.api.user.remove(username)
     with pytest.raises(userdata.UserServiceError):
         user_svc.api.user.remove(username)
+
+
+def test_conditional_get(logger, mongodb, user_svc):
+    """Test the user ETag, 304 revalidation and the client's use of it.
+    """
+    from urlparse import urljoin
+
+    user_svc.api.user.add(dict(
+        username="bob",
+        password="11amb",
+        email="bob@example.net",
+    ))
+    uri = urljoin(user_svc.URI, "/user/bob/")
+
+    res = requests.get(uri)
+    assert res.status_code == 200
+    etag = res.headers['ETag']
+    assert res.json()['data']['username'] == "bob"
+
+    # The internal fields aren't returned, the version is in the ETag:
+    assert "_version" not in res.json()['data']
+    assert "_access_tokens" not in res.json()['data']
+
+    # The same version is served from the rendered body cache:
+    again = requests.get(uri)
+    assert again.headers['ETag'] == etag
+    assert again.content == res.content
+    assert user_svc.api.ping()['body_cache']['hits'] >= 1
+
+    res = requests.get(uri, headers={'If-None-Match': etag})
+    assert res.status_code == 304
+    assert res.content == ""
+
+    # A change is a new version and so a new ETag:
+    user_svc.api.user.update(dict(username="bob", display_name="Bob"))
+    res = requests.get(uri, headers={'If-None-Match': etag})
+    assert res.status_code == 200
+    assert res.headers['ETag'] != etag
+    assert res.json()['data']['display_name'] == "Bob"
+
+    # The client revalidates with the ETag of its last get():
+    api = user_svc.api.user
+    first = api.get("bob")
+    first['display_name'] = "Changed by the caller"
+    assert api.get("bob")['display_name'] == "Bob"
+
+    api.update(dict(username="bob", display_name="Robert"))
+    assert api.get("bob")['display_name'] == "Robert"
+
+    api.remove("bob")
+    with pytest.raises(userdata.UserServiceError):
+        api.get("bob")
+
+    res = requests.get(uri)
+    assert res.json()['success'] is False
+    assert "ETag" not in res.headers
+
+
+def test_update_if_match(logger, mongodb, user_svc):
+    """Test If-Match updates and the client's retry with merge.
+    """
+    from urlparse import urljoin
+
+    api = user_svc.api.user
+    bob = api.add(dict(
+        username="bob",
+        password="11amb",
+        email="bob@example.net",
+    ))
+    uri = urljoin(user_svc.URI, "/user/bob/")
+    etag = requests.get(uri).headers['ETag']
+
+    res = requests.put(
+        uri,
+        json.dumps(dict(username="bob", display_name="Bob")),
+        headers={'If-Match': etag, 'content-type': 'application/json'},
+    )
+    assert res.status_code == 200
+    assert res.headers['ETag'] != etag
+    assert "_version" not in res.json()['data']
+    assert "_access_tokens" not in res.json()['data']
+
+    # The ETag is now out of date:
+    res = requests.put(
+        uri,
+        json.dumps(dict(username="bob", display_name="Rob")),
+        headers={'If-Match': etag, 'content-type': 'application/json'},
+    )
+    assert res.status_code == 412
+    assert res.json()['success'] is False
+    assert api.get("bob")['display_name'] == "Bob"
+
+    with pytest.raises(userdata.UserVersionConflictError):
+        api.update(
+            dict(username="bob", _id=bob['_id'], display_name="Rob"),
+            expected_version=1,
+        )
+
+    updated = api.update(
+        dict(username="bob", _id=bob['_id'], display_name="Rob"),
+        expected_version=2,
+    )
+    assert "_version" not in updated
+    assert api.version("bob") == 3
+
+    # Each retry sees the changes made in between:
+    seen = []
+
+    def rename(current):
+        seen.append(current['email'])
+        if len(seen) == 1:
+            api.update(dict(username="bob", email="rob@example.net"))
+        return dict(display_name=current['display_name'] + "ert")
+
+    updated = api.update_with_retry("bob", rename)
+    assert seen == ["bob@example.net", "rob@example.net"]
+    assert updated['display_name'] == "Robert"
+    assert updated['email'] == "rob@example.net"
+
+
+def test_patch(logger, mongodb, user_svc):
+    """Test the merge patch of a user's fields.
+    """
+    api = user_svc.api.user
+    bob = api.add(dict(
+        username="bob",
+        password="11amb",
+        email="bob@example.net",
+        phone="12121212",
+        extra=dict(role="user", team="a"),
+    ))
+
+    updated = api.patch(dict(
+        username="bob",
+        display_name="Bob",
+        phone=None,
+        extra=dict(role="admin", team=None),
+    ))
+    assert updated['display_name'] == "Bob"
+    assert "phone" not in updated
+    assert updated['extra'] == dict(role="admin")
+    assert updated['email'] == "bob@example.net"
+
+    updated = api.patch(dict(username="bob", new_password="12amcoke"))
+    assert api.authenticate("bob", "12amcoke") is True
+
+    with pytest.raises(userdata.UserVersionConflictError):
+        api.patch(
+            dict(username="bob", _id=bob['_id'], display_name="Rob"),
+            expected_version=1,
+        )
+
+    updated = api.patch(
+        dict(username="bob", _id=bob['_id'], display_name="Rob"),
+        expected_version=api.version("bob"),
+    )
+    assert updated['display_name'] == "Rob"
+
+
+def test_internal_fields_hidden(logger, mongodb, user_svc):
+    """Test the token index and version are in no user returned.
+    """
+    api = user_svc.api.user
+    internal = set(["_access_tokens", "_version"])
+
+    added = api.add(dict(
+        username="bob",
+        password="11amb",
+        email="bob@example.net",
+        tokens={"token1": "secret1"},
+    ))
+    assert api.version("bob") == 1
+
+    found = [
+        added,
+        api.update(dict(username="bob", display_name="Bob")),
+        api.patch(dict(username="bob", phone="12121212")),
+        api.get("bob"),
+    ]
+    found.extend(api.all())
+    found.extend(api.page(limit=10)['users'])
+    found.extend(api.page(fields=["email", "_version"])['users'])
+    found.extend(api.get_many(["bob"])['users'])
+    found.extend(
+        change['user'] for change in api.changes(since=0)['changes']
+    )
+
+    assert len(found) == 11
+    for userdict in found:
+        assert internal.isdisjoint(userdict)
+
+    # The version is given by the ETag instead:
+    assert api.version("bob") == 3
+
+
+def test_changes_feed(logger, mongodb, user_svc):
+    """Test a downstream service can follow the user changes.
+    """
+    import threading
+
+    api = user_svc.api.user
+    assert list(api.iter_changes(follow=False)) == []
+
+    api.add(dict(username="bob", password="11amb", email="bob@a.net"))
+    api.update(dict(username="bob", display_name="Bob"))
+    api.add(dict(username="fred", password="11amb", email="fred@a.net"))
+    api.remove("fred")
+
+    found = list(api.iter_changes(since=0, limit=3, follow=False))
+    assert [(change['op'], change['username']) for change in found] == [
+        ("add", "bob"), ("update", "bob"), ("add", "fred"), ("remove", "fred"),
+    ]
+    assert found[0]['user']['display_name'] == "Bob"
+    assert found[3]['user'] is None
+    last_seq = found[-1]['seq']
+
+    # Resuming from the last seq only returns the later changes:
+    assert list(api.iter_changes(since=last_seq, follow=False)) == []
+
+    # A long poll returns once a change is made:
+    timer = threading.Timer(0.5, lambda: api.update(
+        dict(username="bob", display_name="Robert")
+    ))
+    timer.start()
+    try:
+        found = api.changes(since=last_seq, wait=10)
+    finally:
+        timer.join()
+    assert [change['op'] for change in found['changes']] == ["update"]
+    assert found['last_seq'] == last_seq + 1
+    assert found['reset'] is False
+
+    # Only changes.max_waiters long polls wait at once, others get a 503:
+    waiting = threading.Thread(
+        target=api.changes, kwargs=dict(since=last_seq + 1, wait=2)
+    )
+    waiting.start()
+    try:
+        time.sleep(0.5)
+        with pytest.raises(error.ServiceBusyError):
+            api.changes(since=last_seq + 1, wait=2)
+        # Not waiting is always answered:
+        assert api.changes(since=last_seq + 1)['changes'] == []
+    finally:
+        waiting.join()
+
+
+def test_get_many(logger, mongodb, user_svc):
+    """Test recovering many users in batches preserving their order.
+    """
+    api = user_svc.api.user
+    for username in ["bob", "fred", "sam"]:
+        api.add(dict(
+            username=username,
+            password="11amb",
+            email="{}@example.net".format(username),
+        ))
+
+    found = api.get_many(["sam", "unknown", "BOB", "fred", "sam"])
+    assert [u and u['username'] for u in found['users']] == [
+        "sam", None, "bob", "fred", "sam",
+    ]
+    assert found['missing'] == ["unknown"]
+    assert "password_hash" in found['users'][0]
+
+    # Large lists are asked for in chunks:
+    found = api.get_many(
+        ["bob", "missing1", "fred", "missing2", "sam"],
+        fields=["email"],
+        chunk_size=2,
+    )
+    assert [u and u['email'] for u in found['users']] == [
+        "bob@example.net", None, "fred@example.net", None, "sam@example.net",
+    ]
+    assert found['missing'] == ["missing1", "missing2"]
+    assert "password_hash" not in found['users'][0]
+
+    assert api.get_many([]) == dict(users=[], missing=[])
+
+    # A body of the wrong shape is refused rather than a server error:
+    from urlparse import urljoin
+    uri = urljoin(user_svc.URI, "/users/batch/")
+    for body in [["bob"], dict(usernames="bob"), dict(usernames=[1])]:
+        res = requests.post(
+            uri, json.dumps(body), headers={'content-type': 'application/json'}
+        )
+        assert res.status_code != 500
+        assert res.json()['success'] is False
+
+
+def test_add_many(logger, mongodb, user_svc):
+    """Test adding users in chunks with a result for each.
+    """
+    api = user_svc.api.user
+    api.add(dict(username="bob", password="11amb1", email="bob@a.net"))
+
+    def users():
+        for username in ["fred", "bob", "sam", "tim", "al", "jon"]:
+            yield dict(
+                username=username,
+                password="{}-password".format(username),
+                email="{}@b.net".format(username),
+            )
+
+    progress = []
+    results = api.add_many(
+        users(), chunk_size=2, progress=lambda r: progress.append(len(r))
+    )
+    assert [(r['username'], r['status']) for r in results] == [
+        ("fred", "added"),
+        ("bob", "conflict"),
+        ("sam", "added"),
+        ("tim", "added"),
+        ("al", "invalid"),
+        ("jon", "added"),
+    ]
+    assert progress == [2, 4, 6]
+
+    assert api.get("bob")['email'] == "bob@a.net"
+    assert api.authenticate("fred", "fred-password") is True
+    assert api.get("jon")['_id'] == results[5]['_id']
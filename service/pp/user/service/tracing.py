@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Trace requests through the service's middleware, views and MongoDB calls.
+
+The trace started by the client's traceparent header is continued by the
+outer most middleware. Each middleware layer, the view and every MongoDB
+command then gets its own span, see pp.user.validate.tracing.
+
+The ini settings are::
+
+    # The fraction of requests traced when the caller hasn't sampled:
+    tracing.sample_rate = 0.01
+
+    # none, memory, log, file or a package.module:factory:
+    tracing.exporter = file
+    tracing.file = %(here)s/spans.json
+
+"""
+import logging
+
+from pymongo import monitoring
+
+from pp.user.validate import tracing
+from pp.user.service.metrics import route_name
+
+
+def get_log(extra=None):
+    m = "{}.{}".format(__name__, extra) if extra else __name__
+    return logging.getLogger(m)
+
+
+def configure(settings):
+    """Set up the process's tracer from the tracing.* settings."""
+    exporter = tracing.exporter_from(
+        settings.get("tracing.exporter", "none"),
+        settings.get("tracing.file"),
+    )
+    sample_rate = float(settings.get("tracing.sample_rate", 0.0))
+    tracing.configure(sample_rate=sample_rate, exporter=exporter)
+    get_log("configure").info(
+        "sample_rate '{}' exporter <{}>".format(sample_rate, exporter)
+    )
+
+
+class TracedMiddleware(object):
+    """Time a WSGI app in a span named after it.
+
+    The span covers calling the app, not iterating a streamed response.
+
+    """
+    def __init__(self, app, name):
+        self.app = app
+        self.name = name
+
+    def __call__(self, environ, start_response):
+        traceparent = environ.get(tracing.ENVIRON_KEY)
+        with tracing.start_span(self.name, traceparent) as span:
+            span.set_attribute("method", environ.get("REQUEST_METHOD"))
+            span.set_attribute("path", environ.get("PATH_INFO"))
+            return self.app(environ, start_response)
+
+
+def tween_factory(handler, pyramid_registry):
+    """Time the view and its tweens in a span named after the route."""
+    def tracing_tween(request):
+        with tracing.start_span("view") as span:
+            response = handler(request)
+            span.name = "view {}".format(route_name(request))
+            span.set_attribute("status", response.status_code)
+            return response
+
+    return tracing_tween
+
+
+class CommandListener(monitoring.CommandListener):
+    """Record a span for each command the driver sends to MongoDB.
+
+    The driver calls the listener in the thread making the command, so its
+    span is a child of whatever is current there e.g. the view.
+
+    """
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        tracing.record(
+            "mongo {}".format(event.command_name),
+            event.duration_micros / 1e6,
+            server="{}:{}".format(*event.connection_id),
+        )
+
+    def failed(self, event):
+        tracing.record(
+            "mongo {}".format(event.command_name),
+            event.duration_micros / 1e6,
+            error=str(event.failure),
+            server="{}:{}".format(*event.connection_id),
+        )
@@ -5,12 +5,19 @@ User Administration views for the REST interface.
 PythonPro Limited
 
 """
+import httplib
 import logging
+import functools
+import threading
 
 from pyramid.view import view_config
+from pyramid.renderers import render
 
-from pp.auth import pwtools
 from pp.user.model import user
+from pp.user.model import cache
+from pp.user.model import changes
+from pp.user.model import pwpool
+from pp.user.validate import error
 from pp.user.validate import userdata
 from pp.web.base.restfulhelpers import json_result
 
@@ -20,15 +27,183 @@ def get_log(extra=None):
     return logging.getLogger(m)
 
 
+# The most usernames or users a batch request can have:
+MAX_BATCH = 1000
+
+# The most changes and seconds to wait for them user_changes() allows, see
+# configure_changes_wait():
+MAX_CHANGES_LIMIT = 1000
+MAX_CHANGES_WAIT = 10.0
+
+# A long poll holds a request thread while it waits. Only this many wait at
+# once, so the other threads are left to serve the rest:
+changes_waiters = threading.BoundedSemaphore(1)
+
+# The fields of a stored user which are never returned, see public():
+INTERNAL_FIELDS = (user.TOKEN_INDEX_FIELD, user.VERSION_FIELD)
+
+# The rendered JSON response body of each user version, by ETag. A new
+# version has a new ETag so entries never need invalidating, the old ones
+# fall out of the LRU. See configure_body_cache():
+body_cache = cache.LRUCache(max_size=10000, ttl=3600)
+
+
+def configure_body_cache(max_size=10000, ttl=3600):
+    """Replace the rendered user body cache.
+
+    :param max_size: The most bodies kept, 0 disables the cache.
+
+    :param ttl: The seconds a body is kept after it was rendered.
+
+    """
+    global body_cache
+    body_cache = cache.LRUCache(max_size=max_size, ttl=ttl)
+
+
+def configure_changes_wait(max_waiters=1, max_wait=10.0):
+    """Set how many user_changes() long polls a worker process allows.
+
+    :param max_waiters: The most requests waiting for changes at once.
+    Beyond this a request with a wait gets a 503 to retry later. Keep it
+    well below the threads serving requests, 0 refuses every wait.
+
+    :param max_wait: The most seconds a request waits for changes.
+
+    """
+    global changes_waiters
+    global MAX_CHANGES_WAIT
+    changes_waiters = threading.BoundedSemaphore(max(max_waiters, 0))
+    MAX_CHANGES_WAIT = max_wait
+
+
+def rendered(request, view):
+    """Render the json_result of the view as the JSON renderer would.
+
+    :returns: The UTF-8 encoded JSON body.
+
+    """
+    body = render('json', json_result(view)(request), request=request)
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    return body
+
+
+def public(userdict):
+    """Remove the INTERNAL_FIELDS from the user dict to be returned.
+
+    The user's version is only given by its ETag, see set_etag().
+
+    :returns: The given user dict or None if None was given.
+
+    """
+    if userdict is not None:
+        for field in INTERNAL_FIELDS:
+            userdict.pop(field, None)
+    return userdict
+
+
+def set_etag(request, userdict):
+    """Set the ETag of the stored user dict on the response.
+
+    This must be called before public() removes the version.
+
+    """
+    request.response.etag = user.etag_for(
+        userdict['_id'], userdict.get(user.VERSION_FIELD)
+    )
+
+
+def unavailable_when_busy(view):
+    """Set the 503 status on the response if the service is too busy.
+
+    Views which hash or verify passwords are wrapped with this so a login
+    storm gets a fast 503 the client can retry later, as are the long polls
+    beyond changes_waiters.
+
+    """
+    @functools.wraps(view)
+    def inner(request):
+        try:
+            return view(request)
+
+        except error.ServiceBusyError:
+            request.response.status_int = httplib.SERVICE_UNAVAILABLE
+            request.response.headers['Retry-After'] = '1'
+            raise
+
+    return inner
+
+
+def decode_new_password(user_data):
+    """Recover the plain new_password the client sent Base64 encoded.
+
+    :returns: The given dict.
+
+    """
+    # un-obuscate the new password, not ideal!
+    if "new_password" in user_data:
+        try:
+            decoded = user_data["new_password"].decode("base64")
+            user_data["new_password"] = decoded
+        except Exception as e:
+            raise ValueError("The new_password not Base64 encoded: %s" % e)
+
+    return user_data
+
+
+def precondition_failed_on_conflict(view):
+    """Set the 412 status on the response if the user version conflicts.
+
+    Views which honour If-Match are wrapped with this so the client can
+    tell the user changed and read it again.
+
+    """
+    @functools.wraps(view)
+    def inner(request):
+        try:
+            return view(request)
+
+        except userdata.UserVersionConflictError:
+            request.response.status_int = httplib.PRECONDITION_FAILED
+            raise
+
+    return inner
+
+
+def expected_from(request):
+    """Recover the user version a request's If-Match header expects.
+
+    :returns: A dict of expected_id and expected_version for user.update()
+    or an empty dict if there is no If-Match or it is '*'.
+
+    """
+    if_match = request.headers.get('If-Match', '').strip()
+    if not if_match or if_match == '*':
+        return {}
+
+    found = user.parse_etag(if_match)
+    if not found:
+        raise userdata.UserVersionConflictError(
+            "The If-Match <{!r}> isn't a user ETag.".format(if_match)
+        )
+
+    return dict(expected_id=found[0], expected_version=found[1])
+
+
 @view_config(route_name='the_users', request_method='PUT', renderer='json')
 @view_config(route_name='the_users-1', request_method='PUT', renderer='json')
 @json_result
+@unavailable_when_busy
 def user_add(request):
     """Add a new user to the system when the data is PUT to the server.
 
     The user dict that's posted must validate against
     userdata.creation_required_fields(user_data).
 
+    The response has the new user's ETag.
+
+    :returns: The new user dict.
+
     """
     log = get_log("user_add")
 
@@ -40,8 +215,9 @@ def user_add(request):
     user_data = userdata.creation_required_fields(user_data)
 
     rc = user.add(**user_data)
+    set_etag(request, rc)
 
-    return rc
+    return public(rc)
 
 
 @view_config(route_name='the_users', request_method='GET', renderer='json')
@@ -50,22 +226,235 @@ def user_add(request):
 def the_users(request):
     """Handle the recovery of all users currently on the system.
 
-    :returns: A list of user dicts or an empty list.
+    The query string can narrow down the users returned:
+
+        limit: return pages of at most this many users.
+
+        after: only users after this '_id' are returned, with or without a
+        limit. See below.
+
+        fields: a comma separated list of the user fields to return.
+
+        <field>=<value>: only users with this field value are returned.
+        Field names can't start with '$' or contain a '.' so no query
+        operators can be given.
+
+    :returns: A list of user dicts or an empty list. When a limit is given
+    a page dict is returned instead::
+
+        dict(
+            users=[<user dict>, ..],
+            # The '_id' to request the next page with or None at the end:
+            after="<_id>",
+        )
 
     """
     log = get_log("user_get")
 
-    log.debug("recovering all users on the system")
+    criteria = dict(request.params)
+    limit = criteria.pop('limit', None)
+    after = criteria.pop('after', None)
+    fields = criteria.pop('fields', None)
+    if fields:
+        fields = [f.strip() for f in fields.split(',') if f.strip()]
+
+    for name in criteria.keys() + (fields or []):
+        if name.startswith('$') or '.' in name:
+            raise ValueError("The field name <{!r}> isn't allowed.".format(
+                name
+            ))
+
+    if limit is None:
+        log.debug("recovering all users on the system")
+        the_users, after = user.page(criteria, after=after, fields=fields)
+        log.debug("Returning all '{}' user(s).".format(len(the_users)))
+        return [public(userdict) for userdict in the_users]
+
+    limit = int(limit)
+    if limit < 1:
+        raise ValueError("The limit must be 1 or more not '{}'".format(limit))
+
+    the_users, after = user.page(
+        criteria, limit=limit, after=after, fields=fields
+    )
+    log.debug("Returning page of '{}' user(s).".format(len(the_users)))
+
+    return dict(
+        users=[public(userdict) for userdict in the_users], after=after,
+    )
+
 
-    the_users = [u for u in user.find()]
+@view_config(
+    route_name='the_users-batch', request_method='PUT', renderer='json'
+)
+@json_result
+@unavailable_when_busy
+def the_users_add_batch(request):
+    """Add many new users to the system at once.
+
+    The PUT JSON is a list of at most MAX_BATCH user dicts, each as the
+    add of a single user takes. The users which don't validate or whose
+    username is present are reported, the rest are still added.
+
+    :returns: A list in the same order as the users given of::
+
+        dict(
+            username="<username>",
+            status="added" | "conflict" | "invalid" | "failed",
+            _id="<the new user's '_id'>" | None,
+            message="<why the user wasn't added>" | None,
+        )
+
+    """
+    log = get_log("the_users_add_batch")
+
+    users = request.json_body
+    if not isinstance(users, list) or len(users) > MAX_BATCH:
+        raise ValueError(
+            "A list of at most {} users must be given.".format(MAX_BATCH)
+        )
+
+    log.debug("adding <{}> users".format(len(users)))
+    results = user.add_many(users)
+    log.debug("'{}' users added ok.".format(
+        sum(1 for result in results if result['status'] == user.ADDED)
+    ))
+
+    return results
+
+
+@view_config(
+    route_name='the_users-batch', request_method='POST', renderer='json'
+)
+@json_result
+def the_users_batch(request):
+    """Recover many users in one request.
+
+    The POSTed JSON is the usernames and optionally the fields to return::
+
+        dict(
+            usernames=["<username>", ..],
+            # Optional, the '_id' and 'username' are always returned:
+            fields=["<field name>", ..],
+        )
+
+    At most MAX_BATCH usernames can be given.
+
+    :returns: A dict of the form::
+
+        dict(
+            # In the order given, None for a username not found:
+            users=[<user dict> | None, ..],
+            missing=["<username not found>", ..],
+        )
+
+    """
+    log = get_log("the_users_batch")
+
+    data = request.json_body
+    if not isinstance(data, dict):
+        raise ValueError("A dict of the usernames must be given.")
+
+    usernames = data.get('usernames', [])
+    fields = data.get('fields')
+    if not isinstance(usernames, list) or not all(
+        isinstance(username, basestring) for username in usernames
+    ):
+        raise ValueError("The usernames must be a list of strings.")
+
+    if fields is not None and (not isinstance(fields, list) or not all(
+        isinstance(field, basestring) for field in fields
+    )):
+        raise ValueError("The fields must be a list of strings.")
+
+    if len(usernames) > MAX_BATCH:
+        raise ValueError("At most {} usernames can be given not {}.".format(
+            MAX_BATCH, len(usernames)
+        ))
+
+    usernames = [username.strip().lower() for username in usernames]
+
+    log.debug("recovering <{}> users".format(len(usernames)))
+    found = user.get_many(usernames, fields=fields)
+
+    return dict(
+        users=[public(userdict) for userdict in found],
+        missing=[
+            username for username, userdict in zip(usernames, found)
+            if userdict is None
+        ],
+    )
+
+
+@view_config(route_name='user-changes', request_method='GET', renderer='json')
+@view_config(
+    route_name='user-changes-1', request_method='GET', renderer='json'
+)
+@json_result
+@unavailable_when_busy
+def user_changes(request):
+    """Return the user changes after a sequence number, see model.changes.
+
+    The query string is:
+
+        since: the 'last_seq' of the previous call, 0 by default.
+
+        limit: the most changes returned, 100 by default.
+
+        wait: the seconds to wait for a change if there are none yet, 0 by
+        default. At most MAX_CHANGES_WAIT seconds are waited.
+
+    Each waiting request holds a thread, so only changes_waiters requests
+    wait at once. Another request with a wait gets a 503 to retry later.
 
-    log.debug("Returning all '{}' user(s).".format(len(the_users)))
+    :returns: A dict of the form::
 
-    return the_users
+        dict(
+            changes=[<change>, ..],
+            last_seq=<the since of the following call>,
+            # True if the changes are no longer held, reload every user:
+            reset=<True or False>,
+        )
+
+    """
+    log = get_log("user_changes")
+
+    since = int(request.params.get('since', 0))
+    limit = int(request.params.get('limit', 100))
+    wait = float(request.params.get('wait', 0))
+    if since < 0 or not 0 < limit <= MAX_CHANGES_LIMIT:
+        raise ValueError(
+            "The since must be 0 or more and the limit 1 to {}.".format(
+                MAX_CHANGES_LIMIT
+            )
+        )
+
+    wait = min(max(wait, 0.0), MAX_CHANGES_WAIT)
+    if wait:
+        if not changes_waiters.acquire(False):
+            raise error.ServiceBusyError(
+                "Too many requests are waiting for changes, try again later."
+            )
+        try:
+            found = changes.wait(since, limit, wait)
+        finally:
+            changes_waiters.release()
+    else:
+        found = changes.since(since, limit)
+
+    for change in found['changes']:
+        public(change['user'])
+
+    log.debug("'{}' change(s) after '{}'.".format(
+        len(found['changes']), since
+    ))
+
+    return found
 
 
 @view_config(route_name='user-auth', request_method='POST', renderer='json')
 @json_result
+@unavailable_when_busy
 def user_auth(request):
     """Handle password verification.
 
@@ -98,9 +487,7 @@ def user_auth(request):
     #     found_user, pw
     # ))
 
-    result = pwtools.validate_password(
-        pw, found_user['password_hash']
-    )
+    result = pwpool.validate_password(pw, found_user['password_hash'])
 
     log.debug("user <{!r}> password validated? {}".format(
         found_user['username'], result
@@ -109,12 +496,91 @@ def user_auth(request):
     return result
 
 
+@view_config(
+    route_name='user-auth-batch', request_method='POST', renderer='json'
+)
+@json_result
+@unavailable_when_busy
+def user_auth_batch(request):
+    """Handle the password verification of many users at once.
+
+    The POSTed JSON is a list of at most MAX_BATCH of the username and
+    base64 encoded password to verify::
+
+        [
+            dict(username="<username>", password="<base64 password>"),
+            :
+            etc
+        ]
+
+    An item which isn't of this form is reported and the rest still
+    verified.
+
+    :returns: A list in the same order as that given of::
+
+        dict(
+            username="<username>",
+            # False if the password is wrong or the user wasn't found:
+            authenticated=True | False,
+            found=True | False,
+            # Why the item couldn't be verified:
+            message="<description>" | None,
+        )
+
+    """
+    log = get_log("user_auth_batch")
+
+    items = request.json_body
+    if not isinstance(items, list) or len(items) > MAX_BATCH:
+        raise ValueError(
+            "A list of at most {} credentials must be given.".format(
+                MAX_BATCH
+            )
+        )
+
+    results = []
+    credentials = []
+    for item in items:
+        result = dict(
+            username=None, authenticated=False, found=False, message=None
+        )
+        results.append(result)
+        try:
+            result['username'] = item['username'].strip().lower()
+            plain_pw = item['password'].decode("base64")
+
+        except Exception as e:
+            result['message'] = "The credentials aren't valid: {}".format(e)
+            continue
+
+        credentials.append((result, plain_pw))
+
+    log.debug("attempting to verify <{}> users".format(len(credentials)))
+
+    found = user.validate_passwords([
+        (result['username'], plain_pw) for result, plain_pw in credentials
+    ])
+    for (result, plain_pw), validated in zip(credentials, found):
+        result.update(
+            authenticated=validated is True,
+            found=validated is not None,
+        )
+
+    return results
+
+
 @view_config(route_name='user', request_method='PUT', renderer='json')
 @view_config(route_name='user-1', request_method='PUT', renderer='json')
 @json_result
+@unavailable_when_busy
+@precondition_failed_on_conflict
 def user_update(request):
     """Update a stored user on the system.
 
+    If the request has an If-Match with the user's ETag the update is only
+    made if the user is still that version, otherwise the status is 412.
+    The response has the updated user's ETag.
+
     :returns: The updated user dict.
 
     """
@@ -124,29 +590,66 @@ def user_update(request):
 
     log.debug("updating user <{!r}>".format(username))
 
-    user_data = request.json_body
-
-    # un-obuscate the new password, not ideal!
-    if "new_password" in user_data:
-        try:
-            decoded = user_data["new_password"].decode("base64")
-            user_data["new_password"] = decoded
-        except Exception as e:
-            raise ValueError("The new_password not Base64 encoded: %s" % e)
-
+    user_data = decode_new_password(request.json_body)
+    user_data.update(expected_from(request))
     result = user.update(**user_data)
+    set_etag(request, result)
 
     log.debug("user <{!r}> updated ok.".format(result['username']))
 
-    return result
+    return public(result)
 
 
-@view_config(route_name='user', request_method='GET', renderer='json')
-@view_config(route_name='user-1', request_method='GET', renderer='json')
+@view_config(route_name='user', request_method='PATCH', renderer='json')
+@view_config(route_name='user-1', request_method='PATCH', renderer='json')
 @json_result
+@unavailable_when_busy
+@precondition_failed_on_conflict
+def user_patch(request):
+    """Change some of a stored user's fields with a JSON merge patch.
+
+    The body is merged into the user (RFC 7396): nested objects such as
+    'extra' and 'tokens' are merged field by field and a null removes the
+    field. The 'new_password' and 'new_username' fields are handled as for
+    PUT, as is If-Match.
+
+    :returns: The updated user dict.
+
+    """
+    log = get_log("user_patch")
+
+    username = request.matchdict['username'].strip().lower()
+
+    log.debug("patching user <{!r}>".format(username))
+
+    patch = request.json_body
+    if not isinstance(patch, dict):
+        raise ValueError("The merge patch must be a JSON object.")
+
+    patch = decode_new_password(patch)
+
+    patch.pop('username', None)
+    fields, remove = user.flatten_patch(patch)
+    fields.update(expected_from(request))
+    result = user.update(username=username, remove=remove, **fields)
+    set_etag(request, result)
+
+    log.debug("user <{!r}> patched ok.".format(username))
+
+    return public(result)
+
+
+@view_config(route_name='user', request_method='GET')
+@view_config(route_name='user-1', request_method='GET')
 def user_get(request):
     """Recover a user based on the given username.
 
+    The response has the user's ETag. If the request's If-None-Match has
+    it the user hasn't changed and an empty 304 is returned. The rendered
+    body of each version is cached so it is only rendered once.
+
+    The user's version is given by the ETag, see public().
+
     :returns: The user dict.
 
     """
@@ -155,10 +658,38 @@ def user_get(request):
     username = request.matchdict['username'].strip().lower()
     log.debug("attempting to recover <{!r}>".format(username))
 
-    result = user.get(username)
-    log.debug("user <{!r}> recovered ok.".format((result['username'])))
-
-    return result
+    # The status and headers json_result() sets are kept:
+    response = request.response
+
+    try:
+        result = user.get(username)
+
+    except userdata.UserNotFoundError as e:
+        def not_found(request):
+            raise e
+        body = rendered(request, not_found)
+
+    else:
+        log.debug("user <{!r}> recovered ok.".format(result['username']))
+        etag = user.etag_for(result['_id'], result.get(user.VERSION_FIELD))
+        response.etag = etag
+        if etag in request.if_none_match:
+            log.debug("user <{!r}> not modified.".format(username))
+            response.status_int = httplib.NOT_MODIFIED
+            return response
+
+        response.cache_control = 'no-cache'
+        body = body_cache.get(etag)
+        if body is None:
+            public(result)
+            body = rendered(request, lambda request: result)
+            body_cache.set(etag, body)
+
+    response.content_type = 'application/json'
+    response.charset = 'utf-8'
+    response.body = body
+
+    return response
 
 
 @view_config(route_name='user', request_method='DELETE', renderer='json')
@@ -12,6 +12,10 @@ import pkg_resources
 from pyramid.view import view_config
 from pp.web.base.restfulhelpers import json_result
 
+from pp.user.model import user
+from pp.user.model import pwpool
+from pp.user.service import useradminviews
+
 
 @view_config(route_name='home', request_method='GET', renderer='json')
 @json_result
@@ -25,7 +29,23 @@ def status(request):
         dict(
             status="ok",
             name="<project name>",
-            version="<egg version of pp.user.service>"
+            version="<egg version of pp.user.service>",
+            secret_cache=dict(
+                size=<entries>,
+                max_size=<most entries>,
+                hits=<count>,
+                misses=<count>,
+                evictions=<count>,
+            ),
+            body_cache=dict(<the same as secret_cache>),
+            password_pool=dict(
+                processes=<worker processes>,
+                max_pending=<most passwords queued>,
+                pending=<passwords queued or in progress>,
+                completed=<count>,
+                rejected=<count>,
+                utilisation=<0.0 to 1.0>,
+            ),
         )
 
     """
@@ -35,4 +55,7 @@ def status(request):
         status="ok",
         name="pp-user-service",
         version=pkg.version,
+        secret_cache=user.secret_cache.stats(),
+        body_cache=useradminviews.body_cache.stats(),
+        password_pool=pwpool.stats(),
     )
@@ -39,6 +39,7 @@ needed = [
     'pp-user-validate',
     'pp-user-service',
     'pp-user-client',
+    'gunicorn',
 ]
 
 test_needed = [
@@ -61,6 +62,10 @@ PackageData = {
 EntryPoints = {
     'paste.app_factory': [
         'main = pp.user.service:main'
+    ],
+    'console_scripts': [
+        'user-service = pp.user.service.scripts.main:main',
+        'user-service-loadtest = pp.user.service.loadtest:main',
     ]
 }
 
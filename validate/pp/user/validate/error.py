@@ -6,3 +6,7 @@ This contains for general exceptions.
 
 class CommunicationError(Exception):
     """A server error occured adding performing an operation."""
+
+
+class ServiceBusyError(Exception):
+    """The service is too busy to handle the request, try again later."""
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import json
+import shutil
+import tempfile
+import unittest
+import os.path
+
+from pp.user.validate import tracing
+
+
+class TracingTC(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = tracing.InMemoryExporter()
+        self.tracer = tracing.Tracer(sample_rate=1.0, exporter=self.exporter)
+
+    def test_parse_traceparent(self):
+        """Test the trace context is recovered from valid headers only.
+        """
+        trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+        value = "00-{}-00f067aa0ba902b7-01".format(trace_id)
+        self.assertEquals(
+            tracing.parse_traceparent(value),
+            (trace_id, "00f067aa0ba902b7", True)
+        )
+        self.assertEquals(
+            tracing.parse_traceparent(value[:-1] + "0")[2], False
+        )
+
+        for bad in [
+            None, "", "junk", "00-abc-00f067aa0ba902b7-01",
+            "00-{}-0000000000000000-01".format(trace_id),
+            "00-{}-00f067aa0ba902b7-zz".format(trace_id),
+        ]:
+            self.assertEquals(tracing.parse_traceparent(bad), None)
+
+    def test_nested_spans(self):
+        """Test spans in the same thread become children of the current.
+        """
+        with self.tracer.start_span("outer", kind="test") as outer:
+            self.assertEquals(self.tracer.current_span(), outer)
+            with self.tracer.start_span("inner") as inner:
+                inner.set_attribute("users", 3)
+            self.tracer.record("done", 0.25)
+            self.tracer.record("failed", 0.1, error="timed out")
+
+        self.assertEquals(self.tracer.current_span(), None)
+
+        spans = dict((s['name'], s) for s in self.exporter.spans)
+        self.assertEquals(
+            [s['name'] for s in self.exporter.spans],
+            ["inner", "done", "failed", "outer"]
+        )
+        self.assertEquals(spans['outer']['parent_id'], None)
+        self.assertEquals(spans['outer']['attributes'], dict(kind="test"))
+        self.assertEquals(spans['inner']['parent_id'], outer.span_id)
+        self.assertEquals(spans['inner']['attributes'], dict(users=3))
+        self.assertEquals(spans['done']['parent_id'], outer.span_id)
+        self.assertEquals(spans['done']['duration_ms'], 250.0)
+        self.assertEquals(spans['failed']['error'], "timed out")
+        for span in self.exporter.spans:
+            self.assertEquals(span['trace_id'], outer.trace_id)
+
+    def test_remote_parent_and_sampling(self):
+        """Test a remote parent is continued and its sampling honoured.
+        """
+        caller = tracing.Span("caller", "ab" * 16, sampled=True)
+
+        tracer = tracing.Tracer(sample_rate=0.0, exporter=self.exporter)
+        with tracer.start_span("server", caller.traceparent()) as span:
+            pass
+        self.assertEquals(span.trace_id, caller.trace_id)
+        self.assertEquals(span.parent_id, caller.span_id)
+        self.assertEquals(len(self.exporter.spans), 1)
+
+        # Not sampled by the caller or here so nothing is exported, but the
+        # context is still passed on:
+        caller.sampled = False
+        with tracer.start_span("server", caller.traceparent()) as span:
+            self.assertTrue(span.traceparent().endswith("-00"))
+        self.assertEquals(len(self.exporter.spans), 1)
+
+    def test_errors_are_recorded(self):
+        """Test an exception raised in a span is recorded on it.
+        """
+        def broken():
+            with self.tracer.start_span("broken"):
+                raise ValueError("boom")
+
+        self.assertRaises(ValueError, broken)
+        self.assertEquals(self.exporter.spans[0]['error'], "ValueError: boom")
+
+    def test_file_exporter(self):
+        """Test spans are appended to the file as JSON lines.
+        """
+        test_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(test_dir, "spans.json")
+            exporter = tracing.exporter_from("file", path)
+            tracer = tracing.Tracer(sample_rate=1.0, exporter=exporter)
+            with tracer.start_span("one"):
+                pass
+            with tracer.start_span("two"):
+                pass
+
+            with open(path) as fd:
+                names = [json.loads(line)['name'] for line in fd]
+            self.assertEquals(names, ["one", "two"])
+            self.assertEquals(len(exporter.read()), 2)
+
+        finally:
+            shutil.rmtree(test_dir)
+
+        self.assertEquals(tracing.exporter_from("none"), None)
+        self.assertTrue(isinstance(
+            tracing.exporter_from("memory"), tracing.InMemoryExporter
+        ))
+        self.assertTrue(isinstance(
+            tracing.exporter_from("pp.user.validate.tracing:LogExporter"),
+            tracing.LogExporter
+        ))
+        self.assertRaises(ValueError, tracing.exporter_from, "file")
+        self.assertRaises(ValueError, tracing.exporter_from, "zipkin")
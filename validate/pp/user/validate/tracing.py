@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Trace a call from the client, through the service and into MongoDB.
+
+A span times one piece of work. Spans started while another is current in
+the same thread become its children. The trace context crosses from the
+client to the service in the W3C 'traceparent' request header::
+
+    traceparent: 00-<32 hex trace id>-<16 hex parent span id>-01
+
+This lives here as the client, model and service all depend on it.
+
+Sampling is decided once at the root of a trace. A trace the caller
+sampled is always sampled, otherwise sample_rate of the traces starting
+here are. Only sampled spans are exported, unsampled ones only carry the
+trace context on::
+
+    tracing.configure(sample_rate=0.1, exporter=FileExporter("spans.json"))
+
+    with tracing.start_span("import", source="crm") as span:
+        :
+        span.set_attribute("users", len(users))
+
+"""
+import os
+import json
+import time
+import random
+import logging
+import binascii
+import functools
+import threading
+from timeit import default_timer
+
+
+def get_log(e=None):
+    return logging.getLogger("{0}.{1}".format(__name__, e) if e else __name__)
+
+
+# The header the trace context travels in:
+HEADER = "traceparent"
+
+# The header as it appears in a WSGI environ:
+ENVIRON_KEY = "HTTP_TRACEPARENT"
+
+
+def _new_id(bits):
+    # os.urandom so forked workers don't repeat each other's ids:
+    return binascii.hexlify(os.urandom(bits // 8))
+
+
+def parse_traceparent(value):
+    """Recover the trace context from a traceparent header value.
+
+    :returns: (trace_id, parent_span_id, sampled) or None if the value is
+    missing or malformed.
+
+    """
+    try:
+        version, trace_id, span_id, flags = value.strip().split("-")
+        int(trace_id, 16)
+        int(span_id, 16)
+        sampled = bool(int(flags, 16) & 0x01)
+    except (AttributeError, ValueError):
+        return None
+
+    if (
+        len(version) != 2 or len(trace_id) != 32 or len(span_id) != 16 or
+        trace_id == "0" * 32 or span_id == "0" * 16
+    ):
+        return None
+
+    return trace_id.lower(), span_id.lower(), sampled
+
+
+class Span(object):
+    """A timed piece of work in a trace."""
+
+    def __init__(
+        self, name, trace_id, parent_id=None, sampled=False, attributes=None,
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start = time.time()
+        self.duration = None
+        self._started = default_timer()
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def traceparent(self):
+        """Return the header value making this span the remote parent."""
+        return "00-{}-{}-{}".format(
+            self.trace_id, self.span_id, "01" if self.sampled else "00"
+        )
+
+    def finish(self, duration=None):
+        """Record the span's duration in seconds, measured if not given."""
+        if duration is None:
+            duration = default_timer() - self._started
+        self.duration = duration
+
+    def to_dict(self):
+        return dict(
+            name=self.name,
+            trace_id=self.trace_id,
+            span_id=self.span_id,
+            parent_id=self.parent_id,
+            start=self.start,
+            duration_ms=self.duration * 1000,
+            attributes=self.attributes,
+            error=self.error,
+            pid=os.getpid(),
+            thread=threading.current_thread().name,
+        )
+
+
+class InMemoryExporter(object):
+    """Keep the finished spans in a list, for tests."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def export(self, span):
+        with self.lock:
+            self.spans.append(span.to_dict())
+
+    def clear(self):
+        with self.lock:
+            self.spans = []
+
+
+class FileExporter(object):
+    """Append each finished span to a file as a line of JSON."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict()) + "\n"
+        with self.lock:
+            with open(self.path, "a") as fd:
+                fd.write(line)
+
+    def read(self):
+        """Return the spans written so far."""
+        with open(self.path) as fd:
+            return [json.loads(line) for line in fd if line.strip()]
+
+
+class LogExporter(object):
+    """Log each finished span at debug level."""
+
+    def export(self, span):
+        get_log("LogExporter").debug(json.dumps(span.to_dict()))
+
+
+class Tracer(object):
+    """Start spans, keeping the current one per thread."""
+
+    def __init__(self, sample_rate=0.0, exporter=None):
+        """
+        :param sample_rate: The fraction 0.0 to 1.0 of traces starting here
+        which are sampled.
+
+        :param exporter: An object with an export(span) method called with
+        each sampled span as it finishes.
+
+        """
+        self.sample_rate = float(sample_rate)
+        self.exporter = exporter
+        self._local = threading.local()
+
+    def current_span(self):
+        """Return the current span of this thread or None."""
+        stack = getattr(self._local, "stack", None)
+        return stack[-1] if stack else None
+
+    def _sampled(self, remote_sampled=False):
+        if remote_sampled:
+            return True
+        return bool(self.sample_rate) and random.random() < self.sample_rate
+
+    def new_span(self, name, traceparent=None, attributes=None):
+        """Return a span which is a child of the current or remote span.
+
+        :param traceparent: The caller's traceparent header value. Used if
+        there is no current span in this thread.
+
+        """
+        parent = self.current_span()
+        if parent:
+            return Span(
+                name, parent.trace_id, parent.span_id, parent.sampled,
+                attributes,
+            )
+
+        remote = parse_traceparent(traceparent) if traceparent else None
+        if remote:
+            trace_id, parent_id, sampled = remote
+            return Span(
+                name, trace_id, parent_id, self._sampled(sampled), attributes,
+            )
+
+        return Span(name, _new_id(128), None, self._sampled(), attributes)
+
+    def start_span(self, name, traceparent=None, **attributes):
+        """Return a context manager timing the work done within it.
+
+        The span is current inside the with block and records the error
+        of any exception raised from it.
+
+        """
+        return _Active(self, self.new_span(name, traceparent, attributes))
+
+    def record(self, name, duration, error=None, **attributes):
+        """Export a child of the current span for work already done.
+
+        :param duration: The seconds the work took, ending now.
+
+        :param error: A description of how the work failed, if it did.
+
+        """
+        span = self.new_span(name, attributes=attributes)
+        span.start -= duration
+        span.error = error
+        span.finish(duration)
+        self.export(span)
+        return span
+
+    def export(self, span):
+        if span.sampled and self.exporter:
+            try:
+                self.exporter.export(span)
+            except Exception:
+                get_log("Tracer.export").exception("span export failed.")
+
+    def _push(self, span):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(span)
+
+    def _pop(self, span):
+        stack = self._local.stack
+        if stack and stack[-1] is span:
+            stack.pop()
+        elif span in stack:
+            stack.remove(span)
+
+
+class _Active(object):
+    """The context manager returned by Tracer.start_span()."""
+
+    def __init__(self, tracer, span):
+        self.tracer = tracer
+        self.span = span
+
+    def __enter__(self):
+        self.tracer._push(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.span.finish()
+        if exc_type is not None:
+            self.span.error = "{}: {}".format(exc_type.__name__, exc_value)
+        self.tracer._pop(self.span)
+        self.tracer.export(self.span)
+
+
+# The tracer of this process, see configure():
+tracer = Tracer()
+
+
+def configure(sample_rate=0.0, exporter=None):
+    """Set the sampling rate and exporter of this process's tracer."""
+    tracer.sample_rate = float(sample_rate)
+    tracer.exporter = exporter
+
+
+def current_span():
+    """See Tracer.current_span()."""
+    return tracer.current_span()
+
+
+def start_span(name, traceparent=None, **attributes):
+    """See Tracer.start_span()."""
+    return tracer.start_span(name, traceparent, **attributes)
+
+
+def record(name, duration, error=None, **attributes):
+    """See Tracer.record()."""
+    return tracer.record(name, duration, error, **attributes)
+
+
+def traced(name):
+    """Decorate a function so each call is done within a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.start_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def exporter_from(name, path=None):
+    """Create an exporter from its configured name.
+
+    :param name: One of 'none', 'memory', 'log' or 'file', or the
+    'package.module:factory' of another exporter.
+
+    :param path: The file the 'file' exporter appends spans to. It is also
+    given to a custom factory if set.
+
+    :returns: An exporter instance or None.
+
+    """
+    name = (name or "none").strip()
+    if ":" in name:
+        module, factory = name.split(":")
+        factory = getattr(__import__(module, fromlist=[factory]), factory)
+        return factory(path) if path else factory()
+
+    name = name.lower()
+    if name == "none":
+        return None
+    elif name == "memory":
+        return InMemoryExporter()
+    elif name == "log":
+        return LogExporter()
+    elif name == "file":
+        if not path:
+            raise ValueError("The file exporter needs a path.")
+        return FileExporter(path)
+
+    raise ValueError("Unknown span exporter '{}'.".format(name))
@@ -26,6 +26,19 @@ class UserNotFoundError(UserServiceError):
     """Raised when a user is not present on the system."""
 
 
+class UserVersionConflictError(UserServiceError):
+    """Raised when a user changed from the version an update expected."""
+
+
+class ChangesResetError(UserServiceError):
+    """Raised when the changes asked for are no longer held.
+
+    Every user must be reloaded, then changes followed from the sequence
+    number before the reload.
+
+    """
+
+
 class UserNameRequiredError(UserServiceError):
     """Raised when a username is not present or empty."""
 